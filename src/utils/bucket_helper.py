@@ -30,9 +30,7 @@ class BucketHelper(object):
     """
 
     def __init__(self):
-        config = ConfigHelper()
-        self.bucket = config.get_config("GCP_BUCKET")
-        self.account = config.get_config("GOOGLE_APPLICATION_CREDENTIALS")
+        self.bucket, self.account = ConfigHelper.shared().bucket()
 
         # all these values are necessary
         if not self.bucket or not self.account:
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Import and export the classification rules in bulk, as CSV or JSON, with
+the same columns as the classification form
+"""
+
+# python standard
+import io
+import csv
+import json
+import logging
+from types import SimpleNamespace
+
+# third-party imports
+from sqlalchemy import text
+
+# local imports
+from utils.pattern_helper import SOURCES
+from utils.regex_helper import check_pattern, vet_rules
+
+############################################################################
+logger = logging.getLogger('dspreview_application')
+############################################################################
+
+LABELS = ["brand", "sub_brand", "dsp"]
+FLAGS = ["use_campaign_id", "use_campaign", "use_placement_id",
+         "use_placement"]
+RULE_FIELDS = ["pattern"] + LABELS + FLAGS
+
+# the sizes of the `classifications` columns
+MAX_LENGTHS = {"pattern": 256, "brand": 25, "sub_brand": 25, "dsp": 25}
+
+RULE_FORMATS = ("csv", "json")
+
+TRUE_VALUES = ("1", "true", "t", "yes", "y")
+
+
+def read_rules(content, fmt):
+    """
+    Params
+    ------
+    content : string
+        a CSV with a header, or a JSON list of objects (an object with the
+        list in `data` is accepted too, it is what the export writes)
+    fmt : string
+        one of `RULE_FORMATS`
+
+    Returns
+    -------
+    A list of dictionaries, as they were written
+    """
+    if fmt == "json":
+        rows = json.loads(content)
+        if isinstance(rows, dict):
+            rows = rows.get("data", [])
+        return list(rows)
+    if fmt == "csv":
+        return list(csv.DictReader(io.StringIO(content)))
+    raise Exception("Unknown rules format [{}]".format(fmt))
+
+
+def flag(value):
+    if isinstance(value, str):
+        return value.strip().lower() in TRUE_VALUES
+    return bool(value)
+
+
+def signature(rule):
+    """
+    the fields of the unique index of `classifications`, normalized like
+    its collation compares them, the case and the trailing spaces aside
+    """
+    return (tuple((rule.get(f) or "").lower().rstrip()
+                  for f in ["pattern"] + LABELS) +
+            tuple(bool(rule.get(f)) for f in FLAGS))
+
+
+def validate_rules(rows, index=None):
+    """
+    Params
+    ------
+    rows : array_like
+        dictionaries from `read_rules`
+    index : utils.pattern_helper.KeyIndex
+        the keys the patterns are timed against, see
+        `utils.regex_helper.vet_rules`
+
+    Returns
+    -------
+    the rules with the `RULE_FIELDS`, and a list of errors, one for each
+    invalid row, numbered from 1
+    """
+    rules, errors, seen = [], [], set()
+    for n, row in enumerate(rows, 1):
+        rule = {"pattern": (row.get("pattern") or "").strip()}
+        for f in LABELS:
+            rule[f] = (row.get(f) or "").strip()
+        for f in FLAGS:
+            rule[f] = flag(row.get(f))
+
+        problems = []
+        if not rule["pattern"]:
+            problems.append("the pattern is missing")
+        else:
+            problems += check_pattern(rule["pattern"])
+        if not any(rule[f] for f in LABELS):
+            problems.append("a brand, sub brand or dsp is required")
+        if not any(rule[f] for f in FLAGS):
+            problems.append("at least one use_* flag is required")
+        problems += ["{} is longer than {}".format(f, size)
+                     for f, size in MAX_LENGTHS.items()
+                     if len(rule[f] or "") > size]
+        if signature(rule) in seen:
+            problems.append("it is repeated")
+        seen.add(signature(rule))
+
+        if problems:
+            errors.append("row {}: {}".format(n, ", ".join(problems)))
+        rules.append(rule)
+
+    if not errors:
+        # only the patterns of a valid file are run
+        slow = vet_rules([SimpleNamespace(**r) for r in rules], index)
+        errors = ["row {}: {}".format(n, ", ".join(problems))
+                  for n, problems in enumerate(slow, 1) if problems]
+    return rules, errors
+
+
+def import_rules(con, rules, replace=False):
+    """
+    Insert the rules in a single transaction, with a single `executemany`
+
+    Params
+    ------
+    con : sqlalchemy connection
+    rules : array_like
+        valid rules from `validate_rules`
+    replace : boolean
+        if True, the current rules are replaced by `rules` (in their order),
+        otherwise the rules that already exist are skipped
+
+    Returns
+    -------
+    A dictionary with how many rules were inserted, skipped and removed, and
+    `changed`, the rules whose keys might be classified differently now
+    """
+    query = "SELECT {} FROM classifications ORDER BY id".format(
+        ", ".join(RULE_FIELDS))
+    existing = [dict(zip(RULE_FIELDS, r)) for r in con.execute(query)]
+    current = {signature(r) for r in existing}
+    if replace:
+        incoming = {signature(r) for r in rules}
+        removed = [r for r in existing if signature(r) not in incoming]
+        new = list(rules)
+        # the order, so the rule winning a key, might change as well
+        changed = new + removed
+    else:
+        removed = []
+        new = [r for r in rules if signature(r) not in current]
+        changed = new
+
+    with con.begin():
+        if replace:
+            con.execute("DELETE FROM classifications")
+        if new:
+            con.execute(text("INSERT INTO classifications ({}) VALUES ({})"
+                             .format(", ".join(RULE_FIELDS),
+                                     ", ".join(":" + f for f in RULE_FIELDS))),
+                        new)
+    logger.info("Imported [{}] classifications, removed [{}]".format(
+        len(new), len(removed)))
+    return {
+        "inserted": len(new),
+        "skipped": len(rules) - len(new),
+        "removed": len(removed),
+        "changed": changed
+    }
+
+
+def affected_keys(index, rules):
+    """
+    Params
+    ------
+    index : utils.pattern_helper.KeyIndex
+    rules : array_like
+        rules as dictionaries
+
+    Returns
+    -------
+    by source, how many distinct keys are matched by any of the `rules`
+    """
+    affected = {}
+    for source in SOURCES:
+        keys = set()
+        for rule in rules:
+            keys |= index.matches(source, SimpleNamespace(**rule),
+                                  cache=False)
+        affected[source] = len(keys)
+    return affected
+
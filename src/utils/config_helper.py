@@ -6,31 +6,81 @@ Config file manager
 # python standard
 import os
 import json
+import threading
+from collections import namedtuple
+
+ConnectionInfo = namedtuple("ConnectionInfo",
+                            "dbhost, dbport, dbuser, dbpass, dbname")
+BucketInfo = namedtuple("BucketInfo", "bucket, account")
+MQInfo = namedtuple("MQInfo", "host, port, vhost, user, password, queue")
 
 
 class ConfigHelper(object):
     """
     Manage the config file
     """
+    _shared = None
+    _shared_lock = threading.Lock()
+
     def __init__(self):
         self.config_info = {}
+        self.mtime = None
 
         # check for the config file even if the env vars are found
         self.user_home = os.path.expanduser("~")
         self.config_file = "{}/.dspreview.json".format(self.user_home)
+        self.load()
+
+    @classmethod
+    def shared(cls):
+        """
+        The process-wide config, the file is parsed only once and read again
+        only when its modification time changes
+
+        Returns
+        -------
+        A `ConfigHelper` instance shared by the whole process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            elif cls._shared.changed():
+                cls._shared.load()
+            return cls._shared
+
+    def load(self):
+        """
+        (Re)load the config file, creating an empty one if it does not exist
+        """
+        self.config_info = {}
+        self.mtime = None
 
         # create a config file if it does not exist
         if not os.path.exists(self.config_file):
             with open(self.config_file, 'a') as f:
                 f.write("")
         else:
+            self.mtime = self.current_mtime()
             with open(self.config_file, 'r') as f:
                 try:
-                    self.config_info = json.loads(f.read())
+                    content = f.read()
+                    # an empty file is the one created above
+                    if content.strip():
+                        self.config_info = json.loads(content)
                 except Exception as err:
                     print(str(err))
                     raise Exception("Invalid .dspreview.json file.")
 
+    def current_mtime(self):
+        try:
+            return os.path.getmtime(self.config_file)
+        except OSError:
+            return None
+
+    def changed(self):
+        """whether the file was modified since it was loaded"""
+        return self.current_mtime() != self.mtime
+
     def get_config(self, name):
         """
         Params
@@ -40,6 +90,69 @@ class ConfigHelper(object):
         """
         return os.getenv(name) or self.config_info.get(name)
 
+    def get_int(self, name, default=None):
+        value = self.get_config(name)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
+    def get_float(self, name, default=None):
+        value = self.get_config(name)
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return default
+
+    def get_bool(self, name, default=False):
+        value = self.get_config(name)
+        if value is None or value == "":
+            return default
+        if isinstance(value, bool):
+            return value
+        return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+    def database(self, test=False):
+        """
+        Params
+        ------
+        test : boolean
+            if True, the name, user and password of the test database are used
+
+        Returns
+        -------
+        A `ConnectionInfo` with the MySQL connection information
+        """
+        prefix = "DB_TEST_" if test else "DB_"
+        return ConnectionInfo(dbhost=self.get_config("DB_HOST"),
+                              dbport=self.get_config("DB_PORT"),
+                              dbuser=self.get_config(prefix + "USER"),
+                              dbpass=self.get_config(prefix + "PASS"),
+                              dbname=self.get_config(prefix + "NAME"))
+
+    def bucket(self):
+        """
+        Returns
+        -------
+        A `BucketInfo` with the GCP bucket and the service account file
+        """
+        return BucketInfo(
+            bucket=self.get_config("GCP_BUCKET"),
+            account=self.get_config("GOOGLE_APPLICATION_CREDENTIALS"))
+
+    def mq(self):
+        """
+        Returns
+        -------
+        A `MQInfo` with the RabbitMQ connection information
+        """
+        return MQInfo(host=self.get_config("MQ_HOST"),
+                      port=self.get_int("MQ_PORT", 5672),
+                      vhost=self.get_config("MQ_VHOST"),
+                      user=self.get_config("MQ_USER"),
+                      password=self.get_config("MQ_PASS"),
+                      queue=self.get_config("MQ_QUEUE"))
+
     def set_config(self, name, value):
         self.config_info[name] = value
         content = json.dumps(self.config_info)
@@ -47,4 +160,4 @@ class ConfigHelper(object):
             f.write(content)
 
         # reload contents
-        self.__init__()
+        self.load()
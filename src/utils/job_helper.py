@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Background jobs started by the web app, so a long task (the rebuild of the
+classified and report tables) never runs inside a request. A job is a row
+in `jobs`, run by the MQ consumer (see workers.manager), or by a thread of
+this process when JOB_RUNNER is 'local' or the MQ is not available
+"""
+
+# python standard
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta
+
+# third-party imports
+from sqlalchemy import text, DateTime
+
+# local imports
+from utils.config_helper import ConfigHelper
+
+############################################################################
+logger = logging.getLogger('dspreview_application')
+############################################################################
+
+JOB_KINDS = ["rebuild"]
+
+# the MQ messages running a job are this prefix and the job id
+JOB_MESSAGE = "job."
+
+JOB_FIELDS = ["id", "kind", "status", "stage", "processed", "expected",
+              "error", "started_at", "finished_at"]
+
+# the hours a queued job is waited for, an older one was lost (a crashed
+# process, a dropped message) and new jobs do not join it
+JOB_QUEUED_HOURS = 24
+
+
+def expected_duration(con, kind):
+    """the seconds the last job of `kind` took, None if it never ran"""
+    if kind == "rebuild":
+        return con.execute("""SELECT duration FROM rebuilds
+                              ORDER BY id DESC LIMIT 1""").scalar()
+    return None
+
+
+def create_job(con, kind):
+    """
+    Params
+    ------
+    con : sqlalchemy connection
+    kind : string
+        one of `JOB_KINDS`
+
+    Returns
+    -------
+    the id of the new job, it is queued
+    """
+    if kind not in JOB_KINDS:
+        raise Exception("Unknown job [{}]".format(kind))
+    job_id = uuid.uuid4().hex
+    con.execute(text("""INSERT INTO jobs (id, kind, status, processed,
+                                          expected, created_at)
+                        VALUES (:id, :kind, 'queued', 0, :expected,
+                                CURRENT_TIMESTAMP)"""),
+                id=job_id, kind=kind, expected=expected_duration(con, kind))
+    return job_id
+
+
+def queued_job(con, kind):
+    """
+    the id of the oldest job of `kind` still queued, created in the last
+    JOB_QUEUED_HOURS by the clock of the database, None if there is none
+    """
+    hours = ConfigHelper.shared().get_int("JOB_QUEUED_HOURS",
+                                          JOB_QUEUED_HOURS)
+    # `created_at` is set by the database, so is the cutoff
+    now = con.execute(text("SELECT CURRENT_TIMESTAMP AS now").columns(
+        now=DateTime)).scalar()
+    return con.execute(text("""SELECT id FROM jobs
+                               WHERE kind = :kind AND status = 'queued'
+                                 AND created_at > :since
+                               ORDER BY created_at LIMIT 1"""),
+                       kind=kind, since=now - timedelta(hours=hours)).scalar()
+
+
+def update_job(con, job_id, **fields):
+    """set the `fields` (some of `JOB_FIELDS`) of the job"""
+    columns = ", ".join("{0} = :{0}".format(f) for f in fields
+                        if f in JOB_FIELDS)
+    con.execute(text("UPDATE jobs SET {} WHERE id = :job_id".format(columns)),
+                job_id=job_id, **fields)
+
+
+def get_job(con, job_id):
+    """
+    Returns
+    -------
+    A dictionary with the `JOB_FIELDS` and `eta`, the seconds it is still
+    expected to run, None if the job does not exist
+    """
+    query = text("SELECT {} FROM jobs WHERE id = :id".format(
+        ", ".join(JOB_FIELDS))).columns(started_at=DateTime,
+                                        finished_at=DateTime)
+    row = con.execute(query, id=job_id).fetchone()
+    if row is None:
+        return None
+    job = dict(zip(JOB_FIELDS, row))
+    job["eta"] = None
+    if job["status"] == "running" and job["expected"] is not None:
+        elapsed = (datetime.now() - job["started_at"]).total_seconds()
+        job["eta"] = max(job["expected"] - elapsed, 0)
+    return job
+
+
+def run_job(job_id, con=None):
+    """
+    Run the job and record its progress, a failure is recorded in the job
+    instead of being raised
+
+    Params
+    ------
+    job_id : string
+    con : sqlalchemy connection
+        if None, a new one is created
+    """
+    from utils.sql_helper import get_connection
+
+    own = con is None
+    con = con or get_connection()
+    try:
+        job = get_job(con, job_id)
+        if job is None or job["status"] != "queued":
+            logger.warning("Job [{}] is not queued".format(job_id))
+            return
+        run_rebuild(con, job_id)
+    finally:
+        if own:
+            con.close()
+
+
+def run_rebuild(con, job_id):
+    """run the rebuild of the classified and report tables as a job"""
+    from utils.rebuild_helper import rebuild_tables
+
+    logger.info("Running rebuild job [{}]".format(job_id))
+    update_job(con, job_id, status="running", started_at=datetime.now())
+
+    def progress(stage, rows):
+        logger.info("Job [{}] stage [{}], [{}] rows".format(job_id, stage,
+                                                            rows))
+        update_job(con, job_id, stage=stage, processed=rows)
+
+    try:
+        result = rebuild_tables(con, progress=progress)
+        update_job(con, job_id, status="done", stage="done",
+                   processed=sum(result["rows"].values()),
+                   finished_at=datetime.now())
+    except Exception as err:
+        logger.exception(err)
+        update_job(con, job_id, status="failed", error=str(err),
+                   finished_at=datetime.now())
+
+
+def enqueue_job(con, kind):
+    """
+    Create a job and hand it to the MQ consumer, or to a thread of this
+    process when JOB_RUNNER is 'local' or the MQ cannot be reached. While a
+    job of `kind` is queued, it is returned instead, it has not read the
+    classifications yet. A running one might have, so another job is queued
+    after it, they run one after the other (see
+    utils.rebuild_helper.rebuild_lock)
+
+    Returns
+    -------
+    the id of the job
+    """
+    job_id = queued_job(con, kind)
+    if job_id is not None:
+        logger.info("Job [{}] of [{}] is already queued".format(job_id,
+                                                                 kind))
+        return job_id
+    job_id = create_job(con, kind)
+    if (ConfigHelper.shared().get_config("JOB_RUNNER") or "mq") != "local":
+        try:
+            from workers.manager import Manager
+            with Manager() as m:
+                m.schedule_task(JOB_MESSAGE + job_id)
+            return job_id
+        except Exception as err:
+            logger.warning("Running job [{}] locally, {}".format(job_id,
+                                                                 err))
+    threading.Thread(target=run_job, args=(job_id,), daemon=True).start()
+    return job_id
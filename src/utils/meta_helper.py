@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+The report metadata, a single row in `report_meta`
+"""
+
+# python standard
+import logging
+
+# third-party imports
+from sqlalchemy import text
+
+############################################################################
+logger = logging.getLogger('dspreview_application')
+############################################################################
+
+META_ID = 1
+
+
+def report_version(con):
+    """
+    Returns
+    -------
+    The version of the report data, 0 if it was never generated
+    """
+    version = con.execute(text("SELECT version FROM report_meta "
+                               "WHERE id = :id"), id=META_ID).scalar()
+    return version or 0
+
+
+def bump_report_version(con, mode=None, duration=None, rows=None):
+    """
+    Tell the readers that the report data changed, it must be called after
+    every generation of the report
+
+    Params
+    ------
+    con : sqlalchemy connection
+    mode : string
+        how the report was generated, 'incremental', 'full', or 'rebuild'
+    duration : float
+        the seconds it took
+    rows : int
+        the report rows written
+
+    Returns
+    -------
+    The new version
+    """
+    params = {"id": META_ID, "mode": mode, "duration": duration,
+              "rows": rows}
+    result = con.execute(text("""UPDATE report_meta
+                                 SET version = version + 1,
+                                 generated_at = CURRENT_TIMESTAMP,
+                                 mode = :mode, duration = :duration,
+                                 report_rows = :rows,
+                                 updated_at = CURRENT_TIMESTAMP
+                                 WHERE id = :id"""), **params)
+    if not result.rowcount:
+        con.execute(text("""INSERT INTO report_meta (id, version, generated_at,
+                                                     mode, duration,
+                                                     report_rows, updated_at)
+                            VALUES (:id, 1, CURRENT_TIMESTAMP, :mode,
+                                    :duration, :rows, CURRENT_TIMESTAMP)
+                            """), **params)
+    version = report_version(con)
+    logger.info("Report data version [{}]".format(version))
+    return version
+
+
+def report_meta(con):
+    """
+    Returns
+    -------
+    A dictionary with the version, and the time (`generated_at`), mode,
+    duration and rows of the last generation, None if the report was never
+    generated
+    """
+    row = con.execute(text("""SELECT version, generated_at, mode, duration,
+                                     report_rows
+                              FROM report_meta WHERE id = :id"""),
+                      id=META_ID).fetchone()
+    return dict(row) if row is not None else None
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Monthly RANGE partitioning of the fact tables by `date`, so date range reads
+and report regeneration only touch the months they need
+"""
+
+# python standard
+import re
+import logging
+from datetime import date
+
+# local imports
+from utils.config_helper import ConfigHelper
+
+############################################################################
+logger = logging.getLogger('dspreview_application')
+############################################################################
+
+# every unique key of these tables includes `date`, as MySQL requires
+PARTITIONED_TABLES = [
+    "dcm_raw",
+    "dsp_raw",
+    "dcm_classified",
+    "dsp_classified",
+    "report"
+]
+
+MONTHLY_PARTITION = re.compile(r"^p(\d{4})(\d{2})$")
+
+
+def add_months(day, months):
+    """the first day of the month `months` after the month of `day`"""
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_starts(start, end):
+    """
+    Params
+    ------
+    start, end : datetime.date
+        the first and the last months to be included
+
+    Returns
+    -------
+    array of the first day of each month from `start` to `end`
+    """
+    months = []
+    current = add_months(start, 0)
+    while current <= end:
+        months.append(current)
+        current = add_months(current, 1)
+    return months
+
+
+def partition_name(month):
+    return "p{:%Y%m}".format(month)
+
+
+def month_partition(month):
+    """the partition holding the rows of the given month"""
+    return "PARTITION {name} VALUES LESS THAN (TO_DAYS('{upper}'))".format(
+        name=partition_name(month), upper=add_months(month, 1).isoformat())
+
+
+def partitioning_start():
+    """
+    The first month with its own partition, older rows are kept in `p0`,
+    it might be set through PARTITION_START (YYYY-MM)
+    """
+    value = ConfigHelper.shared().get_config("PARTITION_START") or "2018-01"
+    year, month = value.split("-")[:2]
+    return date(int(year), int(month), 1)
+
+
+def partition_clause(start=None, months_ahead=3, today=None):
+    """
+    Params
+    ------
+    start : datetime.date
+        the first month with its own partition
+    months_ahead : int
+        how many months after the current one are created in advance
+
+    Returns
+    -------
+    the `PARTITION BY` clause for a fact table
+    """
+    start = start or partitioning_start()
+    end = add_months(today or date.today(), months_ahead)
+    parts = ["PARTITION p0 VALUES LESS THAN (TO_DAYS('{}'))".format(
+        add_months(start, 0).isoformat())]
+    parts.extend(month_partition(m) for m in month_starts(start, end))
+    parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return "PARTITION BY RANGE (TO_DAYS(date)) (\n    {}\n)".format(
+        ",\n    ".join(parts))
+
+
+def roll_clause(partitions, months_ahead=3, today=None):
+    """
+    Params
+    ------
+    partitions : array_like
+        the names of the existing partitions
+    months_ahead : int
+        how many months after the current one must exist
+
+    Returns
+    -------
+    the `REORGANIZE PARTITION` clause splitting `pmax` into the missing
+    months, or None if nothing is missing
+    """
+    months = [date(int(m.group(1)), int(m.group(2)), 1) for m in
+              (MONTHLY_PARTITION.match(p or "") for p in partitions) if m]
+    end = add_months(today or date.today(), months_ahead)
+    start = add_months(max(months), 1) if months else partitioning_start()
+    missing = month_starts(start, end)
+    if not missing:
+        return None
+    parts = [month_partition(m) for m in missing]
+    parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return "REORGANIZE PARTITION pmax INTO (\n    {}\n)".format(
+        ",\n    ".join(parts))
+
+
+def existing_partitions(con, table):
+    rows = con.execute("""SELECT PARTITION_NAME
+                          FROM information_schema.PARTITIONS
+                          WHERE TABLE_SCHEMA = DATABASE()
+                          AND TABLE_NAME = '{table}'
+                          ORDER BY PARTITION_ORDINAL_POSITION
+                          """.format(table=table))
+    return [r[0] for r in rows if r[0]]
+
+
+def partition_table(con, table, months_ahead=3):
+    """
+    Partition an existing table, or roll its partitions forward so there
+    are always `months_ahead` empty months waiting for new data
+
+    Params
+    ------
+    con : sqlalchemy connection
+    table : string
+        one of `PARTITIONED_TABLES`
+    months_ahead : int
+        how many months after the current one must exist
+    """
+    partitions = existing_partitions(con, table)
+    if not partitions:
+        logger.info("Partitioning [{}] by month".format(table))
+        clause = partition_clause(months_ahead=months_ahead)
+    else:
+        clause = roll_clause(partitions, months_ahead=months_ahead)
+        if not clause:
+            logger.info("Partitions of [{}] are up to date".format(table))
+            return
+        logger.info("Rolling partitions of [{}] forward".format(table))
+    con.execute("ALTER TABLE {table} {clause}".format(table=table,
+                                                      clause=clause))
+
+
+def partition_tables(con, months_ahead=3):
+    """apply `partition_table` to all the fact tables"""
+    for table in PARTITIONED_TABLES:
+        partition_table(con, table, months_ahead=months_ahead)
+
+
+def partition_on_create(target, connection, **kw):
+    """
+    Listener for `after_create`, new fact tables are created partitioned
+    """
+    if connection.dialect.name != "mysql":
+        return
+    connection.execute("ALTER TABLE {table} {clause}".format(
+        table=target.name, clause=partition_clause()))
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Try a classification pattern before saving it. The distinct campaign and
+placement keys of the raw tables are kept in memory, so a candidate rule is
+evaluated against all of them in milliseconds, without touching the fact
+tables
+"""
+
+# python standard
+import re
+import time
+import logging
+import threading
+from collections import Counter
+
+# third-party imports
+from sqlalchemy import text
+
+############################################################################
+logger = logging.getLogger('dspreview_application')
+############################################################################
+
+# the fields a rule classifies, see workers.worker.Worker.find_by_patter
+FIELDS = ["brand", "sub_brand", "dsp"]
+
+# the keys of each raw table, DSP files have no placements
+SOURCES = {
+    "dcm": """SELECT campaign_id, campaign, placement_id, placement,
+                     MAX(id)
+              FROM dcm_raw WHERE id > :last
+              GROUP BY campaign_id, campaign, placement_id, placement""",
+    "dsp": """SELECT campaign_id, campaign, NULL, NULL, MAX(id)
+              FROM dsp_raw WHERE id > :last
+              GROUP BY campaign_id, campaign"""
+}
+
+KEY_NAMES = ["campaign_id", "campaign", "placement_id", "placement"]
+
+# the matched keys returned by a dry run
+SAMPLE_SIZE = 20
+
+
+def flags(rule):
+    """the `use_*` flags of a rule, they choose what is composed"""
+    return (bool(rule.use_campaign_id), bool(rule.use_campaign),
+            bool(rule.use_placement_id), bool(rule.use_placement))
+
+
+def compose(rule_flags, campaign_id, campaign, placement_id, placement):
+    """
+    Params
+    ------
+    rule_flags : tuple
+        the `flags` of a rule
+    campaign_id, campaign, placement_id, placement :
+        a key of the raw data, missing values might be None
+
+    Returns
+    -------
+    the text matched by the pattern of the rule
+    """
+    use_campaign_id, use_campaign, use_placement_id, use_placement = \
+        rule_flags
+    composed = ""
+    if use_campaign_id:
+        composed += str(campaign_id or 0)
+    if use_campaign:
+        composed += campaign or ""
+    if use_placement_id:
+        composed += str(placement_id or 0)
+    if use_placement:
+        composed += placement or ""
+    return composed
+
+
+class KeyIndex(object):
+    """
+    The distinct keys of `dcm_raw` and `dsp_raw`. Only the rows loaded since
+    the last refresh are read, so refreshing after each load is cheap. Keys
+    of rows deleted afterwards are kept, they still tell what a pattern
+    would match.
+
+    The keys are only appended, so the composed texts and the keys matched
+    by each rule are cached and extended with the new keys on demand
+    """
+
+    def __init__(self):
+        self.keys = {source: [] for source in SOURCES}
+        self.last_ids = {source: 0 for source in SOURCES}
+        self._seen = {source: set() for source in SOURCES}
+        # by source and rule flags, the composed text of each key
+        self._composed = {}
+        # by source, pattern and flags, the keys covered and those matched
+        self._matches = {}
+        self._lock = threading.RLock()
+
+    def refresh(self, con):
+        """
+        Read the keys of the rows added since the last refresh
+
+        Returns
+        -------
+        the number of new keys
+        """
+        added = 0
+        with self._lock:
+            for source, query in SOURCES.items():
+                rows = con.execute(text(query),
+                                   last=self.last_ids[source]).fetchall()
+                for row in rows:
+                    key = tuple(row[:4])
+                    self.last_ids[source] = max(self.last_ids[source],
+                                                row[4])
+                    if key not in self._seen[source]:
+                        self._seen[source].add(key)
+                        self.keys[source].append(key)
+                        added += 1
+        if added:
+            logger.info("Added [{}] keys to the pattern index".format(added))
+        return added
+
+    def composed(self, source, rule_flags):
+        """the composed text of each key of `source`, in the same order"""
+        with self._lock:
+            keys = self.keys[source]
+            texts = self._composed.setdefault((source, rule_flags), [])
+            texts.extend(compose(rule_flags, *key)
+                         for key in keys[len(texts):])
+            return texts
+
+    def matches(self, source, rule, cache=True):
+        """
+        Params
+        ------
+        source : string
+            one of `SOURCES`
+        rule : object
+            with the `pattern` and the `use_*` flags of a classification
+        cache : boolean
+            whether the result is kept for the next calls, the candidates of
+            the dry runs are not, they are tried once
+
+        Returns
+        -------
+        the set of positions of the keys of `source` matched by `rule`
+        """
+        rule_flags = flags(rule)
+        with self._lock:
+            texts = self.composed(source, rule_flags)
+            entry = [0, set()]
+            if cache:
+                entry = self._matches.setdefault(
+                    (source, rule.pattern, rule_flags), entry)
+            covered, matched = entry
+            if covered < len(texts):
+                regex = re.compile(rule.pattern, re.IGNORECASE)
+                matched.update(i for i in range(covered, len(texts))
+                               if regex.search(texts[i]))
+                entry[0] = len(texts)
+            return matched
+
+    def prune(self, rules):
+        """forget the matches of the patterns not used by `rules` anymore"""
+        used = {(r.pattern, flags(r)) for r in rules}
+        with self._lock:
+            for key in list(self._matches):
+                if key[1:] not in used:
+                    del self._matches[key]
+
+
+def dry_run(index, rules, candidate, sample_size=SAMPLE_SIZE):
+    """
+    Evaluate a candidate rule against every key of the `index`
+
+    Params
+    ------
+    index : KeyIndex
+    rules : array_like
+        the current classifications, in the order they are applied (by id)
+    candidate : object
+        with the attributes of a classification, its `id` is None for a new
+        rule, which is applied after all the others
+    sample_size : int
+        how many matched keys are returned
+
+    Returns
+    -------
+    A dictionary by source with the number of keys, the keys matched, a
+    sample of them, the rule currently winning them for each field the
+    candidate sets (its id, or None for unidentified), and how many of them
+    the candidate would win
+    """
+    begin = time.time()
+    # invalid patterns fail here, before anything is cached
+    re.compile(candidate.pattern, re.IGNORECASE)
+    ids = [r.id for r in rules]
+    position = ids.index(candidate.id) if candidate.id in ids else len(ids)
+    fields = [f for f in FIELDS if getattr(candidate, f)]
+    index.prune(rules)
+
+    result = {}
+    for source in SOURCES:
+        matched = sorted(index.matches(source, candidate, cache=False))
+        texts = index.composed(source, flags(candidate))
+        current, wins = {}, {}
+        for f in fields:
+            # the first rule matching a key wins it, so the earlier rules
+            # are written last
+            winners = {}
+            for rule in reversed(rules):
+                if getattr(rule, f):
+                    winners.update(dict.fromkeys(index.matches(source, rule),
+                                                 rule.id))
+            current[f] = Counter(winners.get(i) for i in matched)
+            earlier = set()
+            for rule in rules[:position]:
+                if getattr(rule, f):
+                    earlier |= index.matches(source, rule)
+            wins[f] = sum(1 for i in matched if i not in earlier)
+        result[source] = {
+            "keys": len(texts),
+            "matches": len(matched),
+            "sample": [dict(zip(KEY_NAMES, index.keys[source][i]),
+                            composed=texts[i])
+                       for i in matched[:sample_size]],
+            "current": {f: [{"rule": k, "keys": v}
+                            for k, v in current[f].most_common()]
+                        for f in fields},
+            "wins": wins
+        }
+    result["took_ms"] = (time.time() - begin) * 1000
+    return result
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Rebuild the classified and report tables into shadow tables, swapping them
+in at once, so the dashboard never reads empty or partial data
+"""
+
+# python standard
+import re
+import time
+import logging
+from contextlib import contextmanager
+
+# third-party imports
+from sqlalchemy import text
+
+# local imports
+from utils.config_helper import ConfigHelper
+from utils.rollup_helper import refresh_rollups
+from utils.meta_helper import bump_report_version
+from utils.unclassified_helper import refresh_unclassified
+from webapp.app.queries import (GENERATE_CLASSIFIED, GENERATE_REPORT,
+                                CLEAN_DIRTY_DATES, statements)
+
+############################################################################
+logger = logging.getLogger('dspreview_application')
+############################################################################
+
+# the tables rebuilt from the raw data, in the order they are generated
+REBUILT_TABLES = ["dcm_classified", "dsp_classified", "report"]
+
+# the MySQL named lock held while the `REBUILT_TABLES` are rebuilt or
+# written, and the seconds it is waited for (REBUILD_LOCK_TIMEOUT)
+REBUILD_LOCK = "dspreview_rebuild"
+REBUILD_LOCK_TIMEOUT = 3600
+
+
+def shadow_name(table):
+    return "{}_shadow".format(table)
+
+
+def old_name(table):
+    return "{}_old".format(table)
+
+
+def on_shadows(script, tables=None):
+    """
+    Params
+    ------
+    script : string
+        sql statements writing and reading `tables`
+    tables : array_like
+        the table names to be replaced, the default is `REBUILT_TABLES`
+
+    Returns
+    -------
+    the same script, using the shadow of each table instead
+    """
+    for table in tables or REBUILT_TABLES:
+        # \b does not match before `_`, so `dcm_classified_stage` is kept
+        script = re.sub(r"\b{}\b".format(table), shadow_name(table), script)
+    return script
+
+
+def swap_clause(tables=None):
+    """
+    Returns
+    -------
+    a single `RENAME TABLE` moving every table out and its shadow in, MySQL
+    applies it atomically
+    """
+    renames = []
+    for table in tables or REBUILT_TABLES:
+        renames.append("{} TO {}".format(table, old_name(table)))
+        renames.append("{} TO {}".format(shadow_name(table), table))
+    return "RENAME TABLE {}".format(", ".join(renames))
+
+
+@contextmanager
+def rebuild_lock(con):
+    """
+    Hold the rebuild lock in the session of `con`. A rebuild holds it from
+    start to end, and the workers hold it while they write the classified
+    and report tables, so their rows are never written into tables about
+    to be swapped out (they would be lost at the `RENAME TABLE`). Only
+    MySQL has named locks, other databases are not locked
+
+    Raises
+    ------
+    Exception if the lock is not acquired in REBUILD_LOCK_TIMEOUT seconds
+    """
+    if con.dialect.name != "mysql":
+        yield
+        return
+    timeout = ConfigHelper.shared().get_int("REBUILD_LOCK_TIMEOUT",
+                                            REBUILD_LOCK_TIMEOUT)
+    logger.info("Waiting for the lock [{}]".format(REBUILD_LOCK))
+    acquired = con.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                           name=REBUILD_LOCK, timeout=timeout).scalar()
+    if not acquired:
+        raise Exception("Timed out waiting for the lock [{}]".format(
+            REBUILD_LOCK))
+    try:
+        yield
+    finally:
+        con.execute(text("SELECT RELEASE_LOCK(:name)"), name=REBUILD_LOCK)
+
+
+def rebuild_tables(con, progress=None):
+    """
+    Generate the classified and report tables again from the raw tables.
+    They are written into empty shadow copies (same indexes and partitions)
+    while the current ones keep being read, and swapped in at the end. The
+    `rebuild_lock` is held meanwhile, so no other rebuild runs at the same
+    time and the workers wait to write the classified tables
+
+    Params
+    ------
+    con : sqlalchemy connection
+        not inside a transaction, DDL statements commit implicitly
+    progress : callable
+        if given, it is called with the name of each stage as it starts
+        ('shadows', 'classified', 'report', 'swap', 'rollups',
+        'unclassified') and the rows
+        generated so far
+
+    Returns
+    -------
+    A dictionary with the duration in seconds and the rows of each table,
+    it is also recorded in `rebuilds`
+    """
+    with rebuild_lock(con):
+        return _rebuild_tables(con, progress)
+
+
+def _rebuild_tables(con, progress):
+    rows = {}
+
+    def stage(name):
+        if progress is not None:
+            progress(name, sum(rows.values()))
+
+    def count(tables):
+        for table in tables:
+            rows[table] = con.execute("SELECT COUNT(*) FROM {}".format(
+                shadow_name(table))).scalar()
+            logger.info("Generated [{}] rows for [{}]".format(rows[table],
+                                                             table))
+
+    started = con.execute("SELECT CURRENT_TIMESTAMP()").scalar()
+    begin = time.time()
+    stage("shadows")
+    for table in REBUILT_TABLES:
+        con.execute("DROP TABLE IF EXISTS {}, {}".format(
+            shadow_name(table), old_name(table)))
+        con.execute("CREATE TABLE {} LIKE {}".format(shadow_name(table),
+                                                     table))
+
+    stage("classified")
+    logger.info("Generating classified shadow tables")
+    for statement in statements(on_shadows(GENERATE_CLASSIFIED)):
+        con.execute(text(statement))
+    count(REBUILT_TABLES[:-1])
+    stage("report")
+    logger.info("Generating report shadow table")
+    for statement in statements(on_shadows(GENERATE_REPORT)):
+        con.execute(text(statement))
+    count(REBUILT_TABLES[-1:])
+
+    stage("swap")
+    logger.info("Swapping shadow tables")
+    con.execute(swap_clause())
+    for table in REBUILT_TABLES:
+        con.execute("DROP TABLE {}".format(old_name(table)))
+    # the dates marked in the meantime are kept for the next report
+    con.execute(text(CLEAN_DIRTY_DATES), started=started)
+    stage("rollups")
+    refresh_rollups(con)
+    stage("unclassified")
+    refresh_unclassified(con)
+    duration = time.time() - begin
+    bump_report_version(con, mode="rebuild", duration=duration,
+                        rows=rows["report"])
+    logger.info("Rebuild finished in [{:.2f}s]".format(duration))
+    con.execute(text("""INSERT INTO rebuilds (started_at, duration, dcm_rows,
+                                              dsp_rows, report_rows)
+                        VALUES (:started, :duration, :dcm, :dsp, :report)"""),
+                started=started, duration=duration,
+                dcm=rows["dcm_classified"], dsp=rows["dsp_classified"],
+                report=rows["report"])
+    return {"duration": duration, "rows": rows}
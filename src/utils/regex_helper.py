@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Keep a single slow classification pattern from stalling the workers and the
+reset. Patterns are vetted when they are saved or imported: nested
+quantifiers and repeated alternatives that overlap are refused, and the
+others are timed against sample keys in a child process, which is killed
+when it runs out of time. While classifying, the time of every match is
+added to its rule, and a rule going over the budget again and again is
+quarantined from the next run on
+"""
+
+# python standard
+import re
+import time
+import logging
+import threading
+import multiprocessing
+from collections import Counter
+
+# third-party imports
+from sqlalchemy import text
+
+# local imports
+from utils.config_helper import ConfigHelper
+from utils.pattern_helper import SOURCES, flags
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # python < 3.11
+    import sre_parse
+    import sre_constants
+
+############################################################################
+logger = logging.getLogger('dspreview_application')
+############################################################################
+
+REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+           getattr(sre_constants, "POSSESSIVE_REPEAT", None)} - {None}
+
+# the first characters of a part of a pattern are a set of lowercase
+# characters, with these for any character and for the empty string
+ANY_CHARACTER, EMPTY = "any", "empty"
+
+# the largest character range taken one character at a time
+MAX_RANGE = 256
+
+# the milliseconds a pattern might take on all its sample keys when vetted
+PATTERN_BUDGET_MS = 200
+
+# the milliseconds a single match might take while classifying, and how
+# many matches over it quarantine the rule
+MATCH_BUDGET_MS = 50
+QUARANTINE_OVERRUNS = 3
+
+# the keys of each source a pattern is timed against, and how many of the
+# longest ones are also repeated, the worst case for backtracking
+VET_SAMPLE_SIZE = 2000
+VET_LONG_SAMPLES = 20
+SYNTHETIC_SAMPLES = ["a" * 64 + "!", "0" * 64 + "!", "a_" * 32 + "!"]
+
+# the time a child process is given to start, besides the budget
+STARTUP_SECONDS = 1.0
+
+
+def budget_ms(name, default):
+    return ConfigHelper.shared().get_int(name, default)
+
+
+def _children(av):
+    """the subpatterns inside the arguments of a parsed item"""
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (tuple, list)):
+        for item in av:
+            for child in _children(item):
+                yield child
+
+
+def _nested(subpattern, repeated):
+    for op, av in subpattern:
+        if op in REPEATS:
+            low, high, item = av
+            # fixed counts like {3} do not backtrack
+            varies = high > 1 and high != low
+            if varies and repeated:
+                return True
+            if _nested(item, repeated or varies):
+                return True
+        elif any(_nested(child, repeated) for child in _children(av)):
+            return True
+    return False
+
+
+def nested_quantifiers(pattern):
+    """
+    Whether a repeated part of `pattern` repeats something itself, like
+    `(a+)+` or `(x|.*y)*`, the usual cause of catastrophic backtracking
+    """
+    return _nested(sre_parse.parse(pattern, re.IGNORECASE), False)
+
+
+def _first(subpattern):
+    """the characters a match of `subpattern` might start with"""
+    for op, av in subpattern:
+        if op in (sre_constants.AT, sre_constants.ASSERT,
+                  sre_constants.ASSERT_NOT):
+            continue
+        if op == sre_constants.LITERAL:
+            return {chr(av).lower()}
+        if op == sre_constants.IN:
+            first = set()
+            for item_op, item_av in av:
+                if item_op == sre_constants.LITERAL:
+                    first.add(chr(item_av).lower())
+                elif (item_op == sre_constants.RANGE and
+                      item_av[1] - item_av[0] < MAX_RANGE):
+                    first.update(chr(c).lower()
+                                 for c in range(item_av[0], item_av[1] + 1))
+                else:
+                    return {ANY_CHARACTER}
+            return first
+        if op == sre_constants.SUBPATTERN:
+            first = _first(av[-1])
+            if first == {EMPTY}:
+                continue
+            return first
+        if op == sre_constants.BRANCH:
+            return set().union(*[_first(b) for b in av[1]])
+        if op in REPEATS and av[0] > 0:
+            return _first(av[2])
+        # optional repeats, any character, back references...
+        return {ANY_CHARACTER}
+    return {EMPTY}
+
+
+def _overlap(first, second):
+    if EMPTY in first and EMPTY in second:
+        return True
+    first, second = first - {EMPTY}, second - {EMPTY}
+    if not (first and second):
+        return False
+    return ANY_CHARACTER in first | second or bool(first & second)
+
+
+def _ambiguous(subpattern, repeated):
+    for op, av in subpattern:
+        if op in REPEATS:
+            low, high, item = av
+            if _ambiguous(item, repeated or (high > 1 and high != low)):
+                return True
+        elif op == sre_constants.BRANCH and repeated and any(
+                _overlap(_first(a), _first(b))
+                for i, a in enumerate(av[1]) for b in av[1][i + 1:]):
+            return True
+        elif any(_ambiguous(child, repeated) for child in _children(av)):
+            return True
+    return False
+
+
+def overlapping_alternatives(pattern):
+    """
+    Whether a repeated part of `pattern` has alternatives that might start
+    the same way, like `(a|a)*` or `(ab|\\w)+`, so each repetition can be
+    matched in more than one way
+    """
+    return _ambiguous(sre_parse.parse(pattern, re.IGNORECASE), False)
+
+
+def check_pattern(pattern):
+    """
+    The checks that do not run the pattern
+
+    Returns
+    -------
+    a list of problems, empty if there is none
+    """
+    try:
+        re.compile(pattern, re.IGNORECASE)
+    except re.error as err:
+        return ["invalid pattern, {}".format(err)]
+    if nested_quantifiers(pattern):
+        return ["the pattern has nested quantifiers"]
+    if overlapping_alternatives(pattern):
+        return ["the pattern repeats alternatives that overlap"]
+    return []
+
+
+def sample_keys(index, rule, size=VET_SAMPLE_SIZE, longest=VET_LONG_SAMPLES):
+    """
+    Params
+    ------
+    index : utils.pattern_helper.KeyIndex
+        if None, only synthetic samples are returned
+    rule : object
+        with the `pattern` and the `use_*` flags of a classification
+
+    Returns
+    -------
+    the texts the pattern of `rule` is timed against: keys of the raw data
+    composed by its flags, the longest of them repeated, and some synthetic
+    ones
+    """
+    samples = list(SYNTHETIC_SAMPLES)
+    if index is None:
+        return samples
+    texts = []
+    for source in SOURCES:
+        composed = index.composed(source, flags(rule))
+        step = max(len(composed) // size, 1)
+        texts.extend(composed[::step][:size])
+    samples.extend(texts)
+    samples.extend(t * 4 + "!" for t in sorted(texts, key=len)[-longest:])
+    return samples
+
+
+def time_pattern(pattern, samples):
+    """the seconds `pattern` takes on the `samples`, its compilation aside"""
+    regex = re.compile(pattern, re.IGNORECASE)
+    begin = time.perf_counter()
+    for sample in samples:
+        regex.search(sample)
+    return time.perf_counter() - begin
+
+
+def _time_patterns(items, connection):
+    """run in a child process, send the seconds each pattern takes"""
+    for pattern, samples in items:
+        connection.send(time_pattern(pattern, samples))
+    connection.close()
+
+
+def time_patterns(items, budget):
+    """
+    Time each pattern on its samples, in a child process, so a pattern that
+    never ends can be stopped
+
+    Params
+    ------
+    items : array_like
+        pairs of pattern and samples
+    budget : float
+        the seconds each pattern is waited for
+
+    Returns
+    -------
+    the seconds each pattern took, None for those stopped
+    """
+    items = list(items)
+    timings = [None] * len(items)
+    start = 0
+    while start < len(items):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_time_patterns,
+                                          args=(items[start:], sender),
+                                          daemon=True)
+        process.start()
+        sender.close()
+        position, wait = start, budget + STARTUP_SECONDS
+        try:
+            while position < len(items) and receiver.poll(wait):
+                timings[position] = receiver.recv()
+                position, wait = position + 1, budget
+        except EOFError:
+            pass
+        process.terminate()
+        process.join()
+        receiver.close()
+        # the pattern after the last one timed is the slow one
+        start = position + 1
+    return timings
+
+
+def vet_rules(rules, index=None, budget=None):
+    """
+    Params
+    ------
+    rules : array_like
+        objects with the `pattern` and the `use_*` flags of a classification
+    index : utils.pattern_helper.KeyIndex
+        the keys the patterns are timed against, only synthetic samples are
+        used without it
+    budget : int
+        the milliseconds each pattern might take on its samples, it is
+        PATTERN_BUDGET_MS by default
+
+    Returns
+    -------
+    for each rule, a list of problems, empty if it might be saved
+    """
+    budget = budget or budget_ms("PATTERN_BUDGET_MS", PATTERN_BUDGET_MS)
+    problems = [check_pattern(r.pattern) for r in rules]
+    timed = [(i, sample_keys(index, r)) for i, r in enumerate(rules)
+             if not problems[i]]
+    timings = time_patterns([(rules[i].pattern, s) for i, s in timed],
+                            budget / 1000.0)
+    for (i, samples), seconds in zip(timed, timings):
+        if seconds is None:
+            problems[i].append("the pattern did not finish in {} ms on {} "
+                               "sample keys".format(budget, len(samples)))
+        elif seconds * 1000 > budget:
+            problems[i].append("the pattern took {:.0f} ms on {} sample "
+                               "keys, the budget is {} ms".format(
+                                   seconds * 1000, len(samples), budget))
+    return problems
+
+
+class RuleStats(object):
+    """
+    The time spent matching each rule while classifying. A rule whose
+    matches take longer than the budget `overruns` times is flagged. It
+    still runs until the end of the run, so all the files of a run are
+    classified by the same rules, and it is quarantined when saved: the
+    next snapshots and the reset leave it out, until it is released
+    """
+
+    def __init__(self, budget=None, overruns=None):
+        """
+        Params
+        ------
+        budget : int
+            the milliseconds a single match might take, it is
+            MATCH_BUDGET_MS by default
+        overruns : int
+            the matches over the budget that flag a rule, it is
+            QUARANTINE_OVERRUNS by default, so a single pause of the process
+            (the garbage collector, a busy host) does not flag it
+        """
+        self.budget = (budget or budget_ms("MATCH_BUDGET_MS",
+                                           MATCH_BUDGET_MS)) / 1000.0
+        self.overruns = overruns or ConfigHelper.shared().get_int(
+            "QUARANTINE_OVERRUNS", QUARANTINE_OVERRUNS)
+        self.calls = Counter()
+        self.seconds = Counter()
+        self.slow = Counter()
+        self.flagged = set()
+        self._lock = threading.Lock()
+
+    def record(self, rule, seconds):
+        """add a match of `rule` that took `seconds`"""
+        self.calls[rule.id] += 1
+        self.seconds[rule.id] += seconds
+        if seconds > self.budget:
+            self.slow[rule.id] += 1
+            if self.slow[rule.id] == self.overruns:
+                logger.warning("Flagging classification [{}] [{}], [{}] "
+                               "matches took over [{:.0f}] ms".format(
+                                   rule.id, rule.pattern, self.overruns,
+                                   self.budget * 1000))
+                self.flagged.add(rule.id)
+
+    def save(self, con):
+        """
+        Add the recorded calls and time to `classifications`, and quarantine
+        the flagged rules. The counters start again from zero
+        """
+        with self._lock:
+            calls, self.calls = self.calls, Counter()
+            seconds, self.seconds = self.seconds, Counter()
+            flagged, self.flagged = self.flagged, set()
+        if calls:
+            con.execute(text("""UPDATE classifications
+                                SET match_calls = match_calls + :calls,
+                                    match_seconds = match_seconds + :seconds
+                                WHERE id = :id"""),
+                        [{"id": k, "calls": v, "seconds": seconds[k]}
+                         for k, v in calls.items()])
+        if flagged:
+            logger.warning("Quarantining classifications [{}]".format(
+                ", ".join(str(k) for k in sorted(flagged))))
+            con.execute(text("""UPDATE classifications SET quarantined = 1
+                                WHERE id = :id"""),
+                        [{"id": k} for k in flagged])
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+Rollups of the report by week and month, and by brand only, so the usual
+totals are read from a few rows instead of every daily report row
+"""
+
+# python standard
+import logging
+
+# third-party imports
+import pandas as pd
+from sqlalchemy import text
+
+############################################################################
+logger = logging.getLogger('dspreview_application')
+############################################################################
+
+PERIODS = ["day", "week", "month"]
+LEVELS = ["campaign", "brand"]
+
+# the campaign level by day is the report itself
+ROLLUPS = [
+    ("week", "campaign"),
+    ("month", "campaign"),
+    ("day", "brand"),
+    ("week", "brand"),
+    ("month", "brand")
+]
+
+KEYS = ["brand_key", "ad_campaign_key", "dsp_campaign_key"]
+LABELS = ["brand", "sub_brand", "dsp", "ad_campaign_id", "ad_campaign",
+          "dsp_campaign_id", "dsp_campaign"]
+AD_METRICS = ["ad_impressions", "ad_clicks", "ad_reach"]
+DSP_METRICS = ["dsp_impressions", "dsp_clicks", "dsp_cost"]
+COLUMNS = ["date"] + KEYS + LABELS + AD_METRICS + DSP_METRICS
+
+# the dimensions a report aggregate might be grouped by, a campaign is the
+# pair of DCM and DSP campaigns of the report rows
+DIMENSIONS = {
+    "brand": ["brand"],
+    "sub_brand": ["sub_brand"],
+    "dsp": ["dsp"],
+    "campaign": ["ad_campaign_id", "ad_campaign", "dsp_campaign_id",
+                 "dsp_campaign"]
+}
+
+# which rollups might answer a query grouped by each bucket, coarsest first
+CANDIDATES = {
+    "total": ["month", "week", "day"],
+    "month": ["month", "day"],
+    "week": ["week", "day"],
+    "day": ["day"]
+}
+
+
+def period_start(dates, period):
+    """
+    Params
+    ------
+    dates : pandas.Series
+        datetime values
+    period : string
+        one of `PERIODS`
+
+    Returns
+    -------
+    the first day of the period of each date, weeks start on monday
+    """
+    days = dates.dt.normalize()
+    if period == "week":
+        return days - pd.to_timedelta(days.dt.weekday, unit="D")
+    if period == "month":
+        return days - pd.to_timedelta(days.dt.day - 1, unit="D")
+    return days
+
+
+def period_end(starts, period):
+    """the first day after each period starting at `starts`"""
+    if period == "week":
+        return starts + pd.Timedelta(days=7)
+    if period == "month":
+        return starts + pd.offsets.MonthBegin(1)
+    return starts + pd.Timedelta(days=1)
+
+
+def rollup(report, period, level):
+    """
+    Params
+    ------
+    report : pandas.DataFrame
+        daily report rows, with the `COLUMNS`
+    period : string
+        one of `PERIODS`
+    level : string
+        'campaign' keeps the report dimensions, 'brand' keeps only the brand,
+        sub brand, and dsp
+
+    Returns
+    -------
+    A pandas.DataFrame with the `COLUMNS`, the date is the period start
+    """
+    df = report.assign(date=period_start(report.date, period))
+    if level == "campaign":
+        return df.groupby(["date"] + KEYS + LABELS, as_index=False)[
+            AD_METRICS + DSP_METRICS].sum()[COLUMNS]
+
+    # the report repeats the DCM metrics of a campaign for every DSP
+    # campaign of the brand (and vice versa), so each one is counted once
+    brand = ["date", "brand_key", "brand", "sub_brand", "dsp"]
+    ad = df[~report.duplicated(["date", "brand_key", "ad_campaign_key"])]
+    ad = ad.groupby(brand, as_index=False)[AD_METRICS].sum()
+    dsp = df[(report.dsp_campaign_key != 0) &
+             ~report.duplicated(["date", "brand_key", "dsp_campaign_key"])]
+    dsp = dsp.groupby(["date", "brand_key"], as_index=False)[
+        DSP_METRICS].sum()
+    df = ad.merge(dsp, how="left", on=["date", "brand_key"]).fillna(
+        {c: 0 for c in DSP_METRICS})
+    return df.assign(ad_campaign_key=0, dsp_campaign_key=0,
+                     ad_campaign_id=0, ad_campaign="",
+                     dsp_campaign_id=0, dsp_campaign="")[COLUMNS]
+
+
+def read_report(con, start=None, end=None):
+    """the report rows from `start` (inclusive) to `end` (exclusive)"""
+    query = "SELECT {} FROM report".format(", ".join(COLUMNS))
+    params = {}
+    if start is not None:
+        query += " WHERE date >= :start AND date < :end"
+        params = {"start": start.to_pydatetime(), "end": end.to_pydatetime()}
+    return pd.read_sql(text(query), con, params=params, parse_dates=["date"])
+
+
+def refresh_rollups(con, dates=None):
+    """
+    Generate the rollups of the periods containing `dates` again, from the
+    report rows of those periods
+
+    Params
+    ------
+    con : sqlalchemy connection
+    dates : array_like
+        the report dates that were generated, if None, all the rollups are
+        generated again
+    """
+    if dates is None:
+        logger.info("Generating all the rollups")
+        report = read_report(con)
+        periods = None
+    else:
+        dates = pd.Series(pd.to_datetime(list(dates)))
+        if dates.empty:
+            return
+        # the first and the last period of each kind containing the dates,
+        # the report is read for all of them, so the ones in between are
+        # generated again as well
+        periods = {p: (period_start(dates, p).min(),
+                       period_start(dates, p).max()) for p in PERIODS}
+        start = min(periods["week"][0], periods["month"][0])
+        end = max(period_end(periods["week"][1], "week"),
+                  period_end(periods["month"][1], "month"))
+        logger.info("Generating the rollups from [{}] to [{}]".format(
+            start.date(), end.date()))
+        report = read_report(con, start, end)
+
+    frames = []
+    for period, level in ROLLUPS:
+        df = rollup(report, period, level)
+        if periods is not None:
+            first, last = periods[period]
+            df = df[(df.date >= first) & (df.date <= last)]
+        frames.append(df.assign(period=period, level=level))
+    df = pd.concat(frames, ignore_index=True)
+
+    df.to_sql(con=con, name="report_rollups_temp", if_exists='replace',
+              index=False)
+    all_columns = ",".join(["period", "level"] + COLUMNS)
+    with con.begin():
+        if periods is None:
+            con.execute("DELETE FROM report_rollups")
+        else:
+            delete = text("""DELETE FROM report_rollups
+                             WHERE period = :period
+                             AND date >= :first AND date < :end""")
+            for period, (first, last) in periods.items():
+                con.execute(delete, period=period,
+                            first=first.to_pydatetime(),
+                            end=period_end(last, period).to_pydatetime())
+        con.execute("""INSERT INTO report_rollups ({all_cols})
+                       SELECT {all_cols} FROM report_rollups_temp
+                       """.format(all_cols=all_columns))
+    con.execute("DROP TABLE report_rollups_temp")
+    logger.info("Generated [{}] rollup rows".format(len(df)))
+
+
+def aligned(start, end, period):
+    """whether the dates from `start` to `end` (inclusive) are whole periods"""
+    bounds = pd.Series([start, end + pd.Timedelta(days=1)])
+    return (period_start(bounds, period) == bounds).all()
+
+
+def choose_period(start, end, bucket):
+    """
+    Params
+    ------
+    start, end : pandas.Timestamp
+        the first and the last dates of the query
+    bucket : string
+        'day', 'week', 'month', or 'total'
+
+    Returns
+    -------
+    the coarsest period whose rollup answers the query exactly
+    """
+    for period in CANDIDATES[bucket]:
+        if aligned(start, end, period):
+            return period
+    return "day"
+
+
+def query_rollup(con, start, end, level="brand", bucket="total"):
+    """
+    Sum the report from `start` to `end` (inclusive) by `bucket`, reading
+    the coarsest rollup that answers it
+
+    Params
+    ------
+    con : sqlalchemy connection
+    start, end : datetime
+        the first and the last dates
+    level : string
+        one of `LEVELS`
+    bucket : string
+        'day', 'week', 'month', or 'total'
+
+    Returns
+    -------
+    the period read and a pandas.DataFrame with the `COLUMNS`, its date is
+    the bucket start (or `start` for totals)
+    """
+    if level not in LEVELS or bucket not in CANDIDATES:
+        raise Exception("Unknown level [{}] or bucket [{}]".format(level,
+                                                                   bucket))
+    start = pd.Timestamp(start).normalize()
+    end = pd.Timestamp(end).normalize()
+    period = choose_period(start, end, bucket)
+    params = {"start": start.to_pydatetime(),
+              "end": (end + pd.Timedelta(days=1)).to_pydatetime()}
+    if period == "day" and level == "campaign":
+        df = read_report(con, start, end + pd.Timedelta(days=1))
+    else:
+        query = """SELECT {} FROM report_rollups
+                   WHERE period = :period AND level = :level
+                   AND date >= :start AND date < :end""".format(
+            ", ".join(COLUMNS))
+        df = pd.read_sql(text(query), con, parse_dates=["date"],
+                         params=dict(params, period=period, level=level))
+
+    if bucket == "total":
+        df = df.assign(date=start)
+    elif bucket != period:
+        df = df.assign(date=period_start(df.date, bucket))
+    df = df.groupby(["date"] + KEYS + LABELS, as_index=False)[
+        AD_METRICS + DSP_METRICS].sum()
+    return period, df[COLUMNS]
+
+
+def aggregate(con, start, end, dimensions=(), bucket="total", metrics=None):
+    """
+    Sum the `metrics` from `start` to `end` (inclusive) grouped by the
+    `dimensions` and by `bucket`, the grouping runs in the database against
+    the coarsest rollup that answers it (the brand level unless grouped by
+    campaign)
+
+    Params
+    ------
+    con : sqlalchemy connection
+    start, end : datetime
+        the first and the last dates
+    dimensions : array_like
+        keys of `DIMENSIONS`
+    bucket : string
+        'day', 'week', 'month', or 'total'
+    metrics : array_like
+        some of the ad and dsp metrics, all of them if None
+
+    Returns
+    -------
+    the period read and a pandas.DataFrame with the date (the bucket start, or
+    `start` for totals), the columns of the dimensions, and the metrics
+    """
+    metrics = list(metrics or AD_METRICS + DSP_METRICS)
+    unknown = [d for d in dimensions if d not in DIMENSIONS] + \
+        [m for m in metrics if m not in AD_METRICS + DSP_METRICS]
+    if unknown or bucket not in CANDIDATES:
+        raise Exception("Unknown dimensions or metrics {} or bucket "
+                        "[{}]".format(unknown, bucket))
+    columns = []
+    for d in dimensions:
+        columns += [c for c in DIMENSIONS[d] if c not in columns]
+    level = "campaign" if "campaign" in dimensions else "brand"
+
+    start = pd.Timestamp(start).normalize()
+    end = pd.Timestamp(end).normalize()
+    period = choose_period(start, end, bucket)
+    params = {"start": start.to_pydatetime(),
+              "end": (end + pd.Timedelta(days=1)).to_pydatetime(),
+              "period": period, "level": level}
+    if period == "day" and level == "campaign":
+        table, where = "report", ""
+    else:
+        table = "report_rollups"
+        where = "period = :period AND level = :level AND "
+    group = ([] if bucket == "total" else ["date"]) + columns
+    query = "SELECT {} FROM {} WHERE {}date >= :start AND date < :end".format(
+        ", ".join(group + ["SUM({0}) AS {0}".format(m) for m in metrics]),
+        table, where)
+    if group:
+        query += " GROUP BY " + ", ".join(group)
+    df = pd.read_sql(text(query), con, params=params,
+                     parse_dates=["date"] if "date" in group else None)
+    df = df.fillna({m: 0 for m in metrics})
+
+    if bucket == "total":
+        df.insert(0, "date", start)
+    elif bucket != period:
+        # the range is not made of whole buckets, the partial ones at the
+        # edges are summed from the days
+        df = df.assign(date=period_start(df.date, bucket)).groupby(
+            group, as_index=False)[metrics].sum()
+    return period, df.sort_values(["date"] + columns).reset_index(
+        drop=True)[["date"] + columns + metrics]
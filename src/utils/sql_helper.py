@@ -32,27 +32,11 @@ def rand_word(N):
 
 
 def get_connection_info():
-    ci = namedtuple("ConnectionInfo",
-                    "dbhost, dbport, dbuser, dbpass, dbname")
-    config = ConfigHelper()
-    ci.dbhost = config.get_config("DB_HOST")
-    ci.dbport = config.get_config("DB_PORT")
-    ci.dbuser = config.get_config("DB_USER")
-    ci.dbpass = config.get_config("DB_PASS")
-    ci.dbname = config.get_config("DB_NAME")
-    return ci
+    return ConfigHelper.shared().database()
 
 
 def get_connection_info_test():
-    ci = namedtuple("ConnectionInfoTest",
-                    "dbhost, dbport, dbuser, dbpass, dbname")
-    config = ConfigHelper()
-    ci.dbhost = config.get_config("DB_HOST")
-    ci.dbport = config.get_config("DB_PORT")
-    ci.dbname = config.get_config("DB_TEST_NAME")
-    ci.dbuser = config.get_config("DB_TEST_USER")
-    ci.dbpass = config.get_config("DB_TEST_PASS")
-    return ci
+    return ConfigHelper.shared().database(test=True)
 
 
 def get_connection_strs():
@@ -147,11 +131,109 @@ def initialize_database():
             SQLALCHEMY_DATABASE_URI=flask_str
         )
         with app.app_context():
+            # tables created by older versions are brought up to date
+            migrate_tables(db.engine.connect())
             db.create_all()
+
+            # tables that already existed are partitioned here
+            logger.info("Partitioning tables")
+            from utils.partition_helper import partition_tables
+            partition_tables(db.engine.connect())
     except Exception as err:
         logger.exception(err)
 
 
+def table_columns(con, table):
+    """the columns of `table`, or an empty list if it does not exist"""
+    if not con.execute("SHOW TABLES LIKE '{}'".format(table)).fetchall():
+        return []
+    return [r[0] for r in con.execute("SHOW COLUMNS FROM {}".format(table))]
+
+
+def migrate_tables(con):
+    """
+    Bring the fact tables created by older versions up to date. The raw
+    tables are migrated in place and their `row_key` is backfilled. The
+    classified and report tables only hold derived data, so they are
+    dropped and must be rebuilt through a classification reset. The
+    classified tables get the index of the unclassified keys, and the
+    classifications their match statistics. The row keys hashed by older
+    versions are updated, see `rekey_tables`.
+
+    Params
+    ------
+    con : sqlalchemy connection
+    """
+    from webapp.app.queries import ROW_KEYS, row_key
+
+    for table in ["dcm_classified", "dsp_classified", "report"]:
+        columns = table_columns(con, table)
+        if columns and not all(c in columns for c in ROW_KEYS[table]):
+            logger.info("Dropping [{}], it must be rebuilt".format(table))
+            con.execute("DROP TABLE {}".format(table))
+
+    for table in ["dcm_raw", "dsp_raw"]:
+        columns = table_columns(con, table)
+        if not columns or "row_key" in columns:
+            continue
+        logger.info("Migrating [{}]".format(table))
+        changes = ["DROP PRIMARY KEY", "ADD PRIMARY KEY (id, date)"]
+        if table == "dsp_raw" and "source" not in columns:
+            changes.extend([
+                "ADD COLUMN source VARCHAR(25) NOT NULL DEFAULT ''",
+                "ADD INDEX dsp_raw_source_index (source, date)"])
+        changes.append("ADD COLUMN row_key BINARY(16) NULL")
+        con.execute("ALTER TABLE {} {}".format(table, ", ".join(changes)))
+
+        logger.info("Backfilling [{}] row keys".format(table))
+        con.execute("UPDATE {table} SET row_key = {row_key}".format(
+            table=table, row_key=row_key(ROW_KEYS[table])))
+        con.execute("""ALTER TABLE {table}
+                       MODIFY row_key BINARY(16) NOT NULL,
+                       DROP INDEX {table}_index,
+                       ADD UNIQUE INDEX {table}_index (row_key, date)
+                       """.format(table=table))
+
+    rekey_tables(con)
+
+    for table in ["dcm_classified", "dsp_classified"]:
+        index = "{}_brand_index".format(table)
+        if table_columns(con, table) and not con.execute(
+                "SHOW INDEX FROM {} WHERE Key_name = '{}'".format(
+                    table, index)).fetchall():
+            logger.info("Indexing [{}] by brand".format(table))
+            con.execute("ALTER TABLE {} ADD INDEX {} (brand_key, "
+                        "campaign_key)".format(table, index))
+
+    columns = table_columns(con, "classifications")
+    if columns and "quarantined" not in columns:
+        logger.info("Migrating [classifications]")
+        con.execute("""ALTER TABLE classifications
+                       ADD COLUMN match_calls BIGINT NOT NULL DEFAULT 0,
+                       ADD COLUMN match_seconds FLOAT NOT NULL DEFAULT 0,
+                       ADD COLUMN quarantined BOOL NOT NULL DEFAULT 0""")
+
+
+def rekey_tables(con):
+    """
+    Hash again the `row_key` of the rows keyed by an older `ROW_KEYS` or
+    `row_key` (like keys that were case sensitive). Rows
+    that become repeated under the new keys are removed, one of each is
+    kept, as the unique index would have done
+    """
+    from webapp.app.queries import ROW_KEYS, row_key
+
+    for table in ["dcm_raw", "dsp_raw", "dsp_classified"]:
+        if not table_columns(con, table):
+            continue
+        logger.info("Updating the row keys of [{}]".format(table))
+        key = row_key(ROW_KEYS[table])
+        con.execute("""UPDATE IGNORE {table} SET row_key = {key}
+                       WHERE row_key <> {key}""".format(table=table, key=key))
+        con.execute("DELETE FROM {table} WHERE row_key <> {key}".format(
+            table=table, key=key))
+
+
 def get_context():
     """
     This context is necessary for using the flask models outside the app
@@ -170,10 +252,19 @@ def get_context():
     return app.app_context()
 
 
-def get_connection():
+def get_connection(pool_size=None):
     """
-    Create a connection to the MySQL database
+    Create a connection to the MySQL database, with an engine of its own,
+    call `con.engine.dispose()` when it is not needed anymore
+
+    Params
+    ------
+    pool_size : int
+        the connections kept by the engine, for those who open more of them
+        at the same time. If None, the SQLAlchemy default
     """
     con_str = get_connection_strs().con_str
     logger.info("Creating sql connection")
-    return create_engine(con_str, pool_recycle=1, pool_timeout=57600).connect()
+    kwargs = {"pool_size": pool_size} if pool_size else {}
+    return create_engine(con_str, pool_recycle=1, pool_timeout=57600,
+                         **kwargs).connect()
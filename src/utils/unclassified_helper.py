@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+The review queue of the keys that need new classifications. The workers
+refresh `unclassified_keys` for the campaigns of each file they upload, so
+finding the unidentified keys with the largest impact is an indexed read
+instead of a scan of the classified tables
+"""
+
+# python standard
+import logging
+
+# third-party imports
+from sqlalchemy import text, bindparam, Date
+
+# local imports
+from utils.pattern_helper import FIELDS
+
+############################################################################
+logger = logging.getLogger('dspreview_application')
+############################################################################
+
+# what the workers write when no classification matches, see
+# workers.worker.Worker.find_by_patter
+UNIDENTIFIED = {f: "unidentified " + f.replace("_", "") for f in FIELDS}
+
+UNCLASSIFIED_FIELDS = ["source", "campaign_key", "placement_key",
+                       "campaign_id", "campaign", "placement_id", "placement",
+                       "missing_brand", "missing_sub_brand", "missing_dsp",
+                       "first_seen", "last_seen", "row_count", "impressions",
+                       "clicks", "cost"]
+
+# the orders of the review queue, each one is read from an index
+SORTS = {
+    "cost": "cost DESC, impressions DESC, id DESC",
+    "impressions": "impressions DESC, id DESC",
+    "rows": "row_count DESC, id DESC"
+}
+
+# the largest page served
+MAX_PAGE = 500
+
+MISSING = ",\n".join("MAX(CASE WHEN b.{0} = :{0} THEN 1 ELSE 0 END)".format(f)
+                     for f in FIELDS)
+
+# the unidentified rows of each classified table, grouped by key
+UNCLASSIFIED_SELECT = {
+    "dcm_classified": """
+        SELECT 'dcm', c.campaign_key, c.placement_key, cp.campaign_id,
+               cp.campaign, pl.placement_id, pl.placement,
+               {missing},
+               DATE(MIN(c.date)), DATE(MAX(c.date)), COUNT(*),
+               SUM(c.impressions), SUM(c.clicks), 0
+        FROM dcm_classified AS c
+             JOIN brands AS b ON b.id = c.brand_key
+             JOIN campaigns AS cp ON cp.id = c.campaign_key
+             JOIN placements AS pl ON pl.id = c.placement_key
+        WHERE c.brand_key IN :brand_keys {where}
+        GROUP BY c.campaign_key, c.placement_key, cp.campaign_id,
+                 cp.campaign, pl.placement_id, pl.placement""",
+    "dsp_classified": """
+        SELECT c.source, c.campaign_key, 0, cp.campaign_id, cp.campaign,
+               NULL, NULL,
+               {missing},
+               DATE(MIN(c.date)), DATE(MAX(c.date)), COUNT(*),
+               SUM(c.impressions), SUM(c.clicks), SUM(c.cost)
+        FROM dsp_classified AS c
+             JOIN brands AS b ON b.id = c.brand_key
+             JOIN campaigns AS cp ON cp.id = c.campaign_key
+        WHERE c.brand_key IN :brand_keys {where}
+        GROUP BY c.source, c.campaign_key, cp.campaign_id, cp.campaign"""
+}
+
+
+def unidentified_brand_keys(con):
+    """the keys of the brands with any of the fields unidentified"""
+    rows = con.execute(text("""SELECT id FROM brands
+                               WHERE brand = :brand
+                                  OR sub_brand = :sub_brand
+                                  OR dsp = :dsp"""), **UNIDENTIFIED)
+    return [r[0] for r in rows]
+
+
+def keys_in_range(con, source, start, end):
+    """the campaign keys of `source` with unidentified rows in the range"""
+    rows = con.execute(text("""SELECT DISTINCT campaign_key
+                               FROM unclassified_keys
+                               WHERE source = :source
+                                 AND first_seen <= :end
+                                 AND last_seen >= :start"""),
+                       source=source, start=start, end=end)
+    return [r[0] for r in rows]
+
+
+def refresh_unclassified(con, source=None, campaign_keys=None):
+    """
+    Compute again the unclassified keys of some campaigns of a source, from
+    their rows in the classified table, or all of them
+
+    Params
+    ------
+    con : sqlalchemy connection
+    source : string
+        'dcm' or a DSP name, if None, every source is refreshed
+    campaign_keys : array_like
+        the campaigns of `source` to be refreshed, usually those of the
+        file just uploaded. If None, all of them
+
+    Returns
+    -------
+    the number of unclassified keys written
+    """
+    params = dict(UNIDENTIFIED)
+    tables = list(UNCLASSIFIED_SELECT)
+    delete, where = "DELETE FROM unclassified_keys", ""
+    if source is not None:
+        tables = ["dcm_classified" if source == "dcm" else "dsp_classified"]
+        delete += " WHERE source = :source"
+        where = " AND c.source = :source" if source != "dcm" else ""
+        params["source"] = source
+    if campaign_keys is not None:
+        campaign_keys = sorted(int(k) for k in set(campaign_keys))
+        if not campaign_keys:
+            return 0
+        delete += " AND" if source is not None else " WHERE"
+        delete += " campaign_key IN :campaign_keys"
+        where += " AND c.campaign_key IN :campaign_keys"
+        params["campaign_keys"] = campaign_keys
+
+    def query(sql):
+        q = text(sql)
+        for name in ["brand_keys", "campaign_keys"]:
+            if ":" + name in sql:
+                q = q.bindparams(bindparam(name, expanding=True))
+        return q
+
+    written = 0
+    brand_keys = unidentified_brand_keys(con)
+    with con.begin():
+        con.execute(query(delete), **params)
+        if brand_keys:
+            params["brand_keys"] = brand_keys
+            for table in tables:
+                written += con.execute(query("""
+                    INSERT INTO unclassified_keys ({fields}) {select}
+                    """.format(fields=", ".join(UNCLASSIFIED_FIELDS),
+                               select=UNCLASSIFIED_SELECT[table].format(
+                                   missing=MISSING, where=where))),
+                    **params).rowcount
+    logger.info("Refreshed [{}] unclassified keys of [{}]".format(
+        written, source or "all sources"))
+    return written
+
+
+def list_unclassified(con, sort="cost", source=None, page=1,
+                      per_page=50):
+    """
+    Params
+    ------
+    con : sqlalchemy connection
+    sort : string
+        one of `SORTS`, the largest impact first
+    source : string
+        if given, only the keys of this source
+    page : int
+        starting from 1
+    per_page : int
+        up to `MAX_PAGE`
+
+    Returns
+    -------
+    the total number of keys, and a list of dictionaries for the page,
+    with the unidentified fields in `missing`
+    """
+    if sort not in SORTS:
+        raise Exception("Unknown sort [{}]".format(sort))
+    per_page = max(min(per_page, MAX_PAGE), 1)
+    where = " WHERE source = :source" if source else ""
+    total = con.execute(text("SELECT COUNT(*) FROM unclassified_keys" +
+                             where), source=source).scalar()
+    fields = [f for f in UNCLASSIFIED_FIELDS if not f.endswith("_key")]
+    query = text("""SELECT {fields} FROM unclassified_keys{where}
+                    ORDER BY {order} LIMIT :limit OFFSET :offset""".format(
+        fields=", ".join(fields), where=where, order=SORTS[sort])).columns(
+            first_seen=Date, last_seen=Date)
+    rows = con.execute(query, source=source, limit=per_page,
+                       offset=(max(page, 1) - 1) * per_page)
+    keys = []
+    for row in rows:
+        key = dict(zip(fields, row))
+        key["missing"] = [f for f in FIELDS if key.pop("missing_" + f)]
+        keys.append(key)
+    return total, keys
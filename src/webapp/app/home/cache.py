@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+A bounded LRU cache of encoded report responses. The keys start with the
+report data version, so a new report generation makes every entry stale
+"""
+
+# python standard
+import hashlib
+import threading
+
+# third-party imports
+from cachetools import LRUCache
+
+# query string parameters that change on every request without changing
+# the response (the DataTables counter and the jQuery cache buster)
+IGNORED_PARAMS = ("draw", "_")
+
+
+class ResponseCache(object):
+    """
+    Thread safe LRU cache of response bodies (bytes), bounded by their total
+    size rather than by the number of entries
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Params
+        ------
+        max_bytes : int
+            the total size of the cached bodies
+        """
+        self.max_bytes = max_bytes
+        self._cache = LRUCache(max_bytes, getsizeof=len)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._cache.get(key)
+
+    def set(self, key, body):
+        """bodies larger than the whole cache are not kept"""
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._cache[key] = body
+
+
+def cache_key(version, path, args):
+    """
+    Params
+    ------
+    version : int
+        the report data version
+    path : string
+        the endpoint path
+    args : werkzeug.datastructures.MultiDict
+        the query string
+
+    Returns
+    -------
+    A hashable key, the same for requests with the same parameters in any
+    order
+    """
+    params = tuple(sorted((k, tuple(v)) for k, v in args.lists()
+                          if k not in IGNORED_PARAMS))
+    return (version, path, params)
+
+
+def etag(key):
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
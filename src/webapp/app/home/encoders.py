@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Encode report rows straight from database cursors, a chunk at a time,
+without building ORM objects or the whole payload in memory. The columnar
+json is the exception, each column is a single array, so it is only sent
+once the cursor is read
+"""
+
+# python standard
+import io
+import csv
+import json
+import zlib
+from datetime import date, datetime
+
+# third-party imports
+from sqlalchemy import types
+try:
+    # much faster, and it encodes datetimes natively
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# rows fetched from the cursor and encoded at once
+CHUNK_SIZE = 1000
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+# 'rows' is a list of objects, 'columns' one list per column (buffered), and
+# 'arrow' an Apache Arrow IPC stream
+FORMATS = {
+    "rows": "application/json",
+    "columns": "application/json",
+    "arrow": ARROW_MIMETYPE
+}
+
+
+def default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        # numpy scalars, from pandas
+        return value.item()
+    raise TypeError("{} is not JSON serializable".format(type(value)))
+
+
+def dumps(value):
+    """the compact json text of `value`, datetimes in iso format"""
+    if orjson is not None:
+        return orjson.dumps(value, default=default).decode("utf-8")
+    return json.dumps(value, default=default, separators=(",", ":"))
+
+
+def stream_json(result, keys, head='{"status":"success","data":[',
+                tail=']}'):
+    """
+    Params
+    ------
+    result : sqlalchemy ResultProxy
+        preferably from a `stream_results` connection, so the rows are not
+        buffered by the driver
+    keys : array_like
+        the name of each column of `result`
+
+    Returns
+    -------
+    A generator of json text, `head`, the rows as objects, and `tail`
+    """
+    yield head
+    separator = ""
+    while True:
+        rows = result.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        yield separator + dumps([dict(zip(keys, r)) for r in rows])[1:-1]
+        separator = ","
+    yield tail
+
+
+def stream_csv(result, keys):
+    """
+    Params
+    ------
+    result : sqlalchemy ResultProxy
+    keys : array_like
+        the name of each column of `result`
+
+    Returns
+    -------
+    A generator of csv text, the header and then a chunk of rows at a time
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(keys)
+    while True:
+        rows = result.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def encode_columns(result, keys):
+    """
+    It is not streamed: the first column is only complete after the last
+    row, so the whole `result` is read before anything is yielded. The
+    values are kept as json text of each chunk meanwhile, the large ranges
+    are better served as 'rows' or 'arrow'
+
+    Params
+    ------
+    result : sqlalchemy ResultProxy
+    keys : array_like
+        the name of each column of `result`
+
+    Returns
+    -------
+    A generator of json text, an object with the `keys` in 'columns' and the
+    list of values of each one in 'data', the keys are not repeated by row
+    """
+    encoded = {k: [] for k in keys}
+    while True:
+        rows = result.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        for k, values in zip(keys, zip(*rows)):
+            encoded[k].append(dumps(list(values))[1:-1])
+    yield '{{"status":"success","columns":{},"data":{{'.format(
+        dumps(list(keys)))
+    for i, k in enumerate(keys):
+        yield '{}{}:[{}]'.format("," if i else "", dumps(k),
+                                 ",".join(encoded.pop(k)))
+    yield '}}'
+
+
+def arrow_type(column_type):
+    """the arrow type of a sqlalchemy column type"""
+    if isinstance(column_type, types.DateTime):
+        return pa.timestamp("us")
+    if isinstance(column_type, types.Date):
+        return pa.date32()
+    if isinstance(column_type, types.Integer):
+        return pa.int64()
+    if isinstance(column_type, (types.Float, types.Numeric)):
+        return pa.float64()
+    if isinstance(column_type, types.Boolean):
+        return pa.bool_()
+    return pa.string()
+
+
+def drain(sink):
+    """the bytes written to `sink` since the last call, it is emptied"""
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def stream_arrow(result, columns):
+    """
+    Params
+    ------
+    result : sqlalchemy ResultProxy
+    columns : array_like
+        the sqlalchemy columns selected in `result`, their types make the
+        schema, so it is the same even when there are no rows
+
+    Returns
+    -------
+    A generator of bytes, an Apache Arrow IPC stream with a record batch
+    for each chunk of rows
+    """
+    schema = pa.schema([(str(c.name), arrow_type(c.type)) for c in columns])
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        yield drain(sink)
+        while True:
+            rows = result.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+            arrays = [pa.array(values, type=field.type)
+                      for values, field in zip(zip(*rows), schema)]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays,
+                                                          schema=schema))
+            yield drain(sink)
+    # the end of stream marker
+    yield drain(sink)
+
+
+def encode(result, columns, fmt="rows"):
+    """
+    Params
+    ------
+    result : sqlalchemy ResultProxy
+    columns : array_like
+        the sqlalchemy columns selected in `result`
+    fmt : string
+        one of `FORMATS`
+
+    Returns
+    -------
+    A generator of bytes, `result` in the format `fmt`
+    """
+    if fmt == "arrow":
+        if pa is None:
+            raise Exception("pyarrow is required for the arrow format")
+        return stream_arrow(result, columns)
+    keys = [str(c.name) for c in columns]
+    chunks = encode_columns(result, keys) if fmt == "columns" else \
+        stream_json(result, keys)
+    return (c.encode("utf-8") for c in chunks)
+
+
+def arrow_available():
+    return pa is not None
+
+
+def encodings():
+    """the content codings available, the preferred first"""
+    return (["br"] if brotli is not None else []) + ["gzip"]
+
+
+def compress(chunks, encoding):
+    """
+    Params
+    ------
+    chunks : iterable
+        bytes
+    encoding : string
+        'br', 'gzip', or None to leave `chunks` as they are
+
+    Returns
+    -------
+    A generator of the compressed bytes, as the chunks arrive
+    """
+    if encoding is None:
+        for chunk in chunks:
+            yield chunk
+        return
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        process, finish = compressor.process, compressor.finish
+    else:
+        # 31 bits window, with the gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = process(chunk)
+        if data:
+            yield data
+    yield finish()
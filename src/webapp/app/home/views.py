@@ -1,16 +1,30 @@
 # python standard
 from datetime import datetime
+from types import SimpleNamespace
 
 # third-party imports
-from flask import flash, redirect, render_template, url_for, jsonify, request
+from flask import (abort, flash, redirect, render_template, url_for,
+                   jsonify, request, Response, stream_with_context)
 from flask_login import login_required
 
 # local imports
+from utils.config_helper import ConfigHelper
+from utils.meta_helper import report_version, report_meta
+from utils.job_helper import enqueue_job, get_job
+from utils.pattern_helper import KeyIndex, dry_run
+from utils.classification_helper import (RULE_FIELDS, RULE_FORMATS,
+                                         read_rules, validate_rules,
+                                         import_rules, affected_keys)
+from utils.regex_helper import vet_rules
+from utils.unclassified_helper import SORTS, MAX_PAGE, list_unclassified
+from utils.rollup_helper import query_rollup, aggregate
 from . import home
+from .cache import ResponseCache, cache_key, etag
+from .encoders import (FORMATS, ARROW_MIMETYPE, dumps, encode, encodings,
+                       compress, arrow_available, stream_json, stream_csv)
 from .forms import ClassificationForm
 from .. import db
-from ..models import Report, Classification, DCM, DSP
-from ..queries import GENERATE_CLASSIFIED, GENERATE_REPORT
+from ..models import Report, Classification
 
 
 @home.route('/')
@@ -30,41 +44,294 @@ def dashboard():
     return render_template('home/dashboard.html', title="Dashboard")
 
 
+# the dashboard columns, in the order of the DataTables `columns[i]`
+REPORT_FIELDS = ["date", "brand", "sub_brand", "ad_campaign_id",
+                 "ad_campaign", "dsp", "dsp_campaign_id", "dsp_campaign",
+                 "ad_impressions", "ad_clicks", "ad_reach", "dsp_impressions",
+                 "dsp_clicks", "dsp_cost"]
+
+# the text columns matched by the DataTables search box
+REPORT_SEARCHABLE = ["brand", "sub_brand", "ad_campaign", "dsp",
+                     "dsp_campaign"]
+
+# the columns filtered by the /report parameters of the same name, and the
+# type of their values
+REPORT_FILTERS = {
+    "brand": str,
+    "sub_brand": str,
+    "dsp": str,
+    "ad_campaign_id": int,
+    "dsp_campaign_id": int
+}
+
+# the largest page served, `length=-1` (show all) is capped to it
+REPORT_MAX_PAGE = 1000
+
+
+# encoded responses of the current report data version
+RESPONSE_CACHE = ResponseCache(
+    ConfigHelper.shared().get_int("REPORT_CACHE_MB", 64) * 2 ** 20)
+
+# the distinct keys of the raw data, for the classification dry runs
+KEY_INDEX = KeyIndex()
+
+
+def request_key():
+    """the cache key of this request, for the current report data"""
+    return cache_key(report_version(db.engine), request.path, request.args)
+
+
+def not_modified(key):
+    """a 304 response if the client already has this version"""
+    tag = etag(key)
+    if request.if_none_match.contains(tag):
+        response = Response(status=304)
+        response.set_etag(tag)
+        return response
+    return None
+
+
+def tagged(body, key, mimetype="application/json", encoding=None):
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag(key))
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def response_format():
+    """
+    The `format` query parameter, otherwise arrow when the Accept header
+    prefers it over json
+    """
+    fmt = request.args.get('format')
+    if fmt is None:
+        best = request.accept_mimetypes.best_match(["application/json",
+                                                    ARROW_MIMETYPE])
+        fmt = "arrow" if best == ARROW_MIMETYPE else "rows"
+    if fmt not in FORMATS:
+        raise Exception("Unknown format [{}]".format(fmt))
+    return fmt
+
+
+def response_encoding():
+    """the preferred content coding accepted by the client, if any"""
+    return request.accept_encodings.best_match(encodings())
+
+
+def parse_date(dt):
+    if dt:
+        try:
+            dt = datetime.strptime(dt, "%Y-%m-%d")
+        except Exception:
+            dt = None
+    return dt
+
+
+def split(value):
+    """the items of a comma separated query string parameter"""
+    return [v for v in (value or "").split(",") if v]
+
+
+def report_conditions(start_date, end_date, args):
+    """
+    Params
+    ------
+    start_date, end_date : datetime
+        the first and the last dates, both optional
+    args : werkzeug.datastructures.MultiDict
+        the query string, with the `REPORT_FILTERS`, each one repeated or
+        comma separated for many values, and `campaign`, a prefix of the DCM
+        or the DSP campaign names
+
+    Returns
+    -------
+    the conditions on the report table, for its `WHERE` clause
+    """
+    table = Report.__table__
+    conditions = []
+    if start_date:
+        conditions.append(table.c.date >= start_date)
+    if end_date:
+        conditions.append(table.c.date <= end_date)
+    for field, kind in REPORT_FILTERS.items():
+        values = [kind(v) for value in args.getlist(field)
+                  for v in split(value)]
+        if values:
+            conditions.append(table.c[field].in_(values))
+    prefix = args.get('campaign')
+    if prefix:
+        conditions.append(db.or_(
+            table.c.ad_campaign.startswith(prefix, autoescape=True),
+            table.c.dsp_campaign.startswith(prefix, autoescape=True)))
+    return conditions
+
+
+def report_query(conditions):
+    """the report rows matching the `conditions`"""
+    return Report.query.filter(*conditions)
+
+
+def report_page(query, args):
+    """
+    Params
+    ------
+    query : flask_sqlalchemy.BaseQuery
+        the report rows of the date range
+    args : dict
+        the DataTables server-side parameters (draw, start, length,
+        order[0][column], order[0][dir], columns[i][data], search[value])
+
+    Returns
+    -------
+    the DataTables response, with a single page of rows
+    """
+    total = query.count()
+    search = args.get('search[value]', default='')
+    if search:
+        query = query.filter(db.or_(*[
+            getattr(Report, c).contains(search, autoescape=True)
+            for c in REPORT_SEARCHABLE]))
+    filtered = query.count() if search else total
+
+    column = args.get('order[0][column]', default=0, type=int)
+    field = args.get('columns[{}][data]'.format(column), default='date')
+    if field not in REPORT_FIELDS:
+        field = 'date'
+    order = getattr(Report, field)
+    if args.get('order[0][dir]') == 'desc':
+        order = order.desc()
+    # the id makes the order stable between pages, the date index holds it
+    query = query.order_by(order, Report.id)
+
+    start = max(args.get('start', default=0, type=int), 0)
+    length = args.get('length', default=10, type=int)
+    if length < 0 or length > REPORT_MAX_PAGE:
+        length = REPORT_MAX_PAGE
+    rows = query.offset(start).limit(length).all()
+    return {
+        "draw": args.get('draw', default=0, type=int),
+        "recordsTotal": total,
+        "recordsFiltered": filtered,
+        "data": [r.serialize for r in rows]
+    }
+
+
+def stream_report(conditions, fmt="rows"):
+    """
+    The rows of `Report.serialize` matching the `conditions`, read through a
+    server side cursor and encoded a chunk at a time in the format `fmt`,
+    but for 'columns', which is sent once all the rows are read
+    """
+    table = Report.__table__
+    columns = [table.c[k] for k in REPORT_FIELDS + ["created_at",
+                                                     "updated_at"]]
+    query = db.select(columns).where(db.and_(*conditions))
+    with db.engine.connect() as con:
+        result = con.execution_options(stream_results=True).execute(query)
+        for chunk in encode(result, columns, fmt):
+            yield chunk
+
+
+def caching(key, chunks):
+    """
+    Yield the `chunks`, and keep them in the cache as the body of `key` while
+    they are small enough to fit
+    """
+    kept, size = [], 0
+    for chunk in chunks:
+        yield chunk
+        if kept is not None:
+            kept.append(chunk)
+            size += len(chunk)
+            if size > RESPONSE_CACHE.max_bytes // 4:
+                kept = None
+    if kept is not None:
+        RESPONSE_CACHE.set(key, b"".join(kept))
+
+
 @home.route('/report')
 @login_required
 def report_date():
     """
-    Return full report data as Json
+    Return report data as Json. With the DataTables server-side parameters
+    (`draw`, `start`, `length`...) only the requested page is returned,
+    otherwise all the rows of the date range. The rows might be filtered by
+    brand, sub_brand, dsp, ad_campaign_id, dsp_campaign_id (many values
+    each), and by a campaign name prefix (`campaign`). They are returned as
+    a list of objects, one list per column (`format=columns`, buffered by
+    the server), or an Apache Arrow stream (`format=arrow`), compressed
+    with brotli or gzip when accepted
     """
     try:
-        def parse_date(dt):
-            if dt:
-                try:
-                    dt = datetime.strptime(dt, "%Y-%m-%d")
-                except Exception:
-                    dt = None
-            return dt
-
         start_date = parse_date(request.args.get('start_date',
                                                  default=None, type=None))
         end_date = parse_date(request.args.get('end_date',
                                                default=None, type=None))
+        conditions = report_conditions(start_date, end_date, request.args)
+        key = request_key()
+        if 'draw' in request.args:
+            # the page is cached without the draw counter
+            body = RESPONSE_CACHE.get(key)
+            if body is None:
+                page = report_page(report_query(conditions), request.args)
+                page.pop("draw")
+                body = dumps(page).encode("utf-8")
+                RESPONSE_CACHE.set(key, body)
+            draw = request.args.get('draw', default=0, type=int)
+            return Response(b'{"draw":%d,' % draw + body[1:],
+                            mimetype="application/json")
+
+        fmt = response_format()
+        if fmt == "arrow" and not arrow_available():
+            return jsonify({
+                "status": "fail",
+                "data": []
+            }), 406
+        encoding = response_encoding()
+        # the representations differ, and so do their etags
+        key += (fmt, encoding)
+        response = not_modified(key)
+        if response is not None:
+            return response
+        body = RESPONSE_CACHE.get(key)
+        if body is None:
+            body = stream_with_context(caching(
+                key, compress(stream_report(conditions, fmt),
+                              encoding)))
+        response = tagged(body, key, FORMATS[fmt], encoding)
+        response.vary.update(["Accept", "Accept-Encoding"])
+        return response
+    except Exception as err:
+        print(str(err))
+        return jsonify({
+            "status": "fail",
+            "data": []
+        })
 
-        results = []
-        if start_date and end_date:
-            results = Report.query\
-                            .filter(Report.date >= start_date)\
-                            .filter(Report.date <= end_date)
-        elif start_date:
-            results = Report.query.filter(Report.date >= start_date)
-        elif end_date:
-            results = Report.query.filter(Report.date <= end_date)
-        else:
-            results = Report.query.all()
 
+@home.route('/report/rollup')
+@login_required
+def report_rollup():
+    """
+    Return the report summed by brand (or campaign) for each day, week,
+    month, or for the whole range, read from the coarsest rollup possible
+    """
+    try:
+        start_date = datetime.strptime(request.args.get('start_date'),
+                                       "%Y-%m-%d")
+        end_date = datetime.strptime(request.args.get('end_date'),
+                                     "%Y-%m-%d")
+        level = request.args.get('level', default='brand')
+        bucket = request.args.get('bucket', default='total')
+        with db.engine.connect() as con:
+            period, df = query_rollup(con, start_date, end_date,
+                                      level=level, bucket=bucket)
+        df["date"] = df.date.dt.strftime("%Y-%m-%d")
         return jsonify({
             "status": "success",
-            "data": [r.serialize for r in results]
+            "source": period,
+            "data": df.to_dict(orient="records")
         })
     except Exception as err:
         print(str(err))
@@ -74,18 +341,69 @@ def report_date():
         })
 
 
+@home.route('/report/aggregate')
+@login_required
+def report_aggregate():
+    """
+    Return the report metrics (`metrics`, all by default) summed by the
+    `group` dimensions (brand, sub_brand, dsp, campaign) for each day, week,
+    month, or for the whole range, one list per column
+    """
+    try:
+        start_date = datetime.strptime(request.args.get('start_date'),
+                                       "%Y-%m-%d")
+        end_date = datetime.strptime(request.args.get('end_date'),
+                                     "%Y-%m-%d")
+        key = request_key()
+        response = not_modified(key)
+        if response is not None:
+            return response
+        body = RESPONSE_CACHE.get(key)
+        if body is None:
+            with db.engine.connect() as con:
+                period, df = aggregate(
+                    con, start_date, end_date,
+                    split(request.args.get('group')),
+                    request.args.get('bucket', default='total'),
+                    split(request.args.get('metrics')))
+            df["date"] = df.date.dt.strftime("%Y-%m-%d")
+            body = dumps({
+                "status": "success",
+                "source": period,
+                "columns": list(df.columns),
+                "data": df.to_dict(orient="list")
+            }).encode("utf-8")
+            RESPONSE_CACHE.set(key, body)
+        return tagged(body, key)
+    except Exception as err:
+        print(str(err))
+        return jsonify({
+            "status": "fail",
+            "data": []
+        })
+
+
 @home.route('/last_update')
 @login_required
 def last_update():
     """
-    Get last update date
+    Get last update date, and how the report was last generated, from the
+    single row of `report_meta`
     """
     try:
-        last = Report.query.order_by("updated_at desc").first().updated_at
-        return jsonify({
+        meta = report_meta(db.engine) or {"version": 0}
+        key = cache_key(meta["version"], request.path, request.args)
+        response = not_modified(key)
+        if response is not None:
+            return response
+        return tagged(dumps({
             "status": "success",
-            "last_update": last
-        })
+            "last_update": meta.get("generated_at"),
+            "version": meta["version"],
+            "mode": meta.get("mode"),
+            "duration": meta.get("duration"),
+            "rows": meta.get("report_rows")
+        }), key)
     except Exception as err:
         print(str(err))
         return jsonify({
@@ -107,6 +425,22 @@ def list_classifications():
                            title="Classifications")
 
 
+def vetted(form, rule):
+    """
+    Time the pattern of `rule` against the keys of the raw data, its
+    problems are added to the errors of the pattern field of `form`
+
+    Returns
+    -------
+    True if the pattern might be saved
+    """
+    with db.engine.connect() as con:
+        KEY_INDEX.refresh(con)
+    problems = vet_rules([rule], KEY_INDEX)[0]
+    form.pattern.errors = list(form.pattern.errors) + problems
+    return not problems
+
+
 @home.route('/classifications/add', methods=['GET', 'POST'])
 @login_required
 def add_classification():
@@ -116,7 +450,8 @@ def add_classification():
     add_classification = True
 
     form = ClassificationForm()
-    if form.validate_on_submit():
+    if form.validate_on_submit() and vetted(form,
+                                            SimpleNamespace(**form.data)):
         classification = Classification(pattern=form.pattern.data,
                                         brand=form.brand.data,
                                         sub_brand=form.sub_brand.data,
@@ -143,6 +478,114 @@ def add_classification():
                            title="Add Classification")
 
 
+@home.route('/classifications/dry_run', methods=['POST'])
+@login_required
+def dry_run_classification():
+    """
+    Evaluate the classification of the form against the keys of the raw
+    data without saving it. With `id`, it replaces that classification,
+    otherwise it is applied after all the others
+    """
+    form = ClassificationForm()
+    candidate = SimpleNamespace(id=request.args.get('id', type=int),
+                                **form.data)
+    # the pattern is run in this process, so a slow one must not get there
+    if not (form.validate() and vetted(form, candidate)):
+        return jsonify({
+            "status": "fail",
+            "errors": form.errors
+        })
+    try:
+        rules = Classification.query.filter_by(quarantined=False) \
+            .order_by(Classification.id).all()
+        result = dry_run(KEY_INDEX, rules, candidate)
+        return Response(dumps(dict(result, status="success")),
+                        mimetype="application/json")
+    except Exception as err:
+        print(str(err))
+        return jsonify({
+            "status": "fail",
+            "errors": {"pattern": [str(err)]}
+        })
+
+
+@home.route('/classifications/import', methods=['POST'])
+@login_required
+def import_classifications():
+    """
+    Import the classifications of an uploaded CSV or JSON file (`file`), all
+    of them or none. With `mode=replace` they replace the current ones,
+    otherwise they are added. A single reclassification job is started if
+    any key of the raw data is affected, or the one already queued is
+    joined. A running one might have read the rules before the import, so
+    another one is queued after it
+    """
+    try:
+        upload = request.files['file']
+        fmt = request.form.get('format') or \
+            upload.filename.rsplit(".", 1)[-1].lower()
+        if fmt not in RULE_FORMATS:
+            raise Exception("Unknown rules format [{}]".format(fmt))
+        rows = read_rules(upload.read().decode("utf-8"), fmt)
+        with db.engine.connect() as con:
+            KEY_INDEX.refresh(con)
+        rules, errors = validate_rules(rows, KEY_INDEX)
+        if errors:
+            return jsonify({
+                "status": "fail",
+                "errors": errors
+            }), 400
+
+        with db.engine.connect() as con:
+            replace = request.form.get('mode') == 'replace'
+            result = import_rules(con, rules, replace=replace)
+            KEY_INDEX.refresh(con)
+        affected = affected_keys(KEY_INDEX, result.pop("changed"))
+        job_id = None
+        if any(affected.values()):
+            job_id = enqueue_job(db.engine, "rebuild")
+        return jsonify(dict(result, status="success", affected=affected,
+                            job=job_id,
+                            progress=job_id and url_for('home.job_progress',
+                                                        id=job_id)))
+    except Exception as err:
+        print(str(err))
+        return jsonify({
+            "status": "fail",
+            "errors": [str(err)]
+        })
+
+
+@home.route('/classifications/export', methods=['GET'])
+@login_required
+def export_classifications():
+    """
+    Export the classifications, in the order they are applied, as CSV or as
+    JSON (`format=json`), in the layout accepted by the import
+    """
+    fmt = request.args.get('format', default='csv')
+    if fmt not in RULE_FORMATS:
+        abort(400)
+    table = Classification.__table__
+
+    def generate():
+        query = db.select([table.c[f] for f in RULE_FIELDS]).order_by(
+            table.c.id)
+        with db.engine.connect() as con:
+            result = con.execution_options(stream_results=True).execute(
+                query)
+            stream = stream_csv if fmt == "csv" else stream_json
+            for chunk in stream(result, RULE_FIELDS):
+                yield chunk
+
+    response = Response(stream_with_context(generate()),
+                        mimetype="text/csv" if fmt == "csv"
+                        else "application/json")
+    response.headers["Content-Disposition"] = \
+        "attachment; filename=classifications.{}".format(fmt)
+    return response
+
+
 @home.route('/classifications/edit/<int:id>', methods=['GET', 'POST'])
 @login_required
 def edit_classification(id):
@@ -154,7 +597,8 @@ def edit_classification(id):
 
     classification = Classification.query.get_or_404(id)
     form = ClassificationForm(obj=classification)
-    if form.validate_on_submit():
+    rule = SimpleNamespace(**dict(form.data, pattern=classification.pattern))
+    if form.validate_on_submit() and vetted(form, rule):
         classification.brand = form.brand.data
         classification.sub_brand = form.sub_brand.data
         classification.dsp = form.dsp.data
@@ -199,24 +643,104 @@ def delete_classification(id):
     return render_template(title="Delete Classification")
 
 
+@home.route('/classification/release/<int:id>', methods=['GET', 'POST'])
+@login_required
+def release_classification(id):
+    """
+    Release a quarantined classification, once its pattern passes the
+    vetting again, so the next runs apply it
+    """
+    classification = Classification.query.get_or_404(id)
+    with db.engine.connect() as con:
+        KEY_INDEX.refresh(con)
+    problems = vet_rules([classification], KEY_INDEX)[0]
+    if problems:
+        flash('The classification is still quarantined, {}.'.format(
+            "; ".join(problems)))
+    else:
+        classification.quarantined = False
+        db.session.commit()
+        flash('You have successfully released the classification.')
+
+    # redirect to the classifications page
+    return redirect(url_for('home.list_classifications'))
+
+
 @home.route('/classification/reset', methods=['GET'])
 @login_required
 def reset_classifications():
     """
-    Reset all classifications, might take a while
+    Reset all classifications, might take a while, so it runs as a
+    background job, its progress is at /jobs/<id>. The tables are rebuilt
+    aside and swapped in, so the report can be read in the meantime
     """
     try:
-        DCM.query.delete()
-        DSP.query.delete()
-        Report.query.delete()
-        db.session.execute(GENERATE_CLASSIFIED)
-        db.session.execute(GENERATE_REPORT)
-        db.session.commit()
+        job_id = enqueue_job(db.engine, "rebuild")
         return jsonify({
-            "status": "success"
-        })
+            "status": "success",
+            "job": job_id,
+            "progress": url_for('home.job_progress', id=job_id)
+        }), 202
     except Exception as err:
         print(str(err))
         return jsonify({
             "status": "fail"
         })
+
+
+@home.route('/jobs/<id>', methods=['GET'])
+@login_required
+def job_progress(id):
+    """
+    Return the status of a background job, its stage, the rows processed so
+    far, and the seconds it is expected to take yet (eta)
+    """
+    job = get_job(db.engine, id)
+    if job is None:
+        abort(404)
+    return Response(dumps({"status": "success", "job": job}),
+                    mimetype="application/json")
+
+
+def unclassified_page():
+    """
+    The page of the review queue asked for by `sort` (cost, impressions or
+    rows), `page`, `per_page` and `source`
+
+    Returns
+    -------
+    A dictionary with the keys in `data`, the page and the total of keys
+    """
+    sort = request.args.get('sort', default='cost')
+    if sort not in SORTS:
+        abort(400)
+    page = max(request.args.get('page', default=1, type=int), 1)
+    per_page = max(min(request.args.get('per_page', default=50, type=int),
+                       MAX_PAGE), 1)
+    source = request.args.get('source') or None
+    with db.engine.connect() as con:
+        total, keys = list_unclassified(con, sort=sort, source=source,
+                                        page=page, per_page=per_page)
+    return {"data": keys, "sort": sort, "source": source, "page": page,
+            "per_page": per_page, "total": total}
+
+
+@home.route('/unclassified_keys', methods=['GET'])
+@login_required
+def unclassified_keys():
+    """
+    The keys with unidentified brand, sub brand or dsp rows, the largest
+    impact first, so the classifications they need can be triaged
+    """
+    return Response(dumps(dict(unclassified_page(), status="success")),
+                    mimetype="application/json")
+
+
+@home.route('/unclassified', methods=['GET'])
+@login_required
+def list_unclassified_keys():
+    """
+    List the unclassified keys, a page at a time
+    """
+    return render_template('home/unclassified.html', title="Unclassified",
+                           **unclassified_page())
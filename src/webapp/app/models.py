@@ -2,9 +2,10 @@
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy.sql import func
-from sqlalchemy import Index
+from sqlalchemy import Index, event
 
 # local imports
+from utils.partition_helper import partition_on_create
 from webapp.app import db, login_manager
 
 
@@ -14,18 +15,17 @@ class DCM(db.Model):
     """
 
     __tablename__ = 'dcm_classified'
-    id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, nullable=False)
-    campaign_id = db.Column(db.Integer, nullable=False)
-    campaign = db.Column(db.String(75), nullable=False)
-    placement_id = db.Column(db.Integer, nullable=False)
-    placement = db.Column(db.String(75), nullable=False)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # the partition key must be part of the primary key
+    date = db.Column(db.DateTime, primary_key=True)
+    # md5 of the dimensions, see webapp.app.queries.ROW_KEYS
+    row_key = db.Column(db.BINARY(16), nullable=False)
+    brand_key = db.Column(db.Integer, nullable=False)
+    campaign_key = db.Column(db.Integer, nullable=False)
+    placement_key = db.Column(db.Integer, nullable=False)
     impressions = db.Column(db.Float, nullable=False)
     clicks = db.Column(db.Integer, nullable=False)
     reach = db.Column(db.Float, nullable=False)
-    brand = db.Column(db.String(25), nullable=False)
-    sub_brand = db.Column(db.String(25), nullable=False)
-    dsp = db.Column(db.String(25), nullable=False)
     created_at = db.Column(db.DateTime, nullable=False,
                            server_default=func.now())
     updated_at = db.Column(db.DateTime, nullable=False,
@@ -33,9 +33,10 @@ class DCM(db.Model):
 
 
 # Create an index to not allow reapeated values on these dimensions
-Index('dcm_classified_index', DCM.date, DCM.brand, DCM.sub_brand,
-      DCM.campaign_id, DCM.campaign, DCM.placement_id, DCM.placement, DCM.dsp,
-      unique=True)
+Index('dcm_classified_index', DCM.row_key, DCM.date, unique=True)
+
+# The unidentified rows of some campaigns, see utils.unclassified_helper
+Index('dcm_classified_brand_index', DCM.brand_key, DCM.campaign_key)
 
 
 class DCMRaw(db.Model):
@@ -44,8 +45,11 @@ class DCMRaw(db.Model):
     """
 
     __tablename__ = 'dcm_raw'
-    id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, nullable=False)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # the partition key must be part of the primary key
+    date = db.Column(db.DateTime, primary_key=True)
+    # md5 of the dimensions, see webapp.app.queries.ROW_KEYS
+    row_key = db.Column(db.BINARY(16), nullable=False)
     campaign_id = db.Column(db.Integer, nullable=False)
     campaign = db.Column(db.String(75), nullable=False)
     placement_id = db.Column(db.Integer, nullable=False)
@@ -60,8 +64,7 @@ class DCMRaw(db.Model):
 
 
 # Create an index to not allow reapeated values on these dimensions
-Index('dcm_raw_index', DCMRaw.date, DCMRaw.campaign_id, DCMRaw.campaign,
-      DCMRaw.placement_id, DCMRaw.placement, unique=True)
+Index('dcm_raw_index', DCMRaw.row_key, DCMRaw.date, unique=True)
 
 
 class DSP(db.Model):
@@ -70,16 +73,17 @@ class DSP(db.Model):
     """
 
     __tablename__ = 'dsp_classified'
-    id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, nullable=False)
-    campaign_id = db.Column(db.Integer, nullable=False)
-    campaign = db.Column(db.String(75), nullable=False)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # the partition key must be part of the primary key
+    date = db.Column(db.DateTime, primary_key=True)
+    # md5 of the dimensions, see webapp.app.queries.ROW_KEYS
+    row_key = db.Column(db.BINARY(16), nullable=False)
+    brand_key = db.Column(db.Integer, nullable=False)
+    campaign_key = db.Column(db.Integer, nullable=False)
     impressions = db.Column(db.Float, nullable=False)
     clicks = db.Column(db.Integer, nullable=False)
     cost = db.Column(db.Float, nullable=False)
-    brand = db.Column(db.String(25), nullable=False)
-    sub_brand = db.Column(db.String(25), nullable=False)
-    dsp = db.Column(db.String(25), nullable=False)
+    source = db.Column(db.String(25), nullable=False, server_default="")
     created_at = db.Column(db.DateTime, nullable=False,
                            server_default=func.now())
     updated_at = db.Column(db.DateTime, nullable=False,
@@ -87,8 +91,16 @@ class DSP(db.Model):
 
 
 # Create an index to not allow reapeated values on these dimensions
-Index('dsp_classified_index', DSP.date, DSP.brand, DSP.sub_brand,
-      DSP.campaign_id, DSP.campaign, DSP.dsp, unique=True)
+Index('dsp_classified_index', DSP.row_key, DSP.date, unique=True)
+
+# The report joins DCM and DSP on these
+Index('dsp_classified_join_index', DSP.date, DSP.brand_key)
+
+# Replacing a date range of a single DSP file, see Worker.upload
+Index('dsp_classified_source_index', DSP.source, DSP.date)
+
+# The unidentified rows of some campaigns, see utils.unclassified_helper
+Index('dsp_classified_brand_index', DSP.brand_key, DSP.campaign_key)
 
 
 class DSPRaw(db.Model):
@@ -97,13 +109,17 @@ class DSPRaw(db.Model):
     """
 
     __tablename__ = 'dsp_raw'
-    id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, nullable=False)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # the partition key must be part of the primary key
+    date = db.Column(db.DateTime, primary_key=True)
+    # md5 of the dimensions, see webapp.app.queries.ROW_KEYS
+    row_key = db.Column(db.BINARY(16), nullable=False)
     campaign_id = db.Column(db.Integer, nullable=False)
     campaign = db.Column(db.String(75), nullable=False)
     impressions = db.Column(db.Float, nullable=False)
     clicks = db.Column(db.Integer, nullable=False)
     cost = db.Column(db.Float, nullable=False)
+    source = db.Column(db.String(25), nullable=False, server_default="")
     created_at = db.Column(db.DateTime, nullable=False,
                            server_default=func.now())
     updated_at = db.Column(db.DateTime, nullable=False,
@@ -111,8 +127,10 @@ class DSPRaw(db.Model):
 
 
 # Create an index to not allow reapeated values on these dimensions
-Index('dsp_raw_index', DSPRaw.date, DSPRaw.campaign_id, DSPRaw.campaign,
-      unique=True)
+Index('dsp_raw_index', DSPRaw.row_key, DSPRaw.date, unique=True)
+
+# Replacing a date range of a single DSP file, see Worker.upload
+Index('dsp_raw_source_index', DSPRaw.source, DSPRaw.date)
 
 
 class Report(db.Model):
@@ -121,8 +139,14 @@ class Report(db.Model):
     """
 
     __tablename__ = 'report'
-    id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, nullable=False)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # the partition key must be part of the primary key
+    date = db.Column(db.DateTime, primary_key=True)
+    # md5 of the dimensions, see webapp.app.queries.ROW_KEYS
+    row_key = db.Column(db.BINARY(16), nullable=False)
+    brand_key = db.Column(db.Integer, nullable=False)
+    ad_campaign_key = db.Column(db.Integer, nullable=False)
+    dsp_campaign_key = db.Column(db.Integer, nullable=False)
     brand = db.Column(db.String(25), nullable=False)
     sub_brand = db.Column(db.String(25), nullable=False)
     ad_campaign_id = db.Column(db.Integer, nullable=False)
@@ -165,9 +189,242 @@ class Report(db.Model):
 
 
 # Create an index to not allow reapeated values on these dimensions
-Index('report_index', Report.date, Report.brand, Report.sub_brand,
-      Report.ad_campaign_id, Report.ad_campaign, Report.dsp,
-      Report.dsp_campaign_id, Report.dsp_campaign, unique=True)
+Index('report_index', Report.row_key, Report.date, unique=True)
+
+# Date range reads from the dashboard, filtered by brand and dsp (see the
+# /report filters), the date alone is the prefix of the first
+Index('report_date_brand_index', Report.date, Report.brand, Report.sub_brand,
+      Report.dsp)
+Index('report_date_campaign_index', Report.date, Report.ad_campaign_id,
+      Report.dsp_campaign_id)
+
+
+class Rollup(db.Model):
+    """
+    Create a rollups table, the report summed by week and month, and by
+    brand only (day, week and month), see utils.rollup_helper
+    """
+
+    __tablename__ = 'report_rollups'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # day, week or month
+    period = db.Column(db.String(5), nullable=False)
+    # campaign or brand, the brand level has no campaign keys (zero)
+    level = db.Column(db.String(8), nullable=False)
+    # the first day of the period
+    date = db.Column(db.DateTime, nullable=False)
+    brand_key = db.Column(db.Integer, nullable=False)
+    ad_campaign_key = db.Column(db.Integer, nullable=False)
+    dsp_campaign_key = db.Column(db.Integer, nullable=False)
+    brand = db.Column(db.String(25), nullable=False)
+    sub_brand = db.Column(db.String(25), nullable=False)
+    ad_campaign_id = db.Column(db.Integer, nullable=False)
+    ad_campaign = db.Column(db.String(75), nullable=False)
+    dsp = db.Column(db.String(25), nullable=False)
+    dsp_campaign_id = db.Column(db.Integer, nullable=False)
+    dsp_campaign = db.Column(db.String(75), nullable=False)
+    ad_impressions = db.Column(db.Float, nullable=False)
+    ad_clicks = db.Column(db.Integer, nullable=False)
+    ad_reach = db.Column(db.Float, nullable=False)
+    dsp_impressions = db.Column(db.Float, nullable=False)
+    dsp_clicks = db.Column(db.Integer, nullable=False)
+    dsp_cost = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           server_default=func.now(), onupdate=func.now())
+
+
+# Create an index to not allow reapeated values on these dimensions
+Index('report_rollups_index', Rollup.period, Rollup.level, Rollup.date,
+      Rollup.brand_key, Rollup.ad_campaign_key, Rollup.dsp_campaign_key,
+      unique=True)
+
+# Aggregates grouped by dsp and brand, see utils.rollup_helper.aggregate
+Index('report_rollups_dims_index', Rollup.period, Rollup.level, Rollup.date,
+      Rollup.dsp, Rollup.brand, Rollup.sub_brand)
+
+
+class DirtyDate(db.Model):
+    """
+    Create a dirty dates table, the dates touched by the workers since the
+    last report generation
+    """
+
+    __tablename__ = 'dirty_dates'
+    date = db.Column(db.DateTime, primary_key=True)
+    marked_at = db.Column(db.DateTime, nullable=False,
+                          server_default=func.now())
+
+
+class ReportMeta(db.Model):
+    """
+    Create a report meta table, a single row describing the current report
+    data, see utils.meta_helper
+    """
+
+    __tablename__ = 'report_meta'
+    id = db.Column(db.Integer, primary_key=True)
+    # bumped whenever the report is generated, the web caches depend on it
+    version = db.Column(db.Integer, nullable=False)
+    # the last generation, incremental, full or rebuild, its duration in
+    # seconds, and the report rows it wrote
+    generated_at = db.Column(db.DateTime)
+    mode = db.Column(db.String(11))
+    duration = db.Column(db.Float)
+    report_rows = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           server_default=func.now(), onupdate=func.now())
+
+
+class Rebuild(db.Model):
+    """
+    Create a rebuilds table, the duration and row counts of each rebuild of
+    the classified and report tables, see utils.rebuild_helper
+    """
+
+    __tablename__ = 'rebuilds'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    started_at = db.Column(db.DateTime, nullable=False)
+    duration = db.Column(db.Float, nullable=False)
+    dcm_rows = db.Column(db.Integer, nullable=False)
+    dsp_rows = db.Column(db.Integer, nullable=False)
+    report_rows = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           server_default=func.now())
+
+    @property
+    def serialize(self):
+        """Return object data in serializeable format"""
+        return {
+            "started_at": self.started_at.isoformat(),
+            "duration": self.duration,
+            "dcm_rows": self.dcm_rows,
+            "dsp_rows": self.dsp_rows,
+            "report_rows": self.report_rows
+        }
+
+
+class Job(db.Model):
+    """
+    Create a jobs table, the background jobs started by the web app (the
+    rebuild of the classified and report tables), see utils.job_helper
+    """
+
+    __tablename__ = 'jobs'
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(25), nullable=False)
+    # queued, running, done or failed
+    status = db.Column(db.String(8), nullable=False)
+    stage = db.Column(db.String(25))
+    # the rows generated so far
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    # the seconds it is expected to take, for the ETA
+    expected = db.Column(db.Float)
+    error = db.Column(db.Text)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           server_default=func.now())
+
+
+class UnclassifiedKey(db.Model):
+    """
+    Create an unclassified keys table, the campaign and placement keys of
+    each source with unidentified brand, sub brand or dsp rows, and their
+    impact, see utils.unclassified_helper
+    """
+
+    __tablename__ = 'unclassified_keys'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # dcm or the DSP name
+    source = db.Column(db.String(25), nullable=False)
+    campaign_key = db.Column(db.Integer, nullable=False)
+    # DSP rows have no placement (zero)
+    placement_key = db.Column(db.Integer, nullable=False)
+    campaign_id = db.Column(db.Integer, nullable=False)
+    campaign = db.Column(db.String(75), nullable=False)
+    placement_id = db.Column(db.Integer)
+    placement = db.Column(db.String(75))
+    # which of the fields are unidentified in any of its rows
+    missing_brand = db.Column(db.Boolean, nullable=False)
+    missing_sub_brand = db.Column(db.Boolean, nullable=False)
+    missing_dsp = db.Column(db.Boolean, nullable=False)
+    # the dates of its first and last unidentified rows, their count and
+    # metrics, DCM rows have no cost (zero)
+    first_seen = db.Column(db.Date, nullable=False)
+    last_seen = db.Column(db.Date, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    impressions = db.Column(db.Float, nullable=False)
+    clicks = db.Column(db.Integer, nullable=False)
+    cost = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           server_default=func.now(), onupdate=func.now())
+
+
+# Create an index to not allow reapeated values on these dimensions
+Index('unclassified_keys_index', UnclassifiedKey.source,
+      UnclassifiedKey.campaign_key, UnclassifiedKey.placement_key,
+      unique=True)
+
+# The review queue is read sorted by impact, see
+# utils.unclassified_helper.SORTS
+Index('unclassified_keys_cost_index', UnclassifiedKey.cost,
+      UnclassifiedKey.impressions)
+Index('unclassified_keys_impressions_index', UnclassifiedKey.impressions)
+Index('unclassified_keys_rows_index', UnclassifiedKey.row_count)
+
+
+class Brand(db.Model):
+    """
+    Create a brands dimension, each brand, sub brand, and dsp combination
+    has an integer surrogate key used by the fact tables
+    """
+
+    __tablename__ = 'brands'
+    id = db.Column(db.Integer, primary_key=True)
+    brand = db.Column(db.String(25), nullable=False)
+    sub_brand = db.Column(db.String(25), nullable=False)
+    dsp = db.Column(db.String(25), nullable=False)
+
+
+# Create an index to not allow reapeated values on these dimensions
+Index('brands_index', Brand.brand, Brand.sub_brand, Brand.dsp, unique=True)
+
+
+class Campaign(db.Model):
+    """
+    Create a campaigns dimension, shared by DCM and DSP campaigns
+    """
+
+    __tablename__ = 'campaigns'
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, nullable=False)
+    campaign = db.Column(db.String(75), nullable=False)
+
+
+# Create an index to not allow reapeated values on these dimensions
+Index('campaigns_index', Campaign.campaign_id, Campaign.campaign,
+      unique=True)
+
+
+class Placement(db.Model):
+    """
+    Create a placements dimension (DCM only)
+    """
+
+    __tablename__ = 'placements'
+    id = db.Column(db.Integer, primary_key=True)
+    placement_id = db.Column(db.Integer, nullable=False)
+    placement = db.Column(db.String(75), nullable=False)
+
+
+# Create an index to not allow reapeated values on these dimensions
+Index('placements_index', Placement.placement_id, Placement.placement,
+      unique=True)
+
+
+# The fact tables are partitioned by month, see utils.partition_helper
+for model in [DCM, DCMRaw, DSP, DSPRaw, Report]:
+    event.listen(model.__table__, 'after_create', partition_on_create)
 
 
 class Classification(db.Model):
@@ -185,6 +442,14 @@ class Classification(db.Model):
     use_campaign = db.Column(db.Boolean, nullable=False, default=False)
     use_placement_id = db.Column(db.Boolean, nullable=False, default=False)
     use_placement = db.Column(db.Boolean, nullable=False, default=False)
+    # the matches tried by the workers and their time, and whether a match
+    # went over the budget, see utils.regex_helper.RuleStats
+    match_calls = db.Column(db.BigInteger, nullable=False, default=0,
+                            server_default="0")
+    match_seconds = db.Column(db.Float, nullable=False, default=0,
+                              server_default="0")
+    quarantined = db.Column(db.Boolean, nullable=False, default=False,
+                            server_default="0")
     created_at = db.Column(db.DateTime, nullable=False,
                            server_default=func.now())
     updated_at = db.Column(db.DateTime, nullable=False,
@@ -1,8 +1,51 @@
 # -*- coding: utf-8 -*-
+
+# The dimensions hashed into the `row_key` of each fact table, the unique
+# index is on the `row_key` (plus `date`, required by the partitioning). The
+# DSP tables are shared by all DSPs, so the source is part of their keys
+ROW_KEYS = {
+    "dcm_raw": ["date", "campaign_id", "campaign", "placement_id",
+                "placement"],
+    "dsp_raw": ["date", "source", "campaign_id", "campaign"],
+    "dcm_classified": ["date", "brand_key", "campaign_key", "placement_key"],
+    "dsp_classified": ["date", "source", "brand_key", "campaign_key"],
+    "report": ["date", "brand_key", "ad_campaign_key", "dsp_campaign_key"]
+}
+
+
+def statements(script):
+    """the statements of a `;` separated script, to be executed one by one"""
+    return [s.strip() for s in script.split(";") if s.strip()]
+
+
+def row_key(expressions):
+    """
+    Params
+    ------
+    expressions : array_like
+        the sql expressions of the dimensions in `ROW_KEYS` order, the first
+        one must be the date
+
+    Returns
+    -------
+    the sql expression of a BINARY(16) md5 of the dimensions, the texts are
+    compared like the MySQL collation does, without case and trailing
+    spaces, so `Acme ` and `acme` are the same row
+    """
+    parts = ["DATE({})".format(expressions[0])] + [
+        "LOWER(RTRIM({}))".format(e) for e in expressions[1:]]
+    return "UNHEX(MD5(CONCAT_WS('|', {})))".format(", ".join(parts))
+
+
 GENERATE_CLASSIFIED = """
-INSERT INTO
-    dcm_classified (date, brand, sub_brand, dsp, campaign_id, campaign,
-                    placement, placement_id, impressions, clicks, reach)
+INSERT IGNORE INTO
+    campaigns (campaign_id, campaign)
+    SELECT DISTINCT campaign_id, campaign FROM dcm_raw;
+INSERT IGNORE INTO
+    placements (placement_id, placement)
+    SELECT DISTINCT placement_id, placement FROM dcm_raw;
+CREATE TEMPORARY TABLE
+    dcm_classified_stage
     SELECT
         date,
         brand,
@@ -81,6 +124,8 @@ INSERT INTO
                                     dcm_raw AS dcm
                                     CROSS JOIN
                                         classifications AS cls
+                                WHERE
+                                    NOT cls.quarantined
                                 HAVING
                                     composed REGEXP pattern
                             )
@@ -97,9 +142,47 @@ INSERT INTO
                     ON raw.id = classified.id
         )
         AS big_join;
+INSERT IGNORE INTO
+    brands (brand, sub_brand, dsp)
+    SELECT DISTINCT brand, sub_brand, dsp FROM dcm_classified_stage;
 INSERT INTO
-    dsp_classified (date, brand, sub_brand, dsp, campaign_id, campaign,
-                    impressions, clicks, cost)
+    dcm_classified (date, brand_key, campaign_key, placement_key,
+                    impressions, clicks, reach, row_key)
+    SELECT
+        stage.date,
+        brands.id,
+        campaigns.id,
+        placements.id,
+        stage.impressions,
+        stage.clicks,
+        stage.reach,
+        {dcm_row_key}
+    FROM
+        dcm_classified_stage AS stage
+        JOIN
+            brands
+            ON brands.brand = stage.brand
+            AND brands.sub_brand = stage.sub_brand
+            AND brands.dsp = stage.dsp
+        JOIN
+            campaigns
+            ON campaigns.campaign_id = stage.campaign_id
+            AND campaigns.campaign = stage.campaign
+        JOIN
+            placements
+            ON placements.placement_id = stage.placement_id
+            AND placements.placement = stage.placement
+    ON DUPLICATE KEY
+    UPDATE
+        dcm_classified.impressions = stage.impressions,
+        dcm_classified.clicks = stage.clicks,
+        dcm_classified.reach = stage.reach;
+DROP TEMPORARY TABLE dcm_classified_stage;
+INSERT IGNORE INTO
+    campaigns (campaign_id, campaign)
+    SELECT DISTINCT campaign_id, campaign FROM dsp_raw;
+CREATE TEMPORARY TABLE
+    dsp_classified_stage
     SELECT
         date,
         brand,
@@ -109,7 +192,8 @@ INSERT INTO
         campaign,
         impressions,
         clicks,
-        cost
+        cost,
+        source
     FROM
         (
             SELECT
@@ -122,7 +206,8 @@ INSERT INTO
                 raw.campaign,
                 raw.impressions,
                 raw.clicks,
-                raw.cost
+                raw.cost,
+                raw.source
             FROM
                 dsp_raw AS raw
                 LEFT JOIN
@@ -164,6 +249,8 @@ INSERT INTO
                                     dsp_raw AS dsp
                                     CROSS JOIN
                                         classifications AS cls
+                                WHERE
+                                    NOT cls.quarantined
                                 HAVING
                                     composed REGEXP pattern
                             )
@@ -178,71 +265,173 @@ INSERT INTO
                     ON raw.id = classified.id
         )
         AS big_join;
+INSERT IGNORE INTO
+    brands (brand, sub_brand, dsp)
+    SELECT DISTINCT brand, sub_brand, dsp FROM dsp_classified_stage;
+INSERT INTO
+    dsp_classified (date, brand_key, campaign_key, impressions, clicks, cost,
+                    source, row_key)
+    SELECT
+        stage.date,
+        brands.id,
+        campaigns.id,
+        stage.impressions,
+        stage.clicks,
+        stage.cost,
+        stage.source,
+        {dsp_row_key}
+    FROM
+        dsp_classified_stage AS stage
+        JOIN
+            brands
+            ON brands.brand = stage.brand
+            AND brands.sub_brand = stage.sub_brand
+            AND brands.dsp = stage.dsp
+        JOIN
+            campaigns
+            ON campaigns.campaign_id = stage.campaign_id
+            AND campaigns.campaign = stage.campaign
+    ON DUPLICATE KEY
+    UPDATE
+        dsp_classified.impressions = stage.impressions,
+        dsp_classified.clicks = stage.clicks,
+        dsp_classified.cost = stage.cost;
+DROP TEMPORARY TABLE dsp_classified_stage;
+""".format(dcm_row_key=row_key(["stage.date", "brands.id", "campaigns.id",
+                                "placements.id"]),
+           dsp_row_key=row_key(["stage.date", "stage.source", "brands.id",
+                                "campaigns.id"]))
+
+# each side is aggregated by its own keys before the join, so a DCM row is
+# never repeated for every DSP row of the same brand (and vice versa)
+REPORT_STAGES = """
+CREATE TEMPORARY TABLE
+    report_dcm_stage
+    AS SELECT
+        date,
+        brand_key,
+        campaign_key,
+        SUM(impressions) AS impressions,
+        SUM(clicks) AS clicks,
+        SUM(reach) AS reach
+    FROM
+        dcm_classified{date_filter}
+    GROUP BY
+        date,
+        brand_key,
+        campaign_key;
+CREATE INDEX report_dcm_stage_index ON report_dcm_stage (date, brand_key);
+CREATE TEMPORARY TABLE
+    report_dsp_stage
+    AS SELECT
+        date,
+        brand_key,
+        campaign_key,
+        SUM(impressions) AS impressions,
+        SUM(clicks) AS clicks,
+        SUM(cost) AS cost
+    FROM
+        dsp_classified{date_filter}
+    GROUP BY
+        date,
+        brand_key,
+        campaign_key;
+CREATE INDEX report_dsp_stage_index ON report_dsp_stage (date, brand_key);
 """
 
-GENERATE_REPORT = """
+# both stages are unique on their keys, so the join is already at the
+# grain of the report
+REPORT_INSERT = """
 INSERT INTO
-    report (date, brand, sub_brand, ad_campaign_id, ad_campaign,
-            dsp_campaign_id, dsp, dsp_campaign, ad_impressions, ad_clicks,
-            ad_reach, dsp_impressions, dsp_clicks, dsp_cost)
+    report (date, brand_key, ad_campaign_key, dsp_campaign_key, brand,
+            sub_brand, dsp, ad_campaign_id, ad_campaign, dsp_campaign_id,
+            dsp_campaign, ad_impressions, ad_clicks, ad_reach,
+            dsp_impressions, dsp_clicks, dsp_cost, row_key)
     SELECT
-        date,
-        brand,
-        sub_brand,
-        ad_campaign_id,
-        ad_campaign,
-        dsp_campaign_id,
-        dsp,
-        dsp_campaign,
-        ad_impressions,
-        ad_clicks,
-        ad_reach,
-        dsp_impressions,
-        dsp_clicks,
-        dsp_cost
+        big_join.date,
+        big_join.brand_key,
+        big_join.ad_campaign_key,
+        big_join.dsp_campaign_key,
+        brands.brand,
+        brands.sub_brand,
+        brands.dsp,
+        ad.campaign_id,
+        ad.campaign,
+        ifnull(dsp.campaign_id, 0),
+        ifnull(dsp.campaign, ''),
+        big_join.ad_impressions,
+        big_join.ad_clicks,
+        big_join.ad_reach,
+        big_join.dsp_impressions,
+        big_join.dsp_clicks,
+        big_join.dsp_cost,
+        {report_row_key}
     FROM
         (
             SELECT
                 dcm.date AS date,
-                dcm.brand AS brand,
-                dcm.sub_brand AS sub_brand,
-                dcm.campaign_id AS ad_campaign_id,
-                dcm.campaign AS ad_campaign,
-                dcm.dsp AS dsp,
-                dsp.campaign_id AS dsp_campaign_id,
-                dsp.campaign AS dsp_campaign,
-                SUM(dcm.impressions) AS ad_impressions,
-                SUM(dcm.clicks) AS ad_clicks,
-                SUM(dcm.reach) AS ad_reach,
-                SUM(dsp.impressions) AS dsp_impressions,
-                SUM(dsp.clicks) AS dsp_clicks,
-                SUM(dsp.cost) AS dsp_cost
+                dcm.brand_key AS brand_key,
+                dcm.campaign_key AS ad_campaign_key,
+                ifnull(dsp.campaign_key, 0) AS dsp_campaign_key,
+                dcm.impressions AS ad_impressions,
+                dcm.clicks AS ad_clicks,
+                dcm.reach AS ad_reach,
+                ifnull(dsp.impressions, 0) AS dsp_impressions,
+                ifnull(dsp.clicks, 0) AS dsp_clicks,
+                ifnull(dsp.cost, 0) AS dsp_cost
             FROM
-                dcm_classified AS dcm
+                report_dcm_stage AS dcm
                 LEFT JOIN
-                    dsp_classified AS dsp
+                    report_dsp_stage AS dsp
                     ON dcm.date = dsp.date
-                    AND dcm.brand = dsp.brand
-                    AND dcm.sub_brand = dsp.sub_brand
-                    AND dcm.dsp = dsp.dsp
-            GROUP BY
-                dcm.date,
-                dcm.brand,
-                dcm.sub_brand,
-                dcm.campaign_id,
-                dcm.campaign,
-                dcm.dsp,
-                dsp.campaign_id,
-                dsp.campaign
+                    AND dcm.brand_key = dsp.brand_key
         )
         AS big_join
-        ON DUPLICATE KEY
-        UPdate
-            report.ad_impressions = big_join.ad_impressions,
-            report.ad_clicks = big_join.ad_clicks,
-            report.ad_reach = big_join.ad_reach,
-            report.dsp_impressions = big_join.dsp_impressions,
-            report.dsp_clicks = big_join.dsp_clicks,
-            report.dsp_cost = big_join.dsp_cost,
-            report.updated_at = CURRENT_TIMESTAMP();
+        JOIN
+            brands
+            ON brands.id = big_join.brand_key
+        JOIN
+            campaigns AS ad
+            ON ad.id = big_join.ad_campaign_key
+        LEFT JOIN
+            campaigns AS dsp
+            ON dsp.id = big_join.dsp_campaign_key
+    ON DUPLICATE KEY
+    UPDATE
+        report.ad_impressions = big_join.ad_impressions,
+        report.ad_clicks = big_join.ad_clicks,
+        report.ad_reach = big_join.ad_reach,
+        report.dsp_impressions = big_join.dsp_impressions,
+        report.dsp_clicks = big_join.dsp_clicks,
+        report.dsp_cost = big_join.dsp_cost,
+        report.updated_at = CURRENT_TIMESTAMP();
+""".format(report_row_key=row_key(["big_join.date", "big_join.brand_key",
+                                   "big_join.ad_campaign_key",
+                                   "big_join.dsp_campaign_key"]))
+
+REPORT_DROP_STAGES = """
+DROP TABLE report_dcm_stage;
+DROP TABLE report_dsp_stage;
+"""
+
+# the whole report
+GENERATE_REPORT = (REPORT_STAGES.format(date_filter="") + REPORT_INSERT +
+                   REPORT_DROP_STAGES)
+
+# only the dates marked as dirty before the generation `:started`
+DIRTY_DATES = "SELECT date FROM dirty_dates WHERE marked_at < :started"
+
+CLEAN_DIRTY_DATES = """
+DELETE FROM dirty_dates WHERE marked_at < :started;
+"""
+
+# the slices read by the pandas report engine, see workers.worker
+REPORT_DCM_SLICE = """
+SELECT date, brand_key, campaign_key, impressions, clicks, reach
+FROM dcm_classified{date_filter}
+"""
+
+REPORT_DSP_SLICE = """
+SELECT date, brand_key, campaign_key, impressions, clicks, cost
+FROM dsp_classified{date_filter}
 """
@@ -8,11 +8,6 @@ import time
 import argparse
 import logging
 
-# local imports
-from utils.sql_helper import initialize_database
-from utils.bucket_helper import BucketHelper
-from workers.worker import DcmWorker, DspWorker, Manager, generate_report
-
 ############################################################################
 str_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(level=logging.DEBUG,
@@ -46,7 +41,10 @@ def create_parser():
                         help="""It might be 'init for initialize the database
                         or 'serve' for serving the web app. The default is
                         work, which is about puting a worker to run its
-                        task.""", default="work", nargs='?', const=1)
+                        task. 'partition' rolls the monthly partitions of
+                        the fact tables forward. 'rebuild' classifies all the
+                        raw data again and regenerates the report.""",
+                        default="work", nargs='?', const=1)
     parser.add_argument("--worker", "-w",
                         type=str, help="The worker to execute",
                         choices=['dcm', 'dsp'])
@@ -55,6 +53,13 @@ def create_parser():
                         action=ChangeWorker)
     parser.add_argument("--generate-report", "-g", help="Generate report",
                         required=False, default=False, action='store_true')
+    parser.add_argument("--full", "-f", help="""Generate the whole report, not
+                        only the dates changed since the last one""",
+                        required=False, default=False, action='store_true')
+    parser.add_argument("--engine", "-e", type=str,
+                        help="""The report engine, 'sql' runs in the database
+                        and 'pandas' in this process""",
+                        choices=['sql', 'pandas'], required=False)
     parser.add_argument("--port", "-p", type=int,
                         help="The port for serve the web app",
                         default=8080, required=False)
@@ -63,6 +68,9 @@ def create_parser():
                         default=20, required=False)
     parser.add_argument("--poke", "-k", type=str, help="Add msg to queue",
                         required=False)
+    parser.add_argument("--months", "-m", type=int,
+                        help="Months to be partitioned in advance",
+                        default=3, required=False)
     return parser
 
 
@@ -75,36 +83,59 @@ def manager(args):
     args : array_like
         a list of arguments
 
+    the imports are done inside each action, so lightweight actions like
+    `--poke` do not pay for pandas, flask, or a database connection
     """
     action = args.action.lower()
     if action == "init":
+        from utils.sql_helper import initialize_database
         logger.info("Initializing the environment")
         initialize_database()
 
+    elif action == "partition":
+        from utils.sql_helper import get_connection
+        from utils.partition_helper import partition_tables
+        logger.info("Partitioning tables")
+        partition_tables(get_connection(), months_ahead=args.months)
+
+    elif action == "rebuild":
+        from utils.sql_helper import get_connection
+        from utils.rebuild_helper import rebuild_tables
+        logger.info("Rebuilding classified and report tables")
+        rebuild_tables(get_connection())
+
     elif action == "work":
         if args.generate_report:
+            from workers.worker import generate_report
             logger.info("Generating report")
-            generate_report()
+            generate_report(full=args.full, engine=args.engine)
         elif args.poke:
+            from workers.manager import Manager
             with Manager() as m:
                 m.schedule_task(args.poke)
         else:
+            from utils.bucket_helper import BucketHelper
+            from workers.worker import (DcmWorker, DspWorker,
+                                        ClassificationSnapshot)
             worker = args.worker.lower()
+            snapshot = ClassificationSnapshot.load()
+            logger.info("Using classification snapshot [{}]".format(
+                snapshot.version))
             workers = []
             if worker == 'dcm':
                 logger.info("Triggering DCM worker")
-                workers.append(DcmWorker())
+                workers.append(DcmWorker(snapshot=snapshot))
             elif args.dsp:
                 dsp = args.dsp.lower()
                 logger.info("Triggering DSP worker [{}]".format(dsp))
-                workers.append(DspWorker(dsp))
+                workers.append(DspWorker(dsp, snapshot=snapshot))
             else:
                 logger.info("Triggering DSP workers")
                 dsp_opts = BucketHelper.dsp_available()
                 logger.info("Found [{}]".format(", ".join(dsp_opts)))
                 for opt in dsp_opts:
                     logger.info("Creating structure for [{}]".format(opt))
-                    workers.append(DspWorker(opt))
+                    workers.append(DspWorker(opt, snapshot=snapshot))
             for w in workers:
                 w.extract().transform().load()
 
@@ -120,6 +151,7 @@ def manager(args):
             logger.exception(err)
 
     elif action == "operate":
+        from workers.manager import Manager
         logger.info("Operation requested")
         delay = args.delay
         while True:
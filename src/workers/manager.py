@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+The MQ manager, it schedules tasks and consumes them
+"""
+
+# python standard
+import logging
+
+# third-party imports
+import pika
+
+# local imports
+from utils.config_helper import ConfigHelper
+
+############################################################################
+logger = logging.getLogger('dspreview_application')
+############################################################################
+
+
+class Manager(object):
+    def __enter__(self):
+        try:
+            mq = ConfigHelper.shared().mq()
+            credentials = pika.PlainCredentials(mq.user, mq.password)
+            self.queue = mq.queue
+            parameters = pika.ConnectionParameters(host=mq.host, port=mq.port,
+                                                   virtual_host=mq.vhost,
+                                                   credentials=credentials)
+            self.connection = pika.BlockingConnection(parameters)
+            self.channel = self.connection.channel()
+            self.channel.queue_declare(queue=self.queue, durable=True)
+        except Exception as err:
+            logger.exception(err)
+            raise Exception("""It was not possible to connect to the MQ,
+                            please check the connection information""")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.connection.close()
+
+    def schedule_task(self, task):
+        self.channel.basic_publish(exchange='',
+                                   routing_key=self.queue,
+                                   body=task,
+                                   properties=pika.BasicProperties(
+                                           delivery_mode=2,))
+
+    def check_schedule(self):
+        self.channel.queue_declare(queue=self.queue, durable=True)
+
+        # the workers are heavy (pandas, flask, sql...), they are only
+        # imported by the consumer, never by the producer
+        from utils.bucket_helper import BucketHelper
+        from utils.job_helper import JOB_MESSAGE, run_job
+        from workers.worker import (DcmWorker, DspWorker, generate_report,
+                                    ClassificationSnapshot)
+
+        def callback(ch, method, properties, body):
+            body = body.decode("utf-8").lower()
+            logger.info(">>> Received {}".format(body))
+
+            if body.startswith(JOB_MESSAGE):
+                run_job(body[len(JOB_MESSAGE):])
+            elif body == "report":
+                generate_report()
+            elif body == "report.full":
+                generate_report(full=True)
+            else:
+                snapshot = ClassificationSnapshot.load()
+                logger.info("Using classification snapshot [{}]".format(
+                    snapshot.version))
+                workers = []
+                if body == 'dcm':
+                    logger.info("Triggering DCM worker")
+                    workers.append(DcmWorker(snapshot=snapshot))
+                elif "." in body:
+                    _, dsp = body.split(".")
+                    logger.info("Triggering DSP worker [{}]".format(dsp))
+                    workers.append(DspWorker(dsp, snapshot=snapshot))
+                else:
+                    logger.info("Triggering DSP workers")
+                    dsp_opts = BucketHelper.dsp_available()
+                    logger.info("Found [{}]".format(", ".join(dsp_opts)))
+                    for opt in dsp_opts:
+                        logger.info("Creating structure for [{}]".format(opt))
+                        workers.append(DspWorker(opt, snapshot=snapshot))
+                for w in workers:
+                    w.extract().transform().load()
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            logger.info("<<< Success :)")
+
+        self.channel.basic_qos(prefetch_count=1)
+        self.channel.basic_consume(callback, queue=self.queue)
+        self.channel.start_consuming()
+
+    def route_task(self):
+        pass
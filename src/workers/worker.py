@@ -2,94 +2,234 @@
 
 # python standard
 import re
+import time
+import hashlib
 import logging
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # third-party imports
 import pandas as pd
-from sqlalchemy import and_
-import pika
+from sqlalchemy import text, select, bindparam, tuple_
 
 # local imports
 from utils.bucket_helper import BucketHelper
 from utils.config_helper import ConfigHelper
 from utils.sql_helper import get_connection, get_context
-from webapp.app.models import Classification
-from webapp.app.queries import GENERATE_REPORT
+from utils.rollup_helper import refresh_rollups
+from utils.meta_helper import bump_report_version
+from utils.rebuild_helper import rebuild_lock
+from utils.pattern_helper import KEY_NAMES, compose, flags
+from utils.regex_helper import RuleStats
+from utils.unclassified_helper import (UNIDENTIFIED, keys_in_range,
+                                       refresh_unclassified)
+from webapp.app.models import Classification, Brand, Campaign, Placement
+from webapp.app.queries import (REPORT_STAGES, REPORT_INSERT,
+                                REPORT_DROP_STAGES, CLEAN_DIRTY_DATES,
+                                DIRTY_DATES,
+                                REPORT_DCM_SLICE, REPORT_DSP_SLICE, ROW_KEYS,
+                                row_key, statements)
 
 ############################################################################
 logger = logging.getLogger('dspreview_application')
-con = get_connection()
+_con = None
 ############################################################################
 
+# how a file is written in the database, see `Worker.upload`
+LOAD_MODES = ("upsert", "replace")
 
-class Manager(object):
-    def __enter__(self):
-        try:
-            config = ConfigHelper()
-            credentials = pika.PlainCredentials(config.get_config("MQ_USER"),
-                                                config.get_config("MQ_PASS"))
-            host = config.get_config("MQ_HOST")
-            port = config.get_config("MQ_PORT")
-            vhost = config.get_config("MQ_VHOST")
-            self.queue = config.get_config("MQ_QUEUE")
-            parameters = pika.ConnectionParameters(host=host, port=port,
-                                                   virtual_host=vhost,
-                                                   credentials=credentials)
-            self.connection = pika.BlockingConnection(parameters)
-            self.channel = self.connection.channel()
-            self.channel.queue_declare(queue=self.queue, durable=True)
-        except Exception as err:
-            logger.exception(err)
-            raise Exception("""It was not possible to connect to the MQ,
-                            please check the connection information""")
-        return self
+# how the report is generated, see `generate_report`
+REPORT_ENGINES = ("sql", "pandas")
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.connection.close()
+REPORT_COLUMNS = [
+    "date", "brand_key", "ad_campaign_key", "dsp_campaign_key", "brand",
+    "sub_brand", "dsp", "ad_campaign_id", "ad_campaign", "dsp_campaign_id",
+    "dsp_campaign", "ad_impressions", "ad_clicks", "ad_reach",
+    "dsp_impressions", "dsp_clicks", "dsp_cost"
+]
 
-    def schedule_task(self, task):
-        self.channel.basic_publish(exchange='',
-                                   routing_key=self.queue,
-                                   body=task,
-                                   properties=pika.BasicProperties(
-                                           delivery_mode=2,))
 
-    def check_schedule(self):
-        self.channel.queue_declare(queue=self.queue, durable=True)
+def get_con():
+    """
+    The sql connection is created only when some worker needs it, so
+    importing this module does not touch the database
+    """
+    global _con
+    if _con is None:
+        _con = get_connection()
+    return _con
+
+
+ClassificationRule = namedtuple("ClassificationRule", [
+    "id",
+    "pattern",
+    "brand",
+    "sub_brand",
+    "dsp",
+    "use_campaign_id",
+    "use_campaign",
+    "use_placement_id",
+    "use_placement",
+    "updated_at"
+])
+
+
+class ClassificationSnapshot(object):
+    """
+    A frozen copy of the classification rules. It is fetched once per run
+    and shared by all the workers of that run, so every DSP is classified
+    with exactly the same rules even if they are edited in the meantime.
+    The time spent matching each rule is recorded in `stats`, the slow
+    rules are quarantined from the next snapshot on, never in the middle of
+    a run.
+    """
 
-        def callback(ch, method, properties, body):
-            body = body.decode("utf-8").lower()
-            logger.info(">>> Received {}".format(body))
+    def __init__(self, rules, stats=None):
+        """
+        Params
+        ------
+        rules : array_like
+            `ClassificationRule` items, in the order they must be applied
+        stats : utils.regex_helper.RuleStats
+            if None, a new one with the configured budget
+        """
+        self.rules = tuple(rules)
+        self.stats = stats or RuleStats()
+        # compiled once, so the time of the matches leaves compiling aside
+        self.regexes = {r.pattern: re.compile(r.pattern, re.IGNORECASE)
+                        for r in self.rules}
+        self.for_brand = [r for r in self.rules if r.brand]
+        self.for_sub_brand = [r for r in self.rules if r.sub_brand]
+        self.for_dsp = [r for r in self.rules if r.dsp]
+
+        stamps = [r.updated_at for r in self.rules if r.updated_at]
+        self.updated_at = max(stamps) if stamps else None
+
+        content = "\n".join(repr(r[:-1]) for r in self.rules)
+        self.digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    @property
+    def version(self):
+        """a stamp like `2018-09-01T10:00:00-1a2b3c4d5e6f`"""
+        stamp = self.updated_at.isoformat() if self.updated_at else "empty"
+        return "{}-{}".format(stamp, self.digest[:12])
+
+    @classmethod
+    def load(cls):
+        """
+        Fetch all the classifications in a single query, but the
+        quarantined ones
+
+        Returns
+        -------
+        A new `ClassificationSnapshot`
+        """
+        logger.info("Loading classification snapshot")
+        with get_context():
+            rows = Classification.query.filter_by(quarantined=False) \
+                .order_by(Classification.id).all()
+            rules = [ClassificationRule(*[getattr(row, f) for f in
+                                          ClassificationRule._fields])
+                     for row in rows]
+        return cls(rules)
 
-            if body == "report":
-                generate_report()
-            else:
-                workers = []
-                if body == 'dcm':
-                    logger.info("Triggering DCM worker")
-                    workers.append(DcmWorker())
-                elif "." in body:
-                    _, dsp = body.split(".")
-                    logger.info("Triggering DSP worker [{}]".format(dsp))
-                    workers.append(DspWorker(dsp))
-                else:
-                    logger.info("Triggering DSP workers")
-                    dsp_opts = BucketHelper.dsp_available()
-                    logger.info("Found [{}]".format(", ".join(dsp_opts)))
-                    for opt in dsp_opts:
-                        logger.info("Creating structure for [{}]".format(opt))
-                        workers.append(DspWorker(opt))
-                for w in workers:
-                    w.extract().transform().load()
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            logger.info("<<< Success :)")
-
-        self.channel.basic_qos(prefetch_count=1)
-        self.channel.basic_consume(callback, queue=self.queue)
-        self.channel.start_consuming()
-
-    def route_task(self):
-        pass
+
+def normalized(combination):
+    """
+    The `combination` as the MySQL collation compares it, the case and the
+    trailing spaces of the texts aside, so `Acme ` and `acme` are the same
+    """
+    return tuple(v.lower().rstrip() if isinstance(v, str) else v
+                 for v in combination)
+
+
+class Dimension(object):
+    """
+    A dimension table with an integer surrogate key. The keys are resolved
+    in bulk and cached in memory, so a file only reaches the database for
+    the combinations it has never seen before
+    """
+
+    def __init__(self, table, columns):
+        """
+        Params
+        ------
+        table : sqlalchemy.Table
+            the dimension table, with an `id` column
+        columns : array_like
+            the natural key columns, with the same names in the DataFrames
+        """
+        self.table = table
+        self.columns = list(columns)
+        self.keys = {}
+
+    def refresh(self, con):
+        """load the whole dimension, they are small compared to the facts"""
+        cols = [self.table.c[c] for c in self.columns]
+        rows = con.execute(select([self.table.c.id] + cols))
+        self.keys = {tuple(r[1:]): r[0] for r in rows}
+
+    def match(self, combinations, stored):
+        """
+        Take the keys of the `combinations` from the `stored` ones, a
+        dictionary of combinations and keys, by their `normalized` values.
+        MySQL ignores the case and the trailing spaces, so `Acme` is found
+        for `acme `, and both share its key
+        """
+        stored = {normalized(c): key for c, key in stored.items()}
+        for c in combinations:
+            key = stored.get(normalized(c))
+            if key is not None:
+                self.keys[c] = key
+
+    def lookup(self, con, combinations):
+        """read the keys of the `combinations` in a single query"""
+        cols = [self.table.c[c] for c in self.columns]
+        rows = con.execute(select([self.table.c.id] + cols).where(
+            tuple_(*cols).in_(combinations)))
+        self.match(combinations, {tuple(r[1:]): r[0] for r in rows})
+
+    def resolve(self, con, df):
+        """
+        Params
+        ------
+        con : sqlalchemy connection
+        df : pandas.DataFrame
+            it must have all the natural key columns
+
+        Returns
+        -------
+        A numpy array with the surrogate key of each row of `df`
+        """
+        unique = df[self.columns].drop_duplicates()
+        combinations = [tuple(r) for r in unique.itertuples(index=False)]
+        missing = [c for c in combinations if c not in self.keys]
+        if missing:
+            # it might have been created by another worker, maybe with
+            # another spelling, like `Acme` for `acme`
+            self.refresh(con)
+            self.match(missing, self.keys)
+            missing = [c for c in missing if c not in self.keys]
+        if missing:
+            # a single row for the spellings of the same combination
+            new = list({normalized(c): c for c in missing}.values())
+            logger.info("Adding [{}] new rows to [{}]".format(
+                len(new), self.table.name))
+            con.execute(self.table.insert().prefix_with("IGNORE",
+                                                        dialect="mysql"),
+                        [dict(zip(self.columns, c)) for c in new])
+            self.lookup(con, new)
+            self.match(missing, self.keys)
+
+        mapping = unique.assign(key=[self.keys[c] for c in combinations])
+        return df[self.columns].merge(mapping, how="left",
+                                      on=self.columns)["key"].values
+
+
+# the dimensions are shared by all the workers of the process
+BRANDS = Dimension(Brand.__table__, ["brand", "sub_brand", "dsp"])
+CAMPAIGNS = Dimension(Campaign.__table__, ["campaign_id", "campaign"])
+PLACEMENTS = Dimension(Placement.__table__, ["placement_id", "placement"])
 
 
 class Worker(object):
@@ -99,12 +239,19 @@ class Worker(object):
     It classifies their information regarded to brand, sub brand, and dsp.
     """
 
-    def __init__(self):
+    def __init__(self, snapshot=None):
+        """
+        Params
+        ------
+        snapshot : ClassificationSnapshot
+            the classification rules to be used, workers of the same run
+            should share it. If None, a new one is loaded
+        """
         self.dfs = []
         self.dfs_classified = []
         self.pattern = None
         self.dsp = None
-        self.load_classifications()
+        self.load_classifications(snapshot)
 
     def extract(self, pattern=None):
         """
@@ -146,15 +293,21 @@ class Worker(object):
 
     def load(self):
         """
-        Save data to database
+        Save data to database, and the time spent matching each
+        classification. The data waits for a running rebuild to finish, its
+        rows would be lost when the rebuilt tables are swapped in
 
         Returns
         -------
         The object instace for use in chain calls
         """
-        return self.upload(raw=True).upload()
+        con = get_con()
+        with rebuild_lock(con):
+            self.upload(raw=True).upload()
+        self.snapshot.stats.save(con)
+        return self
 
-    def upload(self, raw=False):
+    def upload(self, raw=False, mode=None):
         """this is a basic upload to the mysql database, since the schema
         is defined in src.utils.sql_helper, the DataFrames are expect to be
         in a very specific format, which must be assured by the parsers
@@ -164,6 +317,10 @@ class Worker(object):
         ------
         raw : boolean
             if True, it will upload only the raw data, without classifications
+        mode : string
+            'upsert' for updating row by row, or 'replace' for replacing the
+            whole date range of each file for this source. If None, the
+            configured `load_mode` is used
 
         Returns
         -------
@@ -176,55 +333,160 @@ class Worker(object):
             dfs = self.dfs
         else:
             logmsg = "Uploading [{}] [classified]".format(self.dsp or "DCM")
-            dims = self.dimensions
+            dims = ["date"] + list(self.dimension_keys.keys())
             table_type = 'classified'
             dfs = self.dfs_classified
 
-        logger.info(logmsg)
+        mode = mode or self.load_mode
+        if mode not in LOAD_MODES:
+            raise Exception("Unknown load mode [{}]".format(mode))
+
+        logger.info("{} [{}]".format(logmsg, mode))
         table = "{}_{}".format('dsp' if self.dsp else 'dcm', table_type)
         table_temp = "{}_temp".format(table)
+        columns = dims + self.metrics
+        if self.dsp:
+            # the dsp tables are shared by all DSPs, the source tells which
+            # DSP file each row came from
+            columns = columns + ["source"]
 
+        con = get_con()
         for df in dfs:
-            df.to_sql(con=con, name=table_temp,
-                      if_exists='replace', index=False)
-            update_part = []
-            for c in self.metrics:
-                update_part.append("{table}.{fld}={temp}.{fld}".format(
-                    table=table, temp=table_temp, fld=c))
-            update_part.append(
-                "{table}.updated_at=CURRENT_TIMESTAMP()".format(table=table))
-            update_part = ",".join(update_part)
-            all_columns = ",".join(dims+self.metrics)
-            connection = con.connect()
-            connection.execute("""INSERT INTO {table} ({all_cols})
-                                    SELECT {all_cols}
-                                    FROM {temp} ON DUPLICATE KEY
-                                    UPDATE
-                                    {updates}
-                                    """.format(table=table, temp=table_temp,
-                                               updates=update_part,
-                                               all_cols=all_columns))
-            connection.execute("DROP TABLE {temp}".format(temp=table_temp))
+            if self.dsp:
+                df = df.assign(source=self.dsp)
+            if not raw:
+                df = self.resolve_keys(con, df)
+            df[columns].to_sql(con=con, name=table_temp,
+                               if_exists='replace', index=False)
+            if mode == "replace":
+                self.replace_range(con, table, table_temp, columns, df)
+            else:
+                self.upsert(con, table, table_temp, columns)
+            con.execute("DROP TABLE {temp}".format(temp=table_temp))
+            if not raw:
+                self.mark_dirty(con, df, mode)
+                self.refresh_unclassified(con, df, mode)
         return self
 
+    def resolve_keys(self, con, df):
+        """
+        The classified tables keep only the surrogate keys of the brand,
+        campaign and placement dimensions
+
+        Returns
+        -------
+        A copy of `df` with one column for each of `dimension_keys`
+        """
+        keys = {}
+        for column, dimension in self.dimension_keys.items():
+            keys[column] = dimension.resolve(con, df)
+        return df.assign(**keys)
+
+    def upsert(self, con, table, table_temp, columns):
+        """
+        Insert the rows of `table_temp` into `table`, updating the metrics
+        of the rows that already exist
+        """
+        update_part = []
+        for c in self.metrics:
+            update_part.append("{table}.{fld}={temp}.{fld}".format(
+                table=table, temp=table_temp, fld=c))
+        update_part.append(
+            "{table}.updated_at=CURRENT_TIMESTAMP()".format(table=table))
+        update_part = ",".join(update_part)
+        all_columns = ",".join(columns)
+        con.execute("""INSERT INTO {table} ({all_cols}, row_key)
+                        SELECT {all_cols}, {row_key}
+                        FROM {temp} ON DUPLICATE KEY
+                        UPDATE
+                        {updates}
+                        """.format(table=table, temp=table_temp,
+                                   updates=update_part,
+                                   all_cols=all_columns,
+                                   row_key=row_key(ROW_KEYS[table])))
+
+    def replace_range(self, con, table, table_temp, columns, df):
+        """
+        DSP files are usually full restatements of a date range, so the
+        whole range of this source is deleted and bulk inserted again in a
+        single transaction, instead of being upserted row by row. DSP rows
+        loaded before the source was recorded (an empty source) are
+        replaced as well, since they cannot be told apart
+        """
+        start, end = df.date.min(), df.date.max()
+        logger.info("Replacing [{}] from [{}] to [{}] in [{}]".format(
+            self.source, start, end, table))
+        condition = "date BETWEEN :start AND :end"
+        params = {"start": start.to_pydatetime(), "end": end.to_pydatetime()}
+        if self.dsp:
+            condition += " AND source IN (:source, '')"
+            params["source"] = self.source
+
+        all_columns = ",".join(columns)
+        with con.begin():
+            con.execute(text("DELETE FROM {table} WHERE {condition}".format(
+                table=table, condition=condition)), **params)
+            con.execute("""INSERT INTO {table} ({all_cols}, row_key)
+                            SELECT {all_cols}, {row_key} FROM {temp}
+                            """.format(table=table, temp=table_temp,
+                                       all_cols=all_columns,
+                                       row_key=row_key(ROW_KEYS[table])))
+
+    def mark_dirty(self, con, df, mode):
+        """
+        Register the dates touched by this file, so only their report is
+        regenerated. A replaced range might lose rows in any of its dates
+        """
+        if mode == "replace":
+            dates = pd.date_range(df.date.min(), df.date.max())
+        else:
+            dates = df.date.drop_duplicates()
+        con.execute(text("""INSERT INTO dirty_dates (date) VALUES (:date)
+                            ON DUPLICATE KEY
+                            UPDATE marked_at = CURRENT_TIMESTAMP()"""),
+                    [{"date": d.to_pydatetime()} for d in dates])
+
+    def refresh_unclassified(self, con, df, mode):
+        """
+        Refresh the unclassified keys of the campaigns in this file, and for
+        a replaced range, of those that had unidentified rows in it
+        """
+        keys = set(df.campaign_key.unique())
+        if mode == "replace":
+            keys.update(keys_in_range(con, self.source,
+                                      df.date.min().to_pydatetime(),
+                                      df.date.max().to_pydatetime()))
+        refresh_unclassified(con, self.source, keys)
+
+    @property
+    def source(self):
+        """the name of the file's source, `dcm` or the DSP name"""
+        return self.dsp or "dcm"
+
+    @property
+    def load_mode(self):
+        """
+        The load mode might be set for each source, like `LOAD_MODE_DBM`, or
+        for all of them through `LOAD_MODE`. The default is `upsert`
+        """
+        config = ConfigHelper.shared()
+        mode = config.get_config("LOAD_MODE_{}".format(self.source.upper()))
+        return (mode or config.get_config("LOAD_MODE") or "upsert").lower()
+
     def parse(self):
         raise NotImplementedError("""Implemented by children, for specific
                                   purposes.""")
 
     def find_by_patter(self, ad_line, classifiers, classifying):
+        stats, regexes = self.snapshot.stats, self.snapshot.regexes
         for c in classifiers:
-            composed = ""
-            if c.use_campaign_id:
-                composed += str(ad_line.get("campaign_id") or 0)
-            if c.use_campaign:
-                composed += ad_line.get("campaign") or ""
-            if c.use_placement_id:
-                composed += str(ad_line.get("placement_id") or 0)
-            if c.use_placement:
-                composed += ad_line.get("placement") or ""
-            if re.search(c.pattern, composed, re.IGNORECASE):
+            composed = compose(flags(c), *[ad_line.get(k) for k in KEY_NAMES])
+            begin = time.perf_counter()
+            found = regexes[c.pattern].search(composed)
+            stats.record(c, time.perf_counter() - begin)
+            if found:
                 return getattr(c, classifying)
-        return "unidentified " + classifying.replace("_", "")
+        return UNIDENTIFIED[classifying]
 
     def find_brand(self, ad_line):
         return self.find_by_patter(ad_line, self.for_brand, "brand")
@@ -256,29 +518,25 @@ class Worker(object):
             self.dfs_classified.append(df.copy())
         return self
 
-    def load_classifications(self):
+    def load_classifications(self, snapshot=None):
         """
         Load the classifications for figuring out the brand, sub brand, and
         dsp according to the information in campaign and placement fields
+
+        Params
+        ------
+        snapshot : ClassificationSnapshot
+            an already loaded snapshot, if None, a new one is loaded
         """
-        with get_context():
-            self.for_brand = Classification.query \
-                .filter(and_(
-                            Classification.brand.isnot(None),
-                            Classification.brand != "")).all()
-            self.for_sub_brand = Classification.query \
-                .filter(and_(
-                            Classification.sub_brand.isnot(None),
-                            Classification.sub_brand != "")).all()
-            self.for_dsp = Classification.query \
-                .filter(and_(
-                            Classification.dsp.isnot(None),
-                            Classification.dsp != "")).all()
+        self.snapshot = snapshot or ClassificationSnapshot.load()
+        self.for_brand = self.snapshot.for_brand
+        self.for_sub_brand = self.snapshot.for_sub_brand
+        self.for_dsp = self.snapshot.for_dsp
 
 
 class DcmWorker(Worker):
-    def __init__(self):
-        super(DcmWorker, self).__init__()
+    def __init__(self, snapshot=None):
+        super(DcmWorker, self).__init__(snapshot)
         self.pattern = ".*dcm.*"
         self.dimensions_raw = [
             "date",
@@ -302,6 +560,11 @@ class DcmWorker(Worker):
             "clicks": "sum",
             "reach": "sum"  # WARNING! CALCULATED METRIC!!!
         }
+        self.dimension_keys = OrderedDict([
+            ("brand_key", BRANDS),
+            ("campaign_key", CAMPAIGNS),
+            ("placement_key", PLACEMENTS)
+        ])
         self.metrics = list(self.metrics_agg.keys())
 
     def parse(self):
@@ -346,7 +609,7 @@ class DcmWorker(Worker):
 
 
 class DspWorker(Worker):
-    def __init__(self, dsp):
+    def __init__(self, dsp, snapshot=None):
         """
         Params
         ------
@@ -354,8 +617,10 @@ class DspWorker(Worker):
             a DSP name, withou formating, spaces or special chars. this will
             be used as pattern for searching advertisenments of this DSP in the
             csv files
+        snapshot : ClassificationSnapshot
+            the classification rules shared by the workers of this run
         """
-        super(DspWorker, self).__init__()
+        super(DspWorker, self).__init__(snapshot)
         self.dsp = dsp
         self.pattern = ".*%s.*" % dsp
         self.dimensions_raw = [
@@ -376,6 +641,10 @@ class DspWorker(Worker):
             "clicks": "sum",
             "cost": "sum"
         }
+        self.dimension_keys = OrderedDict([
+            ("brand_key", BRANDS),
+            ("campaign_key", CAMPAIGNS)
+        ])
         self.metrics = list(self.metrics_agg.keys())
 
     def parse(self):
@@ -417,11 +686,323 @@ class DspWorker(Worker):
         return self
 
 
-def generate_report():
-    """ this function generates the full report, joining data from DCM and
-    the DSPs. Since the files might have arbitrary dates, the option is to
-    generate the whole report table again.
+def report_engine():
+    """the engine set through REPORT_ENGINE, the default is `sql`"""
+    engine = ConfigHelper.shared().get_config("REPORT_ENGINE")
+    return (engine or "sql").lower()
+
+
+def generate_report(full=False, engine=None, parallelism=None,
+                    shard_days=None):
+    """ this function generates the report, joining data from DCM and
+    the DSPs. Only the dates marked as dirty by the workers are replaced,
+    unless a full rebuild is requested. It waits for a running rebuild of
+    the tables to finish, like the workers do.
+
+    A sharded run commits each shard on its own, so readers of the report
+    see some dates generated again and others not yet while it runs. For
+    a full run, the report is only consistent at the end, prefer the
+    rebuild (src.utils.rebuild_helper) when readers must not notice it.
+
+    Params
+    ------
+    full : boolean
+        if True, the whole report table is generated again
+    engine : string
+        'sql' for joining the data in the database, or 'pandas' for
+        joining it in this process. If None, the configured
+        `report_engine` is used
+    parallelism : int
+        how many date shards the sql engine generates at the same time, if
+        None, REPORT_PARALLELISM is used (default 1, no sharding). The
+        connection pool is sized for it
+    shard_days : int
+        the days of each shard, if None, REPORT_SHARD_DAYS is used
+        (default 7)
+    """
+    engine = engine or report_engine()
+    if engine not in REPORT_ENGINES:
+        raise Exception("Unknown report engine [{}]".format(engine))
+    config = ConfigHelper.shared()
+    parallelism = parallelism or config.get_int("REPORT_PARALLELISM", 1)
+    shard_days = shard_days or config.get_int("REPORT_SHARD_DAYS", 7)
+
+    # the shards take a connection each, besides this one
+    con = get_connection(pool_size=parallelism + 1)
+    try:
+        with rebuild_lock(con):
+            # the database clock, the workers mark dates with it too
+            started = con.execute("SELECT CURRENT_TIMESTAMP()").scalar()
+            dates = None
+            if not full:
+                dates = [r[0] for r in con.execute(text(DIRTY_DATES),
+                                                   started=started)]
+            begin = time.time()
+            if engine == "pandas":
+                rows = generate_report_pandas(con, started, full=full)
+            elif parallelism > 1:
+                rows = generate_report_sharded(con, started, full=full,
+                                               shard_days=shard_days,
+                                               parallelism=parallelism)
+            else:
+                rows = generate_report_sql(con, started, full=full)
+            logger.info("Report generated by [{}] in [{:.2f}s]".format(
+                engine, time.time() - begin))
+            refresh_rollups(con, dates)
+            bump_report_version(con, mode="full" if full else "incremental",
+                                duration=time.time() - begin, rows=rows)
+    finally:
+        con.close()
+        con.engine.dispose()
+
+
+def generate_report_sql(con, started, full=False, shard=None):
     """
-    con = get_connection()
-    connection = con.connect()
-    connection.execute(GENERATE_REPORT)
+    Generate the report in the database. DCM and DSP are aggregated into
+    temporary stage tables first, they are session tables, so only the
+    replacement of the report rows runs in a transaction
+
+    Params
+    ------
+    con : sqlalchemy connection
+    started : datetime
+        the dates marked as dirty before it are generated
+    full : boolean
+        if True, the whole report table is generated again
+    shard : tuple
+        if given, only the dates from its start (inclusive) to its end
+        (exclusive) are generated, and the dirty dates are not cleaned
+
+    Returns
+    -------
+    the number of report rows written
+    """
+    conditions, params = [], {"started": started}
+    if not full:
+        conditions.append("date IN ({})".format(DIRTY_DATES))
+    if shard:
+        conditions.append("date >= :start AND date < :end")
+        params.update(start=shard[0], end=shard[1])
+        logger.info("Generating the report from [{}] to [{}]".format(*shard))
+    else:
+        logger.info("Generating the {} report".format(
+            "full" if full else "dirty dates"))
+    date_filter = ""
+    if conditions:
+        date_filter = " WHERE {}".format(" AND ".join(conditions))
+
+    stages = REPORT_STAGES.format(date_filter=date_filter)
+    for statement in statements(stages):
+        con.execute(text(statement), **params)
+    for side in ["dcm", "dsp"]:
+        count = con.execute("SELECT COUNT(*) FROM report_{}_stage".format(
+            side)).scalar()
+        logger.debug("Staged [{}] [{}] rows".format(count, side.upper()))
+
+    with con.begin():
+        con.execute(text("DELETE FROM report" + date_filter), **params)
+        result = con.execute(text(REPORT_INSERT))
+        logger.info("Generated [{}] report rows".format(result.rowcount))
+        if not shard:
+            con.execute(text(CLEAN_DIRTY_DATES), started=started)
+
+    for statement in statements(REPORT_DROP_STAGES):
+        con.execute(statement)
+    return result.rowcount
+
+
+def report_shards(first, last, days):
+    """
+    Params
+    ------
+    first, last : datetime
+        the first and the last dates to be generated
+    days : int
+        the size of each shard
+
+    Returns
+    -------
+    array of (start, end) tuples, the end is exclusive
+    """
+    current = pd.Timestamp(first).normalize()
+    end = pd.Timestamp(last).normalize() + pd.Timedelta(days=1)
+    shards = []
+    while current < end:
+        upper = min(current + pd.Timedelta(days=days), end)
+        shards.append((current.to_pydatetime(), upper.to_pydatetime()))
+        current = upper
+    return shards
+
+
+def generate_report_sharded(con, started, full=False, shard_days=7,
+                            parallelism=4):
+    """
+    Split the dates to be generated into shards of `shard_days`, and run
+    `generate_report_sql` for them concurrently, each one in its own
+    connection and transaction. It is not atomic for readers: each shard
+    is visible as soon as it is committed, and in a full run the dates
+    without DCM data anymore are only removed at the end
+
+    Params
+    ------
+    con : sqlalchemy connection
+        its engine provides the connections of the shards, its pool must
+        hold `parallelism` connections besides `con`, or the shards wait
+        for each other
+    started : datetime
+        the dates marked as dirty before it are generated
+    full : boolean
+        if True, the whole report table is generated again
+    shard_days : int
+        the number of days of each shard
+    parallelism : int
+        how many shards run at the same time
+
+    Returns
+    -------
+    the number of report rows written
+    """
+    if full:
+        query = "SELECT MIN(date), MAX(date) FROM dcm_classified"
+    else:
+        query = "SELECT MIN(date), MAX(date) FROM ({}) AS dirty".format(
+            DIRTY_DATES)
+    first, last = con.execute(text(query), started=started).fetchone()
+    shards = report_shards(first, last, shard_days) if first else []
+    logger.info("Generating [{}] shards of [{}] days, [{}] at a time".format(
+        len(shards), shard_days, parallelism))
+
+    def run(shard):
+        with con.engine.connect() as shard_con:
+            return generate_report_sql(shard_con, started, full=full,
+                                       shard=shard)
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=parallelism) as pool:
+        futures = {pool.submit(run, shard): shard for shard in shards}
+        for done, future in enumerate(as_completed(futures), 1):
+            rows = future.result()
+            total += rows
+            logger.info("Shard [{}/{}] from [{}] to [{}] done, [{}] rows"
+                        .format(done, len(shards), *futures[future], rows))
+
+    with con.begin():
+        # the dates without DCM data anymore
+        if full and shards:
+            con.execute(text("""DELETE FROM report
+                                WHERE date < :first OR date >= :end"""),
+                        first=shards[0][0], end=shards[-1][1])
+        elif full:
+            con.execute("DELETE FROM report")
+        con.execute(text(CLEAN_DIRTY_DATES), started=started)
+    return total
+
+
+def build_report(dcm, dsp, brands, campaigns):
+    """
+    The same rows as `GENERATE_REPORT`, computed with pandas. Each side is
+    aggregated by its own keys before the join, so the join only sees one
+    row per campaign
+
+    Params
+    ------
+    dcm, dsp : pandas.DataFrame
+        slices of `dcm_classified` and `dsp_classified`
+    brands, campaigns : pandas.DataFrame
+        the dimension tables
+
+    Returns
+    -------
+    A pandas.DataFrame with the `REPORT_COLUMNS`
+    """
+    keys = ["date", "brand_key"]
+    ad = dcm.groupby(keys + ["campaign_key"], sort=False).agg(
+        ad_impressions=("impressions", "sum"),
+        ad_clicks=("clicks", "sum"),
+        ad_reach=("reach", "sum")).reset_index()
+    ad = ad.rename(columns={"campaign_key": "ad_campaign_key"})
+    ds = dsp.groupby(keys + ["campaign_key"], sort=False).agg(
+        dsp_impressions=("impressions", "sum"),
+        dsp_clicks=("clicks", "sum"),
+        dsp_cost=("cost", "sum")).reset_index()
+    ds = ds.rename(columns={"campaign_key": "dsp_campaign_key"})
+    df = ad.merge(ds, how="left", on=keys)
+    df = df.fillna({"dsp_campaign_key": 0, "dsp_impressions": 0,
+                    "dsp_clicks": 0, "dsp_cost": 0})
+
+    brands = brands.rename(columns={"id": "brand_key"})
+    ad_campaigns = campaigns.rename(columns={
+        "id": "ad_campaign_key", "campaign_id": "ad_campaign_id",
+        "campaign": "ad_campaign"})
+    dsp_campaigns = campaigns.rename(columns={
+        "id": "dsp_campaign_key", "campaign_id": "dsp_campaign_id",
+        "campaign": "dsp_campaign"})
+    df = df.merge(brands, on="brand_key").merge(
+        ad_campaigns, on="ad_campaign_key").merge(
+        dsp_campaigns, how="left", on="dsp_campaign_key")
+    df = df.fillna({"dsp_campaign_id": 0, "dsp_campaign": ""})
+    ints = ["dsp_campaign_key", "dsp_campaign_id", "ad_clicks", "dsp_clicks"]
+    df[ints] = df[ints].astype(int)
+    return df[REPORT_COLUMNS]
+
+
+def generate_report_pandas(con, started, full=False):
+    """
+    Generate the report in this process instead of the database. Only the
+    slices of the dates being generated are read, and the result is bulk
+    loaded into `report`
+
+    Params
+    ------
+    con : sqlalchemy connection
+    started : datetime
+        the dates marked as dirty before it are generated
+    full : boolean
+        if True, the whole report table is generated again
+
+    Returns
+    -------
+    the number of report rows written
+    """
+    if full:
+        logger.info("Generating the full report [pandas]")
+        date_filter, params = "", {}
+    else:
+        logger.info("Generating the report of dirty dates [pandas]")
+        # the dates are fixed here, so the rows read, deleted and inserted
+        # are the same even if new dates are marked in the meantime
+        dates = [r[0] for r in con.execute(text(DIRTY_DATES),
+                                           started=started)]
+        if not dates:
+            con.execute(text(CLEAN_DIRTY_DATES), started=started)
+            return 0
+        date_filter, params = " WHERE date IN :dates", {"dates": dates}
+
+    def read(query):
+        query = text(query.format(date_filter=date_filter))
+        if params:
+            query = query.bindparams(bindparam("dates", expanding=True))
+        return pd.read_sql(query, con, params=params, parse_dates=["date"])
+
+    df = build_report(read(REPORT_DCM_SLICE), read(REPORT_DSP_SLICE),
+                      pd.read_sql("SELECT id, brand, sub_brand, dsp "
+                                  "FROM brands", con),
+                      pd.read_sql("SELECT id, campaign_id, campaign "
+                                  "FROM campaigns", con))
+    logger.info("Loading [{}] report rows".format(len(df)))
+    df.to_sql(con=con, name="report_temp", if_exists='replace', index=False)
+    all_columns = ",".join(REPORT_COLUMNS)
+    with con.begin():
+        if full:
+            con.execute("DELETE FROM report")
+        else:
+            con.execute(text("DELETE FROM report WHERE date IN :dates")
+                        .bindparams(bindparam("dates", expanding=True)),
+                        **params)
+        con.execute("""INSERT INTO report ({all_cols}, row_key)
+                       SELECT {all_cols}, {row_key} FROM report_temp
+                       """.format(all_cols=all_columns,
+                                  row_key=row_key(ROW_KEYS["report"])))
+        con.execute(text(CLEAN_DIRTY_DATES), started=started)
+    con.execute("DROP TABLE report_temp")
+    return len(df)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# python standard
+import json
+import unittest
+import logging
+
+# third-party imports
+from sqlalchemy import create_engine
+
+# local imports
+from utils.classification_helper import (RULE_FIELDS, read_rules,
+                                         validate_rules, import_rules,
+                                         affected_keys)
+from utils.pattern_helper import KeyIndex
+from webapp.app.models import Classification
+
+logging.disable(logging.CRITICAL)
+
+RULES_CSV = """pattern,brand,sub_brand,dsp,use_campaign_id,use_campaign,\
+use_placement_id,use_placement
+^acme,acme,,,0,1,0,0
+asprin,,asprin,,false,true,false,false
+_dbm$,,,dbm,,yes,,
+"""
+
+
+class TestClassificationHelper(unittest.TestCase):
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        Classification.__table__.create(self.con)
+
+    def tearDown(self):
+        self.con.close()
+
+    def rules(self):
+        query = "SELECT {} FROM classifications ORDER BY id".format(
+            ", ".join(RULE_FIELDS))
+        return [dict(zip(RULE_FIELDS, r)) for r in self.con.execute(query)]
+
+    def test_read_rules(self):
+        rules, errors = validate_rules(read_rules(RULES_CSV, "csv"))
+        self.assertEqual(errors, [])
+        self.assertEqual(rules[0], {
+            "pattern": "^acme", "brand": "acme", "sub_brand": "", "dsp": "",
+            "use_campaign_id": False, "use_campaign": True,
+            "use_placement_id": False, "use_placement": False})
+        self.assertTrue(rules[2]["use_campaign"])
+
+        exported = json.dumps({"status": "success", "data": rules})
+        self.assertEqual(read_rules(exported, "json"), rules,
+                         "The export should be imported back")
+
+    def test_validate_rules(self):
+        _, errors = validate_rules([
+            {"pattern": "acme(", "brand": "acme", "use_campaign": "1"},
+            {"pattern": "acme", "use_campaign": "1"},
+            {"pattern": "x", "brand": "b" * 26, "use_campaign": "1"},
+            {"pattern": "ok", "brand": "ok", "use_campaign": "1"},
+            {"pattern": "ok", "brand": "ok", "use_campaign": "1"},
+        ])
+        self.assertEqual(len(errors), 4)
+        self.assertTrue(errors[0].startswith("row 1: invalid pattern"))
+        self.assertIn("a brand, sub brand or dsp is required", errors[1])
+        self.assertIn("brand is longer than 25", errors[2])
+        self.assertEqual(errors[3], "row 5: it is repeated")
+
+        _, errors = validate_rules([
+            {"pattern": "acme", "brand": "Acme", "use_campaign": "1"},
+            {"pattern": "ACME", "brand": "acme", "use_campaign": "1"},
+        ])
+        self.assertEqual(errors, ["row 2: it is repeated"],
+                         "The collation of the index ignores the case")
+
+        _, errors = validate_rules([
+            {"pattern": "(a+)+$", "brand": "a", "use_campaign": "1"},
+            {"pattern": "^(a|a)*b", "brand": "a", "use_campaign": "1"},
+        ])
+        self.assertEqual(errors, [
+            "row 1: the pattern has nested quantifiers",
+            "row 2: the pattern repeats alternatives that overlap"])
+        _, errors = validate_rules([
+            {"pattern": "^acme", "brand": "a", "use_campaign": "1"},
+            {"pattern": "^" + "a*" * 9 + "b", "brand": "a",
+             "use_campaign": "1"},
+        ])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith(
+            "row 2: the pattern did not finish"))
+
+    def test_import_rules(self):
+        rules, _ = validate_rules(read_rules(RULES_CSV, "csv"))
+        result = import_rules(self.con, rules[:2])
+        self.assertEqual((result["inserted"], result["skipped"]), (2, 0))
+
+        result = import_rules(self.con, rules)
+        self.assertEqual((result["inserted"], result["skipped"]), (1, 2))
+        self.assertEqual(result["changed"], rules[2:],
+                         "Only the new rule should change anything")
+        self.assertEqual(len(self.rules()), 3)
+
+        self.con.execute("""UPDATE classifications SET brand = 'ACME '
+                            WHERE pattern = '^acme'""")
+        result = import_rules(self.con, rules[:1])
+        self.assertEqual((result["inserted"], result["skipped"]), (0, 1),
+                         "It should match the rule stored in another case")
+
+        result = import_rules(self.con, rules[1:], replace=True)
+        self.assertEqual((result["inserted"], result["removed"]), (2, 1))
+        self.assertEqual([r["pattern"] for r in self.rules()],
+                         ["asprin", "_dbm$"])
+
+    def test_affected_keys(self):
+        self.con.execute("""CREATE TABLE dcm_raw (id INTEGER, campaign_id
+                            INTEGER, campaign TEXT, placement_id INTEGER,
+                            placement TEXT)""")
+        self.con.execute("""CREATE TABLE dsp_raw (id INTEGER, campaign_id
+                            INTEGER, campaign TEXT)""")
+        self.con.execute("""INSERT INTO dcm_raw VALUES
+                            (1, 10, 'acme_asprin', 100, 'banner'),
+                            (2, 11, 'acme_other', 101, 'video'),
+                            (3, 12, 'globex_tv', 102, 'banner')""")
+        self.con.execute("""INSERT INTO dsp_raw VALUES
+                            (1, 20, 'acme_asprin_dbm')""")
+        index = KeyIndex()
+        index.refresh(self.con)
+        rules, _ = validate_rules(read_rules(RULES_CSV, "csv"))
+        self.assertEqual(affected_keys(index, rules), {"dcm": 2, "dsp": 1},
+                         "A key matched by many rules counts once")
+        self.assertEqual(affected_keys(index, []), {"dcm": 0, "dsp": 0})
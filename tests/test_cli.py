@@ -4,6 +4,8 @@
 
 # python standard
 import os
+import sys
+import subprocess
 import unittest
 import logging
 
@@ -12,6 +14,13 @@ from workers import cli
 
 logging.disable(logging.CRITICAL)
 
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "..", "src")
+
+# modules that lightweight actions must never pay for
+HEAVY_MODULES = ["pandas", "numpy", "flask", "sqlalchemy", "googleapiclient",
+                 "MySQLdb", "webapp", "workers.worker"]
+
 
 class TestCli(unittest.TestCase):
     def setUp(self):
@@ -43,6 +52,15 @@ class TestCli(unittest.TestCase):
         args = self.parser.parse_args(['--generate-report'])
         self.assertTrue(args.action == "work", "Action should be work!")
         self.assertTrue(args.generate_report, "It should be True!")
+        args = self.parser.parse_args(['-g', '--full', '--engine', 'pandas'])
+        self.assertTrue(args.full, "It should be a full report!")
+        self.assertEqual(args.engine, "pandas", "Engine should be pandas!")
+
+    def test_partition(self):
+        args = self.parser.parse_args(['partition', '--months', '6'])
+        self.assertTrue(args.action == "partition",
+                        "Action should be partition!")
+        self.assertEqual(args.months, 6, "Months should be 6!")
 
     def test_server_with_port(self):
         args = self.parser.parse_args(['serve', '--port', '8080'])
@@ -53,3 +71,42 @@ class TestCli(unittest.TestCase):
         args = self.parser.parse_args(['serve'])
         self.assertTrue(args.action == "serve", "Action should be serve!")
         self.assertTrue(type(args.port) is int, "Port must be an integer!")
+
+
+class TestCliImportTime(unittest.TestCase):
+    """
+    `python -X importtime` benchmark for the lightweight actions, the
+    budgets are in microseconds and are generous on purpose
+    """
+
+    def import_times(self, statement):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = SRC_FOLDER
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                               statement], env=env, stderr=subprocess.PIPE,
+                              stdout=subprocess.PIPE, check=True)
+        times = {}
+        for line in proc.stderr.decode("utf-8").splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative.strip())
+        return times
+
+    def assert_light(self, times):
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, times,
+                             "{} should be imported lazily".format(module))
+
+    def test_cli_import(self):
+        """ parsing the arguments, or `init`, before the action runs """
+        times = self.import_times("import workers.cli")
+        self.assert_light(times)
+        self.assertLess(times["workers.cli"], 250000)
+
+    def test_poke_import(self):
+        """ `dspreview work --poke report` only needs the MQ manager """
+        times = self.import_times("import workers.cli; import workers.manager")
+        self.assert_light(times)
+        self.assertLess(times["workers.manager"], 750000)
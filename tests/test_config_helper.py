@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 # python standard
+import os
 import unittest
 import logging
 import unittest.mock as mock
@@ -45,3 +46,43 @@ class TestConfigHelper(unittest.TestCase):
             self.assertEqual(config.get_config("key"),
                              "value", """Is is not finding the correct
                                         key-value config""")
+
+    @mock.patch('utils.config_helper.os.path.getmtime')
+    @mock.patch('utils.config_helper.os.path.exists')
+    def test_shared_reloads_on_change(self, mock_path_exists, mock_mtime):
+        mock_path_exists.return_value = True
+        mock_mtime.return_value = 1.0
+        ConfigHelper._shared = None
+        try:
+            mo = mock_open(read_data="""{"key":"value"}""")
+            with patch('utils.config_helper.open', mo):
+                config = ConfigHelper.shared()
+                self.assertIs(ConfigHelper.shared(), config)
+            self.assertEqual(mo.call_count, 1, "It should be parsed once")
+
+            mock_mtime.return_value = 2.0
+            mo = mock_open(read_data="""{"key":"other"}""")
+            with patch('utils.config_helper.open', mo):
+                self.assertIs(ConfigHelper.shared(), config)
+            self.assertEqual(config.get_config("key"), "other")
+        finally:
+            ConfigHelper._shared = None
+
+    @mock.patch('utils.config_helper.os.path.exists')
+    def test_empty_file(self, mock_path_exists):
+        mock_path_exists.return_value = True
+        with patch('utils.config_helper.open', mock_open(read_data="")):
+            self.assertEqual(ConfigHelper().config_info, {})
+
+    @mock.patch.dict(os.environ, {"MQ_PORT": "5673", "DB_TEST_NAME": "t",
+                                  "DB_NAME": "n", "MQ_DURABLE": "yes"})
+    @mock.patch('utils.config_helper.os.path.exists')
+    def test_typed_accessors(self, mock_path_exists):
+        mock_path_exists.return_value = True
+        with patch('utils.config_helper.open', mock_open(read_data="{}")):
+            config = ConfigHelper()
+            self.assertEqual(config.mq().port, 5673)
+            self.assertEqual(config.get_int("DB_NAME", 7), 7)
+            self.assertTrue(config.get_bool("MQ_DURABLE"))
+            self.assertEqual(config.database().dbname, "n")
+            self.assertEqual(config.database(test=True).dbname, "t")
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# python standard
+import unittest
+import logging
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+# third-party imports
+from sqlalchemy import create_engine
+
+# local imports
+from utils.job_helper import (create_job, update_job, get_job, run_job,
+                              enqueue_job, queued_job)
+from webapp.app.models import Job, Rebuild
+
+logging.disable(logging.CRITICAL)
+
+
+def fake_rebuild(con, progress=None):
+    progress("classified", 0)
+    progress("report", 30)
+    return {"duration": 1.0, "rows": {"dcm_classified": 10,
+                                      "dsp_classified": 20, "report": 5}}
+
+
+class TestJobHelper(unittest.TestCase):
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        Job.__table__.create(self.con)
+        Rebuild.__table__.create(self.con)
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_create_job(self):
+        job = get_job(self.con, create_job(self.con, "rebuild"))
+        self.assertEqual(job["status"], "queued")
+        self.assertIsNone(job["expected"], "There was no rebuild before")
+        self.assertIsNone(get_job(self.con, "missing"))
+        with self.assertRaises(Exception):
+            create_job(self.con, "unknown")
+
+    def test_eta(self):
+        self.con.execute("""INSERT INTO rebuilds (started_at, duration,
+                                                  dcm_rows, dsp_rows,
+                                                  report_rows)
+                            VALUES ('2018-01-01', 600, 1, 1, 1)""")
+        job_id = create_job(self.con, "rebuild")
+        update_job(self.con, job_id, status="running",
+                   started_at=datetime.now() - timedelta(seconds=100))
+        job = get_job(self.con, job_id)
+        self.assertEqual(job["expected"], 600)
+        self.assertAlmostEqual(job["eta"], 500, delta=5)
+
+    @patch('utils.rebuild_helper.rebuild_tables', side_effect=fake_rebuild)
+    def test_run_job(self, mock_rebuild):
+        job_id = create_job(self.con, "rebuild")
+        run_job(job_id, self.con)
+        job = get_job(self.con, job_id)
+        self.assertEqual((job["status"], job["stage"], job["processed"]),
+                         ("done", "done", 35))
+        self.assertIsNotNone(job["finished_at"])
+
+        run_job(job_id, self.con)
+        self.assertEqual(mock_rebuild.call_count, 1,
+                         "A job should run only once")
+
+    @patch('utils.rebuild_helper.rebuild_tables',
+           side_effect=Exception("lock wait timeout"))
+    def test_run_job_failed(self, mock_rebuild):
+        job_id = create_job(self.con, "rebuild")
+        run_job(job_id, self.con)
+        job = get_job(self.con, job_id)
+        self.assertEqual((job["status"], job["error"]),
+                         ("failed", "lock wait timeout"))
+
+    @patch('utils.job_helper.threading.Thread')
+    @patch('workers.manager.Manager.__enter__',
+           side_effect=Exception("no MQ"))
+    def test_enqueue_job_locally(self, mock_enter, mock_thread):
+        job_id = enqueue_job(self.con, "rebuild")
+        mock_thread.assert_called_once_with(target=run_job, args=(job_id,),
+                                            daemon=True)
+        mock_thread.return_value.start.assert_called_once_with()
+
+    @patch('utils.job_helper.threading.Thread')
+    @patch('workers.manager.Manager.__enter__',
+           side_effect=Exception("no MQ"))
+    def test_enqueue_job_once(self, mock_enter, mock_thread):
+        job_id = enqueue_job(self.con, "rebuild")
+        self.assertEqual(enqueue_job(self.con, "rebuild"), job_id)
+        self.assertEqual(mock_thread.call_count, 1,
+                         "A queued rebuild should be started only once")
+
+        update_job(self.con, job_id, status="running")
+        follow_up = enqueue_job(self.con, "rebuild")
+        self.assertNotEqual(follow_up, job_id,
+                            "A running rebuild might miss the new rules")
+        self.assertEqual(enqueue_job(self.con, "rebuild"), follow_up)
+        self.assertEqual(mock_thread.call_count, 2)
+
+    def test_lost_job(self):
+        job_id = create_job(self.con, "rebuild")
+        self.assertEqual(queued_job(self.con, "rebuild"), job_id)
+        self.con.execute("""UPDATE jobs SET created_at = '2018-01-01'""")
+        self.assertIsNone(queued_job(self.con, "rebuild"),
+                          "A job lost long ago should not hold new ones")
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+# python standard
+import unittest
+import logging
+
+# third-party imports
+from sqlalchemy import create_engine
+
+# local imports
+from utils.meta_helper import (report_version, bump_report_version,
+                               report_meta)
+from webapp.app.models import ReportMeta
+
+logging.disable(logging.CRITICAL)
+
+
+class TestMetaHelper(unittest.TestCase):
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        ReportMeta.__table__.create(self.con)
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_bump_report_version(self):
+        self.assertEqual(report_version(self.con), 0)
+        self.assertEqual(bump_report_version(self.con), 1)
+        self.assertEqual(bump_report_version(self.con), 2)
+        self.assertEqual(report_version(self.con), 2)
+        count = self.con.execute("SELECT COUNT(*) FROM report_meta")
+        self.assertEqual(count.scalar(), 1, "It should be a single row")
+
+    def test_report_meta(self):
+        self.assertIsNone(report_meta(self.con))
+        bump_report_version(self.con, mode="full", duration=2.5, rows=10)
+        meta = report_meta(self.con)
+        self.assertEqual(meta["version"], 1)
+        self.assertEqual(meta["mode"], "full")
+        self.assertEqual(meta["duration"], 2.5)
+        self.assertEqual(meta["report_rows"], 10)
+        self.assertIsNotNone(meta["generated_at"])
+
+        bump_report_version(self.con, mode="incremental", duration=0.5,
+                            rows=3)
+        meta = report_meta(self.con)
+        self.assertEqual((meta["version"], meta["mode"],
+                          meta["report_rows"]), (2, "incremental", 3))
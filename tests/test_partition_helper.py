@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# python standard
+import unittest
+import logging
+from datetime import date
+from unittest.mock import patch, MagicMock
+
+# local imports
+from utils.partition_helper import (add_months, month_starts, partition_clause,
+                                    roll_clause, partition_table)
+
+logging.disable(logging.CRITICAL)
+
+
+class TestPartitionHelper(unittest.TestCase):
+
+    def test_add_months(self):
+        self.assertEqual(add_months(date(2018, 11, 20), 2), date(2019, 1, 1))
+        self.assertEqual(add_months(date(2018, 1, 31), -1), date(2017, 12, 1))
+
+    def test_month_starts(self):
+        months = month_starts(date(2018, 11, 15), date(2019, 2, 1))
+        self.assertEqual(months, [date(2018, 11, 1), date(2018, 12, 1),
+                                  date(2019, 1, 1), date(2019, 2, 1)])
+
+    def test_partition_clause(self):
+        clause = partition_clause(date(2018, 1, 1), months_ahead=1,
+                                  today=date(2018, 2, 10))
+        self.assertTrue(clause.startswith(
+            "PARTITION BY RANGE (TO_DAYS(date))"))
+        self.assertIn("PARTITION p0 VALUES LESS THAN (TO_DAYS('2018-01-01'))",
+                      clause)
+        self.assertIn(
+            "PARTITION p201803 VALUES LESS THAN (TO_DAYS('2018-04-01'))",
+            clause)
+        self.assertNotIn("p201804", clause)
+        self.assertTrue(clause.endswith("VALUES LESS THAN MAXVALUE\n)"))
+
+    def test_roll_clause(self):
+        partitions = ["p0", "p201801", "p201802", "pmax"]
+        clause = roll_clause(partitions, months_ahead=1,
+                             today=date(2018, 2, 10))
+        self.assertTrue(clause.startswith("REORGANIZE PARTITION pmax INTO"))
+        self.assertIn("p201803", clause)
+        self.assertNotIn("p201802", clause)
+
+        self.assertIsNone(roll_clause(partitions, months_ahead=0,
+                                      today=date(2018, 2, 10)))
+
+    @patch('utils.partition_helper.existing_partitions')
+    def test_partition_table_not_partitioned(self, mock_partitions):
+        mock_partitions.return_value = []
+        con = MagicMock()
+        partition_table(con, "report")
+        statement = con.execute.call_args[0][0]
+        self.assertTrue(statement.startswith(
+            "ALTER TABLE report PARTITION BY RANGE"))
+
+    @patch('utils.partition_helper.existing_partitions')
+    def test_partition_table_up_to_date(self, mock_partitions):
+        current = date.today()
+        mock_partitions.return_value = ["p0", "p{:%Y%m}".format(
+            add_months(current, 3)), "pmax"]
+        con = MagicMock()
+        partition_table(con, "report", months_ahead=3)
+        con.execute.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# python standard
+import unittest
+import logging
+from types import SimpleNamespace
+
+# third-party imports
+from sqlalchemy import create_engine
+
+# local imports
+from utils.pattern_helper import KeyIndex, compose, dry_run
+
+logging.disable(logging.CRITICAL)
+
+
+def rule(id, pattern, brand="", sub_brand="", dsp="", use_campaign=True,
+         use_campaign_id=False, use_placement_id=False, use_placement=False):
+    return SimpleNamespace(id=id, pattern=pattern, brand=brand,
+                           sub_brand=sub_brand, dsp=dsp,
+                           use_campaign=use_campaign,
+                           use_campaign_id=use_campaign_id,
+                           use_placement_id=use_placement_id,
+                           use_placement=use_placement)
+
+
+class TestPatternHelper(unittest.TestCase):
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        self.con.execute("""CREATE TABLE dcm_raw (id INTEGER, campaign_id
+                            INTEGER, campaign TEXT, placement_id INTEGER,
+                            placement TEXT)""")
+        self.con.execute("""CREATE TABLE dsp_raw (id INTEGER, campaign_id
+                            INTEGER, campaign TEXT)""")
+        self.con.execute("""INSERT INTO dcm_raw VALUES
+                            (1, 10, 'acme_asprin', 100, 'banner'),
+                            (2, 10, 'acme_asprin', 100, 'banner'),
+                            (3, 11, 'acme_other', 101, 'video'),
+                            (4, 12, 'globex_tv', 102, 'banner')""")
+        self.con.execute("""INSERT INTO dsp_raw VALUES
+                            (1, 20, 'acme_asprin_dbm')""")
+        self.index = KeyIndex()
+        self.index.refresh(self.con)
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_compose(self):
+        self.assertEqual(compose((True, True, True, True), 10, "acme", None,
+                                 None), "10acme0")
+        self.assertEqual(compose((False, True, False, False), 10, None, 1,
+                                 "x"), "")
+
+    def test_refresh(self):
+        self.assertEqual(len(self.index.keys["dcm"]), 3,
+                         "The keys should be distinct")
+        self.assertEqual(self.index.refresh(self.con), 0)
+        self.con.execute("""INSERT INTO dcm_raw VALUES
+                            (5, 10, 'acme_asprin', 100, 'banner'),
+                            (6, 13, 'acme_new', 103, 'video')""")
+        self.assertEqual(self.index.refresh(self.con), 1,
+                         "Only the new key should be added")
+        self.assertEqual(self.index.last_ids["dcm"], 6)
+        self.assertIn("acme_new", self.index.composed(
+            "dcm", (False, True, False, False)))
+
+    def test_dry_run(self):
+        rules = [rule(1, "^acme", brand="acme"),
+                 rule(2, "asprin", brand="asprin brand")]
+        result = dry_run(self.index, rules, rule(None, "asprin|tv",
+                                                 brand="new"))
+        dcm = result["dcm"]
+        self.assertEqual((dcm["keys"], dcm["matches"]), (3, 2))
+        self.assertEqual(dcm["sample"][0]["composed"], "acme_asprin")
+        self.assertEqual(dcm["current"]["brand"],
+                         [{"rule": 1, "keys": 1}, {"rule": None, "keys": 1}])
+        self.assertEqual(dcm["wins"], {"brand": 1},
+                         "Only the key without a rule should be won")
+        self.assertEqual(result["dsp"]["matches"], 1)
+
+    def test_dry_run_edit(self):
+        rules = [rule(1, "^acme", brand="acme"),
+                 rule(2, "globex", brand="globex")]
+        # the first rule narrowed down, the second one wins the rest
+        result = dry_run(self.index, rules, rule(1, "other", brand="acme",
+                                                 use_placement=True))
+        self.assertEqual(result["dcm"]["matches"], 1)
+        self.assertEqual(result["dcm"]["sample"][0]["composed"],
+                         "acme_othervideo")
+        self.assertEqual(result["dcm"]["wins"], {"brand": 1})
+
+    def test_invalid_pattern(self):
+        with self.assertRaises(Exception):
+            dry_run(self.index, [], rule(None, "acme(", brand="acme"))
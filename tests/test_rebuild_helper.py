@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# python standard
+import unittest
+import logging
+from unittest.mock import patch, MagicMock
+
+# local imports
+from utils.rebuild_helper import on_shadows, swap_clause, rebuild_tables
+from webapp.app.queries import GENERATE_CLASSIFIED, GENERATE_REPORT
+
+logging.disable(logging.CRITICAL)
+
+
+class TestRebuildHelper(unittest.TestCase):
+
+    def test_on_shadows(self):
+        script = on_shadows(GENERATE_CLASSIFIED + GENERATE_REPORT)
+        self.assertIn("INSERT INTO\n    dcm_classified_shadow (", script)
+        self.assertIn("INSERT INTO\n    report_shadow (", script)
+        self.assertIn("report_shadow.ad_clicks = big_join.ad_clicks", script)
+        self.assertIn("dcm_classified_stage", script,
+                      "Temporary tables should keep their names")
+        self.assertIn("report_dcm_stage", script)
+        self.assertNotIn("dcm_classified_shadow_stage", script)
+
+    def test_swap_clause(self):
+        self.assertEqual(swap_clause(["report"]),
+                         "RENAME TABLE report TO report_old, "
+                         "report_shadow TO report")
+
+    @patch('utils.rebuild_helper.refresh_unclassified')
+    @patch('utils.rebuild_helper.refresh_rollups')
+    def test_rebuild_tables(self, mock_rollups, mock_unclassified):
+        con = MagicMock()
+        con.execute.return_value.scalar.return_value = 10
+        progress = MagicMock()
+        result = rebuild_tables(con, progress=progress)
+        self.assertEqual(result["rows"]["report"], 10)
+        self.assertEqual([c[0] for c in progress.call_args_list], [
+            ("shadows", 0), ("classified", 0), ("report", 20),
+            ("swap", 30), ("rollups", 30), ("unclassified", 30)])
+        executed = [str(c[0][0]) for c in con.execute.call_args_list]
+        swap = executed.index(swap_clause())
+        self.assertTrue(any("INSERT INTO\n    report_shadow" in s
+                            for s in executed[:swap]),
+                        "The report should be generated before the swap")
+        self.assertFalse(any("DELETE FROM report" in s for s in executed),
+                         "The live tables should never be emptied")
+        mock_rollups.assert_called_once_with(con)
+        mock_unclassified.assert_called_once_with(con)
+        meta = [c for c in con.execute.call_args_list
+                if "UPDATE report_meta" in str(c[0][0])]
+        self.assertEqual(meta[0][1]["mode"], "rebuild")
+        self.assertEqual(meta[0][1]["rows"], 10)
+
+    @patch("utils.rebuild_helper.refresh_unclassified")
+    @patch("utils.rebuild_helper.refresh_rollups")
+    def test_rebuild_lock(self, mock_rollups, mock_unclassified):
+        con = MagicMock()
+        con.dialect.name = "mysql"
+        con.execute.return_value.scalar.return_value = 10
+        rebuild_tables(con)
+        executed = [str(c[0][0]) for c in con.execute.call_args_list]
+        self.assertIn("GET_LOCK", executed[0])
+        self.assertIn("RELEASE_LOCK", executed[-1])
+
+        con.reset_mock()
+        con.execute.return_value.scalar.return_value = 0
+        with self.assertRaises(Exception):
+            rebuild_tables(con)
+        executed = [str(c[0][0]) for c in con.execute.call_args_list]
+        self.assertEqual(len(executed), 1,
+                         "Nothing should run without the lock")
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# python standard
+import unittest
+import logging
+from types import SimpleNamespace
+
+# third-party imports
+from sqlalchemy import create_engine
+
+# local imports
+from utils.regex_helper import (nested_quantifiers, check_pattern,
+                                overlapping_alternatives, sample_keys,
+                                time_patterns, vet_rules, RuleStats,
+                                SYNTHETIC_SAMPLES)
+from utils.pattern_helper import KeyIndex
+from webapp.app.models import Classification
+
+logging.disable(logging.CRITICAL)
+
+# polynomial on "aaaa...!", but with no nested quantifier nor alternatives
+SLOW = "^" + "a*" * 9 + "b"
+
+
+def rule(pattern, use_campaign=True):
+    return SimpleNamespace(pattern=pattern, use_campaign_id=False,
+                           use_campaign=use_campaign, use_placement_id=False,
+                           use_placement=False)
+
+
+class TestRegexHelper(unittest.TestCase):
+    def test_nested_quantifiers(self):
+        for pattern in ["(a+)+", "(a*)*b", "(x|.*y)*", "((ab)+c?)+",
+                        "(?:[a-z]+_)*$", "(\\d+){2,}"]:
+            self.assertTrue(nested_quantifiers(pattern), pattern)
+        for pattern in [".*acme.*", "^128115acme.*", "(acme|other)_\\d+",
+                        "(a{3})+", "(ab)+c*", "(?=a+)b"]:
+            self.assertFalse(nested_quantifiers(pattern), pattern)
+
+    def test_overlapping_alternatives(self):
+        for pattern in ["^(a|a)*$", "(ab|\\w)+", "(.|x)*y", "(a?b|ab)*",
+                        "((ab|ac)|a)+"]:
+            self.assertTrue(overlapping_alternatives(pattern), pattern)
+        for pattern in ["(acme|other)_\\d+", "((acme|other)_)+x",
+                        "(a|ab)*c", "(foo|bar)*", "(a|a)b", SLOW]:
+            self.assertFalse(overlapping_alternatives(pattern), pattern)
+
+    def test_check_pattern(self):
+        self.assertEqual(check_pattern(".*acme.*"), [])
+        self.assertTrue(check_pattern("acme(")[0].startswith(
+            "invalid pattern"))
+        self.assertEqual(check_pattern("(a+)+$"),
+                         ["the pattern has nested quantifiers"])
+        self.assertEqual(check_pattern("^(a|a)*b"),
+                         ["the pattern repeats alternatives that overlap"])
+
+    def test_sample_keys(self):
+        index = KeyIndex()
+        index.keys = {"dcm": [(1, "acme_x", 2, "dbm")], "dsp": []}
+        samples = sample_keys(index, rule(".*"))
+        self.assertEqual(samples[:len(SYNTHETIC_SAMPLES)], SYNTHETIC_SAMPLES)
+        self.assertIn("acme_x", samples)
+        self.assertIn("acme_x" * 4 + "!", samples,
+                      "The longest keys should be repeated")
+        self.assertEqual(sample_keys(None, rule(".*")), SYNTHETIC_SAMPLES)
+
+    def test_time_patterns(self):
+        samples = ["a" * 40 + "!"]
+        timings = time_patterns([("^a", samples), (SLOW, samples),
+                                 ("a$", samples)], 0.2)
+        self.assertIsNotNone(timings[0])
+        self.assertIsNone(timings[1], "The slow pattern should be stopped")
+        self.assertIsNotNone(timings[2],
+                             "The patterns after it should still be timed")
+
+    def test_vet_rules(self):
+        problems = vet_rules([rule("^acme"), rule("(a+)+$"), rule(SLOW)],
+                             budget=200)
+        self.assertEqual(problems[0], [])
+        self.assertEqual(problems[1], ["the pattern has nested quantifiers"])
+        self.assertTrue(problems[2][0].startswith(
+            "the pattern did not finish in 200 ms"))
+
+
+class TestRuleStats(unittest.TestCase):
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        Classification.__table__.create(self.con)
+        self.con.execute("""INSERT INTO classifications
+                            (id, pattern, brand, use_campaign_id,
+                             use_campaign, use_placement_id, use_placement)
+                            VALUES (1, 'a', 'a', 0, 1, 0, 0),
+                                   (2, 'b', 'b', 0, 1, 0, 0)""")
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_record(self):
+        stats = RuleStats(budget=50, overruns=2)
+        a, b = SimpleNamespace(id=1, pattern="a"), SimpleNamespace(id=2,
+                                                                   pattern="b")
+        stats.record(a, 0.01)
+        stats.record(a, 0.06)
+        stats.record(b, 0.06)
+        stats.record(b, 0.07)
+        self.assertEqual(stats.calls, {1: 2, 2: 2})
+        self.assertEqual(stats.flagged, {2},
+                         "A single slow match should not flag a rule")
+
+        stats.save(self.con)
+        stats.save(self.con)
+        rows = self.con.execute("""SELECT id, match_calls, match_seconds,
+                                          quarantined
+                                   FROM classifications ORDER BY id""")
+        rows = [tuple(r) for r in rows]
+        self.assertEqual([r[1] for r in rows], [2, 2],
+                         "The counters should be saved only once")
+        self.assertAlmostEqual(rows[0][2], 0.07)
+        self.assertEqual([r[3] for r in rows], [0, 1])
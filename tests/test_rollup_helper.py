@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# python standard
+import unittest
+import logging
+from datetime import datetime
+
+# third-party imports
+import pandas as pd
+from sqlalchemy import create_engine
+
+# local imports
+from utils.rollup_helper import (COLUMNS, rollup, choose_period,
+                                 refresh_rollups, query_rollup, aggregate)
+from webapp.app.models import Rollup
+
+logging.disable(logging.CRITICAL)
+
+
+def report_rows(days=pd.date_range("2018-01-29", "2018-02-11")):
+    """two DCM campaigns and two DSP campaigns of the same brand each day"""
+    rows = []
+    for day in days:
+        for ad in [1, 2]:
+            for dsp in [3, 4]:
+                rows.append({
+                    "date": day, "brand_key": 1, "ad_campaign_key": ad,
+                    "dsp_campaign_key": dsp, "brand": "acme",
+                    "sub_brand": "asprin", "dsp": "dbm",
+                    "ad_campaign_id": 100 + ad,
+                    "ad_campaign": "ad_{}".format(ad),
+                    "dsp_campaign_id": 100 + dsp,
+                    "dsp_campaign": "dsp_{}".format(dsp),
+                    "ad_impressions": 10.0 * ad, "ad_clicks": ad,
+                    "ad_reach": 1.0, "dsp_impressions": 100.0 * dsp,
+                    "dsp_clicks": dsp, "dsp_cost": 1.0
+                })
+    return pd.DataFrame(rows)[COLUMNS]
+
+
+class TestRollupHelper(unittest.TestCase):
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        self.report = report_rows()
+        self.report.to_sql("report", self.con, index=False)
+        Rollup.__table__.create(self.con)
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_rollup_brand(self):
+        df = rollup(self.report, "week", "brand")
+        self.assertEqual(list(df.date), [datetime(2018, 1, 29),
+                                         datetime(2018, 2, 5)])
+        # each campaign counted once per day, not once per pair
+        self.assertEqual(list(df.ad_clicks), [7 * 3, 7 * 3])
+        self.assertEqual(list(df.dsp_clicks), [7 * 7, 7 * 7])
+
+    def test_rollup_campaign(self):
+        df = rollup(self.report, "month", "campaign")
+        self.assertEqual(len(df), 2 * 4, "One row per month and pair")
+        self.assertEqual(df.ad_clicks.sum(), self.report.ad_clicks.sum())
+
+    def test_choose_period(self):
+        def choose(start, end, bucket):
+            return choose_period(pd.Timestamp(start), pd.Timestamp(end),
+                                 bucket)
+        self.assertEqual(choose("2018-01-01", "2018-02-28", "total"),
+                         "month")
+        self.assertEqual(choose("2018-01-29", "2018-02-11", "total"), "week")
+        self.assertEqual(choose("2018-01-29", "2018-02-11", "month"), "day")
+        self.assertEqual(choose("2018-01-30", "2018-02-11", "week"), "day")
+
+    def test_query_rollup(self):
+        refresh_rollups(self.con)
+        period, df = query_rollup(self.con, datetime(2018, 1, 29),
+                                  datetime(2018, 2, 11))
+        self.assertEqual(period, "week")
+        self.assertEqual(df.ad_clicks.tolist(), [14 * 3])
+
+        period, df = query_rollup(self.con, datetime(2018, 1, 29),
+                                  datetime(2018, 2, 11), bucket="month")
+        self.assertEqual(period, "day")
+        self.assertEqual(df.ad_clicks.tolist(), [3 * 3, 11 * 3])
+
+        period, df = query_rollup(self.con, datetime(2018, 2, 1),
+                                  datetime(2018, 2, 7), level="campaign")
+        self.assertEqual(period, "day")
+        self.assertEqual(len(df), 4)
+
+    def test_refresh_dates(self):
+        refresh_rollups(self.con)
+        self.con.execute("""UPDATE report SET ad_clicks = 0
+                            WHERE date(date) = '2018-02-06'""")
+        refresh_rollups(self.con, ["2018-02-06"])
+        _, weeks = query_rollup(self.con, datetime(2018, 1, 29),
+                                datetime(2018, 2, 11), bucket="week")
+        self.assertEqual(weeks.ad_clicks.tolist(), [7 * 3, 6 * 3],
+                         "Only the week of the date should change")
+        count = self.con.execute("SELECT COUNT(*) FROM report_rollups")
+        # brand by day, week and month, campaign pairs by week and month
+        self.assertEqual(count.scalar(), 14 + 2 + 2 + 8 + 8,
+                         "The rollups should not be duplicated")
+
+    def test_aggregate(self):
+        refresh_rollups(self.con)
+        period, df = aggregate(self.con, datetime(2018, 1, 29),
+                               datetime(2018, 2, 11), ["dsp"], "week",
+                               ["dsp_cost", "ad_clicks"])
+        self.assertEqual(period, "week")
+        self.assertEqual(list(df.columns), ["date", "dsp", "dsp_cost",
+                                            "ad_clicks"])
+        self.assertEqual(df.dsp_cost.tolist(), [7 * 2, 7 * 2])
+        # each campaign counted once per day, not once per pair
+        self.assertEqual(df.ad_clicks.tolist(), [7 * 3, 7 * 3])
+
+        period, df = aggregate(self.con, datetime(2018, 1, 30),
+                               datetime(2018, 2, 11), ["campaign"])
+        self.assertEqual(period, "day")
+        self.assertEqual(len(df), 4, "One row per pair")
+        self.assertEqual(df.dsp_clicks.sum(), 13 * 2 * (3 + 4))
+
+        period, df = aggregate(self.con, datetime(2018, 1, 31),
+                               datetime(2018, 2, 11), bucket="week")
+        self.assertEqual(period, "day")
+        self.assertEqual(df.date.tolist(), [datetime(2018, 1, 29),
+                                            datetime(2018, 2, 5)])
+        self.assertEqual(df.ad_clicks.tolist(), [5 * 3, 7 * 3],
+                         "The partial week should be summed from days")
+
+    def test_aggregate_unknown(self):
+        with self.assertRaises(Exception):
+            aggregate(self.con, datetime(2018, 1, 29), datetime(2018, 2, 11),
+                      ["ad_clicks"])
+        with self.assertRaises(Exception):
+            aggregate(self.con, datetime(2018, 1, 29), datetime(2018, 2, 11),
+                      metrics=["brand; DROP TABLE report"])
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# python standard
+import unittest
+import logging
+from datetime import date, datetime
+
+# third-party imports
+import pandas as pd
+from sqlalchemy import create_engine
+
+# local imports
+from utils.unclassified_helper import (UNIDENTIFIED, refresh_unclassified,
+                                       list_unclassified, keys_in_range)
+from webapp.app.models import Brand, Campaign, Placement, UnclassifiedKey
+
+logging.disable(logging.CRITICAL)
+
+
+class TestUnclassifiedHelper(unittest.TestCase):
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        for model in [Brand, Campaign, Placement, UnclassifiedKey]:
+            model.__table__.create(self.con)
+        self.con.execute(Brand.__table__.insert(), [
+            {"id": 1, "brand": "acme", "sub_brand": "asprin", "dsp": "dbm"},
+            {"id": 2, "brand": UNIDENTIFIED["brand"], "sub_brand": "asprin",
+             "dsp": "dbm"},
+            {"id": 3, "brand": "acme", "sub_brand": "asprin",
+             "dsp": UNIDENTIFIED["dsp"]}])
+        self.con.execute(Campaign.__table__.insert(), [
+            {"id": 1, "campaign_id": 11, "campaign": "unknown_x"},
+            {"id": 2, "campaign_id": 12, "campaign": "acme_asprin"},
+            {"id": 3, "campaign_id": 13, "campaign": "acme_asprin_x"}])
+        self.con.execute(Placement.__table__.insert(), [
+            {"id": 1, "placement_id": 21, "placement": "nowhere"}])
+        pd.DataFrame([
+            {"date": datetime(2018, 1, i), "brand_key": brand_key,
+             "campaign_key": campaign_key, "impressions": 100.0,
+             "clicks": 1, "cost": float(i), "source": "dbm"}
+            for i, brand_key, campaign_key in [(1, 2, 1), (2, 2, 1),
+                                               (3, 2, 1), (4, 1, 2)]
+        ]).to_sql("dsp_classified", self.con, index=False)
+        pd.DataFrame([
+            {"date": datetime(2018, 1, 2), "brand_key": 3,
+             "campaign_key": 3, "placement_key": 1, "impressions": 1000.0,
+             "clicks": 5, "reach": 1.0}
+        ]).to_sql("dcm_classified", self.con, index=False)
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_refresh_all(self):
+        self.assertEqual(refresh_unclassified(self.con), 2)
+        total, keys = list_unclassified(self.con)
+        self.assertEqual(total, 2)
+        self.assertEqual([k["source"] for k in keys], ["dbm", "dcm"],
+                         "The largest spend should come first")
+        self.assertEqual(keys[0], {
+            "source": "dbm", "campaign_id": 11, "campaign": "unknown_x",
+            "placement_id": None, "placement": None, "missing": ["brand"],
+            "first_seen": date(2018, 1, 1), "last_seen": date(2018, 1, 3),
+            "row_count": 3, "impressions": 300.0, "clicks": 3, "cost": 6.0})
+        self.assertEqual(keys[1]["missing"], ["dsp"])
+        self.assertEqual(keys[1]["placement"], "nowhere")
+
+        _, keys = list_unclassified(self.con, sort="impressions")
+        self.assertEqual(keys[0]["source"], "dcm")
+        total, keys = list_unclassified(self.con, source="dcm")
+        self.assertEqual((total, len(keys)), (1, 1))
+        _, keys = list_unclassified(self.con, page=2, per_page=1)
+        self.assertEqual([k["source"] for k in keys], ["dcm"])
+        with self.assertRaises(Exception):
+            list_unclassified(self.con, sort="campaign")
+
+    def test_refresh_campaigns(self):
+        refresh_unclassified(self.con)
+        self.assertEqual(keys_in_range(self.con, "dbm", date(2018, 1, 3),
+                                       date(2018, 1, 9)), [1])
+        self.assertEqual(keys_in_range(self.con, "dbm", date(2018, 1, 4),
+                                       date(2018, 1, 9)), [])
+
+        # the rows of the campaign are classified now
+        self.con.execute("UPDATE dsp_classified SET brand_key = 1")
+        self.assertEqual(refresh_unclassified(self.con, "mediamath", [1]), 0)
+        self.assertEqual(list_unclassified(self.con)[0], 2,
+                         "Other sources should not be touched")
+        self.assertEqual(refresh_unclassified(self.con, "dbm", [1, 2]), 0)
+        total, keys = list_unclassified(self.con)
+        self.assertEqual([k["source"] for k in keys], ["dcm"])
+        self.assertEqual(refresh_unclassified(self.con, "dbm", []), 0)
@@ -2,19 +2,30 @@
 
 # python standard
 import sys
+import json
+import zlib
+import unittest
 from datetime import datetime
+from unittest.mock import patch, MagicMock
 sys.path.insert(0, "./src")
 sys.path.insert(0, "./src/webapp")
 
 # third-party imports
 from flask_testing import TestCase
 from flask import abort, url_for
+from sqlalchemy import (create_engine, select, Table, MetaData, Column,
+                        DateTime, String)
+from sqlalchemy.orm import Session
 
 # local imports
 from utils.sql_helper import get_connection_strs
 from webapp.app import create_app, db
 from webapp.app.models import User, Classification
 from webapp.app.models import DCMRaw, DCM, DSPRaw, DSP, Report
+from webapp.app.models import Brand, Campaign, Placement
+from webapp.app.home import encoders, views
+from webapp.app.home.cache import ResponseCache, cache_key, etag
+from werkzeug.datastructures import MultiDict
 
 
 class TestBase(TestCase):
@@ -52,12 +63,18 @@ class TestBase(TestCase):
                                         use_placement_id=False,
                                         use_placement=True)
 
+        # create the dimensions
+        brand = Brand(id=1, brand="some brand", sub_brand="some sub brand",
+                      dsp="some dsp")
+        campaign = Campaign(id=1, campaign_id=85989,
+                            campaign="some campaign")
+        placement = Placement(id=1, placement_id=54786,
+                              placement="some placement")
+
         # create a test for dcm
-        dcm = DCM(date=datetime.now(), campaign_id=85989,
-                  campaign="some campaign", placement_id=54786,
-                  placement="some placement", impressions=87884.8,
-                  clicks=874, reach=7581.5, brand="some brand",
-                  sub_brand="some sub brand", dsp="some dsp")
+        dcm = DCM(date=datetime.now(), brand_key=1, campaign_key=1,
+                  placement_key=1, impressions=87884.8, clicks=874,
+                  reach=7581.5)
 
         # create a test for dcm raw
         dcm_raw = DCMRaw(date=datetime.now(), campaign_id=85989,
@@ -66,17 +83,16 @@ class TestBase(TestCase):
                          clicks=874, reach=7581.5)
 
         # create a test for dsp
-        dsp = DSP(date=datetime.now(), campaign_id=85989,
-                  campaign="some campaign", impressions=87884.8,
-                  clicks=874, cost=7581.5, brand="some brand",
-                  sub_brand="some sub brand", dsp="some dsp")
+        dsp = DSP(date=datetime.now(), brand_key=1, campaign_key=1,
+                  impressions=87884.8, clicks=874, cost=7581.5)
 
         # create a test for dsp raw
         dsp_raw = DSPRaw(date=datetime.now(), campaign_id=85989,
                          campaign="some campaign", impressions=87884.8,
                          clicks=874, cost=7581.5)
 
-        report = Report(date=datetime.now(), brand="some brand",
+        report = Report(date=datetime.now(), brand_key=1, ad_campaign_key=1,
+                        dsp_campaign_key=1, brand="some brand",
                         sub_brand="some sub brand", ad_campaign_id=89865,
                         ad_campaign="some campaign", dsp="some dsp",
                         dsp_campaign_id=87897, dsp_campaign="some campaign",
@@ -88,6 +104,9 @@ class TestBase(TestCase):
         db.session.add(admin)
         db.session.add(normal_user)
         db.session.add(classification)
+        db.session.add(brand)
+        db.session.add(campaign)
+        db.session.add(placement)
         db.session.add(dcm)
         db.session.add(dcm_raw)
         db.session.add(dsp)
@@ -142,8 +161,235 @@ class TestModels(TestBase):
         """
         self.assertEqual(DCMRaw.query.count(), 1)
 
+    def test_dimension_models(self):
+        """
+        Test number of records in the dimension tables
+        """
+        self.assertEqual(Brand.query.count(), 1)
+        self.assertEqual(Campaign.query.count(), 1)
+        self.assertEqual(Placement.query.count(), 1)
+
     def test_report_model(self):
         """
         Test number of records in DCMRaw table
         """
         self.assertEqual(Report.query.count(), 1)
+
+
+class TestEncoders(unittest.TestCase):
+
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        self.table = Table("t", MetaData(), Column("date", DateTime),
+                           Column("brand", String(25)))
+        self.table.create(self.con)
+        self.con.execute(self.table.insert(), [
+            {"date": datetime(2018, 1, i + 1), "brand": "brand {}".format(i)}
+            for i in range(5)])
+        self.columns = [self.table.c.date, self.table.c.brand]
+
+    def tearDown(self):
+        self.con.close()
+
+    @patch.object(encoders, "CHUNK_SIZE", 2)
+    def test_stream_json(self):
+        result = self.con.execute(select(self.columns))
+        text = "".join(encoders.stream_json(result, ["date", "brand"]))
+        data = json.loads(text)
+        self.assertEqual(data["status"], "success")
+        self.assertEqual(len(data["data"]), 5)
+        self.assertEqual(data["data"][1], {"date": "2018-01-02T00:00:00",
+                                           "brand": "brand 1"})
+
+    def test_empty(self):
+        result = MagicMock()
+        result.fetchmany.return_value = []
+        text = "".join(encoders.stream_json(result, ["date"]))
+        self.assertEqual(json.loads(text), {"status": "success", "data": []})
+
+    @patch.object(encoders, "CHUNK_SIZE", 2)
+    def test_columns(self):
+        result = self.con.execute(select(self.columns))
+        data = json.loads(b"".join(encoders.encode(result, self.columns,
+                                                   "columns")))
+        self.assertEqual(data["columns"], ["date", "brand"])
+        self.assertEqual(data["data"]["brand"],
+                         ["brand {}".format(i) for i in range(5)])
+        self.assertEqual(data["data"]["date"][0], "2018-01-01T00:00:00")
+
+        result = self.con.execute(select(self.columns).where(
+            self.table.c.brand == "none"))
+        data = json.loads(b"".join(encoders.encode(result, self.columns,
+                                                   "columns")))
+        self.assertEqual(data, {"status": "success",
+                                "columns": ["date", "brand"],
+                                "data": {"date": [], "brand": []}})
+
+    @unittest.skipUnless(encoders.arrow_available(), "pyarrow is missing")
+    @patch.object(encoders, "CHUNK_SIZE", 2)
+    def test_arrow(self):
+        import pyarrow as pa
+        result = self.con.execute(select(self.columns))
+        body = b"".join(encoders.encode(result, self.columns, "arrow"))
+        table = pa.ipc.open_stream(body).read_all()
+        self.assertEqual(table.num_rows, 5)
+        self.assertEqual(str(table.schema.field("date").type),
+                         "timestamp[us]")
+        self.assertEqual(table.column("date")[1].as_py(),
+                         datetime(2018, 1, 2))
+
+        # an empty stream still has the schema
+        result = self.con.execute(select(self.columns).where(
+            self.table.c.brand == "none"))
+        body = b"".join(encoders.encode(result, self.columns, "arrow"))
+        table = pa.ipc.open_stream(body).read_all()
+        self.assertEqual(table.num_rows, 0)
+        self.assertEqual(table.schema.names, ["date", "brand"])
+
+    @patch.object(encoders, "CHUNK_SIZE", 2)
+    def test_stream_csv(self):
+        result = self.con.execute(select(self.columns))
+        lines = "".join(encoders.stream_csv(result, ["date", "brand"]))
+        lines = lines.splitlines()
+        self.assertEqual(lines[0], "date,brand")
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[1], "2018-01-01 00:00:00,brand 0")
+
+    def test_numpy(self):
+        import numpy as np
+        self.assertEqual(json.loads(encoders.dumps(
+            {"a": [np.int64(3), np.float64(1.5)]})), {"a": [3, 1.5]})
+
+    def test_compress(self):
+        chunks = [b'{"a":', b"1" * 1000, b"}"]
+        body = b"".join(encoders.compress(iter(chunks), "gzip"))
+        self.assertEqual(zlib.decompress(body, 31), b"".join(chunks))
+        self.assertLess(len(body), 100)
+        self.assertEqual(list(encoders.compress(iter(chunks), None)), chunks)
+
+    @unittest.skipUnless(encoders.brotli, "brotli is missing")
+    def test_compress_brotli(self):
+        chunks = [b'{"a":', b"1" * 1000, b"}"]
+        body = b"".join(encoders.compress(iter(chunks), "br"))
+        self.assertEqual(encoders.brotli.decompress(body), b"".join(chunks))
+        self.assertEqual(encoders.encodings(), ["br", "gzip"])
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_cache_key(self):
+        first = cache_key(3, "/report", MultiDict([
+            ("start_date", "2018-01-01"), ("draw", "1"), ("_", "123")]))
+        second = cache_key(3, "/report", MultiDict([
+            ("draw", "2"), ("start_date", "2018-01-01")]))
+        self.assertEqual(first, second, "draw and _ should be ignored")
+        self.assertEqual(etag(first), etag(second))
+        newer = cache_key(4, "/report", MultiDict([
+            ("start_date", "2018-01-01")]))
+        self.assertNotEqual(etag(first), etag(newer),
+                            "A new report version should change the etag")
+
+    def test_bounded(self):
+        cache = ResponseCache(10)
+        cache.set("a", b"12345")
+        cache.set("b", b"12345")
+        self.assertEqual(cache.get("a"), b"12345")
+        cache.set("c", b"12345")
+        self.assertIsNone(cache.get("b"), "The least recent should go")
+        cache.set("d", b"12345678901")
+        self.assertIsNone(cache.get("d"), "It should not fit")
+        self.assertEqual(cache.get("c"), b"12345")
+
+
+class TestReportConditions(unittest.TestCase):
+
+    def where(self, args):
+        conditions = views.report_conditions(
+            datetime(2018, 1, 1), None, MultiDict(args))
+        query = select([Report.__table__.c.id]).where(db.and_(*conditions))
+        return str(query.compile(compile_kwargs={"literal_binds": True}))
+
+    def test_filters(self):
+        sql = self.where([("brand", "acme,other"), ("brand", "third"),
+                          ("dsp_campaign_id", "7"), ("campaign", "50%_")])
+        self.assertIn("report.date >= '2018-01-01 00:00:00'", sql)
+        self.assertIn("report.brand IN ('acme', 'other', 'third')", sql)
+        self.assertIn("report.dsp_campaign_id IN (7)", sql)
+        self.assertIn("report.ad_campaign LIKE '50/%/_' || '%' ESCAPE '/'",
+                      sql, "The prefix should be escaped")
+        self.assertNotIn("sub_brand", sql)
+
+    def test_invalid_id(self):
+        with self.assertRaises(ValueError):
+            self.where([("ad_campaign_id", "1 OR 1=1")])
+
+
+class TestReportPage(unittest.TestCase):
+
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        # sqlite only increments a primary key made of a single column
+        Table("report", MetaData(), *[
+            Column(c.name, c.type, primary_key=c.name == "id",
+                   server_default=c.server_default)
+            for c in Report.__table__.columns]).create(self.con)
+        rows = [{"id": i + 1, "date": datetime(2018, 1, 25 - i),
+                 "row_key": b"0" * 16, "brand_key": 1, "ad_campaign_key": 1,
+                 "dsp_campaign_key": 1, "brand": "brand {}".format(i % 3),
+                 "sub_brand": "sub", "ad_campaign_id": i,
+                 "ad_campaign": "500 off", "dsp": "dbm",
+                 "dsp_campaign_id": i, "dsp_campaign": "campaign",
+                 "ad_impressions": 1, "ad_clicks": 1, "ad_reach": 1,
+                 "dsp_impressions": 1, "dsp_clicks": 1, "dsp_cost": i}
+                for i in range(25)]
+        rows[3]["ad_campaign"] = "50%_off"
+        self.con.execute(Report.__table__.insert(), rows)
+        self.session = Session(bind=self.con)
+
+    def tearDown(self):
+        self.session.close()
+        self.con.close()
+
+    def page(self, args):
+        return views.report_page(self.session.query(Report), MultiDict(args))
+
+    def test_paging(self):
+        page = self.page({"draw": "7", "start": "10", "length": "5"})
+        self.assertEqual(page["draw"], 7)
+        self.assertEqual(page["recordsTotal"], 25)
+        self.assertEqual(page["recordsFiltered"], 25)
+        # ordered by date by default, the oldest first
+        self.assertEqual([r["ad_campaign_id"] for r in page["data"]],
+                         [14, 13, 12, 11, 10])
+
+    @patch.object(views, "REPORT_MAX_PAGE", 4)
+    def test_page_cap(self):
+        for length in ["-1", "5000"]:
+            page = self.page({"start": "0", "length": length})
+            self.assertEqual(len(page["data"]), 4)
+            self.assertEqual(page["recordsTotal"], 25)
+
+    def test_order(self):
+        page = self.page({"order[0][column]": "1", "order[0][dir]": "desc",
+                          "columns[1][data]": "dsp_cost", "length": "3"})
+        self.assertEqual([r["dsp_cost"] for r in page["data"]],
+                         [24, 23, 22])
+        for field in ["row_key", "id; DROP TABLE report", "serialize"]:
+            page = self.page({"order[0][column]": "0", "length": "3",
+                              "columns[0][data]": field})
+            self.assertEqual([r["ad_campaign_id"] for r in page["data"]],
+                             [24, 23, 22], "[{}] should be ignored, the "
+                             "rows ordered by date".format(field))
+
+    def test_search(self):
+        page = self.page({"search[value]": "0%_", "draw": "2"})
+        self.assertEqual(page["draw"], 2)
+        self.assertEqual(page["recordsTotal"], 25)
+        self.assertEqual(page["recordsFiltered"], 1,
+                         "% and _ should match themselves only")
+        self.assertEqual(page["data"][0]["ad_campaign"], "50%_off")
+
+        page = self.page({"search[value]": "brand 1", "length": "2"})
+        self.assertEqual(page["recordsTotal"], 25)
+        self.assertEqual(page["recordsFiltered"], 8)
+        self.assertEqual(len(page["data"]), 2)
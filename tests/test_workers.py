@@ -5,17 +5,30 @@ files, and how they should store it in the database.
 """
 
 # python standard
+import os
+import hashlib
+import tempfile
 import unittest
 import logging
-from unittest.mock import patch
+from datetime import datetime
+from unittest.mock import patch, MagicMock
 
 # third-party imports
 import pandas as pd
 import numpy as np
+from sqlalchemy import create_engine, event
 
 # local imports
 from utils.bucket_helper import BucketHelper
 from workers.worker import Worker, DcmWorker, DspWorker
+from workers.worker import ClassificationRule, ClassificationSnapshot
+from workers.worker import Dimension, REPORT_COLUMNS
+from webapp.app.queries import REPORT_INSERT, ROW_KEYS, row_key
+from workers.worker import generate_report_pandas, generate_report_sql
+from workers.worker import generate_report_sharded, report_shards
+from workers.worker import generate_report
+from webapp.app.models import Campaign
+from utils.regex_helper import RuleStats
 
 logging.disable(logging.CRITICAL)
 
@@ -450,3 +463,397 @@ class TestWorkers(unittest.TestCase):
 
         with self.assertRaises(Exception):
             worker.parse()
+
+
+class TestClassificationSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.rules = [
+            ClassificationRule(1, ".*acme.*", "acme", "", "", False, True,
+                               False, False, datetime(2018, 1, 1)),
+            ClassificationRule(2, ".*asprin.*", "", "asprin", "", False, True,
+                               False, False, datetime(2018, 3, 1)),
+            ClassificationRule(3, "^dbm.*", "", "", "dbm", False, False,
+                               False, True, datetime(2018, 2, 1)),
+        ]
+
+    def test_split_by_classifying(self):
+        snapshot = ClassificationSnapshot(self.rules)
+        self.assertEqual([r.id for r in snapshot.for_brand], [1])
+        self.assertEqual([r.id for r in snapshot.for_sub_brand], [2])
+        self.assertEqual([r.id for r in snapshot.for_dsp], [3])
+
+    def test_version(self):
+        snapshot = ClassificationSnapshot(self.rules)
+        self.assertEqual(snapshot.updated_at, datetime(2018, 3, 1))
+        self.assertTrue(snapshot.version.startswith("2018-03-01T00:00:00-"))
+        self.assertEqual(snapshot.version,
+                         ClassificationSnapshot(list(self.rules)).version)
+
+        changed = list(self.rules)
+        changed[0] = changed[0]._replace(pattern=".*acme corp.*")
+        self.assertNotEqual(snapshot.digest,
+                            ClassificationSnapshot(changed).digest)
+
+    def test_shared_by_workers(self):
+        snapshot = ClassificationSnapshot(self.rules)
+        dcm = DcmWorker(snapshot=snapshot)
+        dsp = DspWorker('dbm', snapshot=snapshot)
+        self.assertIs(dcm.snapshot, dsp.snapshot)
+        self.assertEqual(dsp.find_brand({"campaign": "acme_asprin"}), "acme")
+        self.assertEqual(dsp.find_dsp({"campaign": "acme_asprin"}),
+                         "unidentified dsp")
+
+    def test_quarantine(self):
+        snapshot = ClassificationSnapshot(self.rules,
+                                          stats=RuleStats(budget=1e-9,
+                                                          overruns=2))
+        dsp = DspWorker('dbm', snapshot=snapshot)
+        self.assertEqual(dsp.find_brand({"campaign": "acme_asprin"}), "acme")
+        self.assertEqual(snapshot.stats.flagged, set(),
+                         "A single slow match should not flag the rule")
+        self.assertEqual(dsp.find_brand({"campaign": "acme_asprin"}), "acme")
+        self.assertEqual(snapshot.stats.flagged, {1})
+        self.assertEqual(dsp.find_brand({"campaign": "acme_asprin"}), "acme",
+                         "A flagged rule should run until the end of the run")
+        self.assertEqual(snapshot.stats.calls, {1: 3})
+
+
+def mysql_functions(con):
+    """
+    The MySQL functions used by the row keys, for testing against sqlite
+    """
+    dbapi = getattr(con, "connection", con)
+    dbapi.create_function("MD5", 1, lambda v: hashlib.md5(
+        v.encode("utf-8")).hexdigest())
+    dbapi.create_function("UNHEX", 1, bytes.fromhex)
+    dbapi.create_function("CONCAT_WS", -1, lambda sep, *args: sep.join(
+        str(a) for a in args if a is not None))
+
+
+class TestUploadModes(unittest.TestCase):
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        mysql_functions(self.con)
+        self.con.execute("""CREATE TABLE dsp_raw (date DATETIME,
+                            campaign_id INTEGER, campaign VARCHAR(75),
+                            impressions FLOAT, clicks INTEGER, cost FLOAT,
+                            source VARCHAR(25), row_key BLOB)""")
+        self.con.execute("""CREATE UNIQUE INDEX dsp_raw_index
+                            ON dsp_raw (row_key, date)""")
+        existing = [
+            (datetime(2018, 1, 1), 1, "acme_old", 10, 1, 1.0, "dbm"),
+            (datetime(2018, 1, 2), 1, "acme_old", 10, 1, 1.0, "dbm"),
+            (datetime(2018, 1, 5), 1, "acme_old", 10, 1, 1.0, "dbm"),
+            (datetime(2018, 1, 2), 2, "acme_mm", 10, 1, 1.0, "mediamath"),
+            (datetime(2018, 1, 1), 1, "acme_new", 10, 1, 1.0, "mediamath"),
+            (datetime(2018, 1, 2), 1, "acme_new", 10, 1, 1.0, ""),
+        ]
+        for row in existing:
+            self.con.execute("""INSERT INTO dsp_raw
+                                VALUES (?,?,?,?,?,?,?,NULL)""", row)
+        self.con.execute("UPDATE dsp_raw SET row_key = {}".format(
+            row_key(ROW_KEYS["dsp_raw"])))
+        self.worker = DspWorker('dbm', snapshot=ClassificationSnapshot([]))
+        self.worker.dfs = [pd.DataFrame([{
+            "date": datetime(2018, 1, 1),
+            "campaign_id": 1,
+            "campaign": "acme_new",
+            "impressions": 20.0,
+            "clicks": 2,
+            "cost": 2.0,
+        }, {
+            "date": datetime(2018, 1, 2),
+            "campaign_id": 1,
+            "campaign": "acme_new",
+            "impressions": 20.0,
+            "clicks": 2,
+            "cost": 2.0,
+        }])]
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_replace_range(self):
+        with patch('workers.worker.get_con', return_value=self.con):
+            self.worker.upload(raw=True, mode="replace")
+        rows = self.con.execute("""SELECT date(date), campaign, source
+                                   FROM dsp_raw
+                                   ORDER BY source, date""").fetchall()
+        self.assertEqual([tuple(r) for r in rows], [
+            ("2018-01-01", "acme_new", "dbm"),
+            ("2018-01-02", "acme_new", "dbm"),
+            ("2018-01-05", "acme_old", "dbm"),
+            ("2018-01-01", "acme_new", "mediamath"),
+            ("2018-01-02", "acme_mm", "mediamath"),
+        ], "Only the dbm rows inside the file's dates should be replaced, "
+           "with the rows of no source")
+        key = self.con.execute("""SELECT row_key FROM dsp_raw
+                                  WHERE campaign = 'acme_new'
+                                    AND source = 'dbm'
+                                  ORDER BY date""").scalar()
+        self.assertEqual(key,
+                         hashlib.md5(b"2018-01-01|dbm|1|acme_new").digest(),
+                         "row_key should be the md5 of the dimensions")
+        tables = self.con.execute("""SELECT name FROM sqlite_master
+                                     WHERE name = 'dsp_raw_temp'""")
+        self.assertIsNone(tables.fetchone(), "Temp table should be dropped")
+
+    def test_row_key_ignores_case(self):
+        self.con.execute("""INSERT INTO dsp_raw VALUES
+                            ('2018-01-09', 9, 'Acme', 1, 1, 1.0, 'dbm', NULL),
+                            ('2018-01-09', 9, 'acme ', 1, 1, 1.0, 'dbm',
+                             NULL)""")
+        keys = self.con.execute("""SELECT DISTINCT {} FROM dsp_raw
+                                   WHERE campaign_id = 9""".format(
+            row_key(ROW_KEYS["dsp_raw"]))).fetchall()
+        self.assertEqual(len(keys), 1, "Rows differing only by case or "
+                         "trailing spaces should have the same key")
+
+    def test_unknown_mode(self):
+        with patch('workers.worker.get_con', return_value=self.con):
+            with self.assertRaises(Exception):
+                self.worker.upload(raw=True, mode="merge")
+
+    def test_mark_dirty(self):
+        df = self.worker.dfs[0].copy()
+        df.loc[1, "date"] = datetime(2018, 1, 4)
+        con = MagicMock()
+        self.worker.mark_dirty(con, pd.concat([df, df]), "upsert")
+        dates = [p["date"] for p in con.execute.call_args[0][1]]
+        self.assertEqual(dates, [datetime(2018, 1, 1), datetime(2018, 1, 4)],
+                         "Each date of the file should be marked once")
+        self.worker.mark_dirty(con, df, "replace")
+        dates = [p["date"] for p in con.execute.call_args[0][1]]
+        self.assertEqual(len(dates), 4,
+                         "Every date of a replaced range should be marked")
+
+    @patch.dict(os.environ, {"LOAD_MODE": "", "LOAD_MODE_DBM": "Replace"})
+    def test_load_mode_per_source(self):
+        self.assertEqual(self.worker.load_mode, "replace")
+        dcm = DcmWorker(snapshot=ClassificationSnapshot([]))
+        self.assertEqual(dcm.load_mode, "upsert")
+
+
+class TestDimension(unittest.TestCase):
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        Campaign.__table__.create(self.con)
+        self.dimension = Dimension(Campaign.__table__,
+                                   ["campaign_id", "campaign"])
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_resolve(self):
+        df = pd.DataFrame([
+            {"campaign_id": 1, "campaign": "acme_asprin", "clicks": 1},
+            {"campaign_id": 2, "campaign": "acme_car", "clicks": 2},
+            {"campaign_id": 1, "campaign": "acme_asprin", "clicks": 3},
+        ])
+        keys = self.dimension.resolve(self.con, df)
+        self.assertEqual(len(keys), 3)
+        self.assertEqual(keys[0], keys[2])
+        self.assertNotEqual(keys[0], keys[1])
+        count = self.con.execute("SELECT COUNT(*) FROM campaigns").scalar()
+        self.assertEqual(count, 2)
+
+        # known combinations come from the cache
+        with patch.object(self.dimension, 'refresh') as mock_refresh:
+            again = self.dimension.resolve(self.con, df.iloc[::-1])
+            mock_refresh.assert_not_called()
+        self.assertListEqual(list(again), list(keys[::-1]))
+
+    def test_resolve_existing(self):
+        self.con.execute("""INSERT INTO campaigns (id, campaign_id, campaign)
+                            VALUES (7, 1, 'acme_asprin')""")
+        df = pd.DataFrame([{"campaign_id": 1, "campaign": "acme_asprin"}])
+        self.assertEqual(self.dimension.resolve(self.con, df)[0], 7)
+
+    def test_resolve_collation(self):
+        # like the MySQL collation, the case is ignored
+        con = create_engine("sqlite://").connect()
+        con.execute("""CREATE TABLE campaigns (
+                       id INTEGER PRIMARY KEY, campaign_id INTEGER,
+                       campaign VARCHAR(75) COLLATE NOCASE,
+                       UNIQUE (campaign_id, campaign))""")
+        first = pd.DataFrame([{"campaign_id": 1, "campaign": "Acme"}])
+        key = self.dimension.resolve(con, first)[0]
+        second = pd.DataFrame([{"campaign_id": 1, "campaign": "acme"},
+                               {"campaign_id": 1, "campaign": "Acme"}])
+        self.assertEqual(list(self.dimension.resolve(con, second)),
+                         [key, key], "Both spellings should share the key")
+        count = con.execute("SELECT COUNT(*) FROM campaigns").scalar()
+        self.assertEqual(count, 1)
+        con.close()
+
+    def test_resolve_in_bulk(self):
+        statements = []
+        event.listen(self.con, "before_cursor_execute",
+                     lambda *args: statements.append(args[2]))
+        df = pd.DataFrame([{"campaign_id": i, "campaign": name}
+                           for i in range(50)
+                           for name in ["Acme", "acme ", "acme"]])
+        keys = self.dimension.resolve(self.con, df)
+        self.assertEqual(len(statements), 3,
+                         "It should refresh, insert and select once")
+        self.assertEqual(len(set(keys)), 50,
+                         "The spellings of a campaign should share its key")
+        count = self.con.execute("SELECT COUNT(*) FROM campaigns").scalar()
+        self.assertEqual(count, 50)
+
+
+def synthetic_report_data(con, days=5, rows=400, seed=42):
+    """
+    Classified DCM and DSP data with repeated keys, a brand without DSP
+    data, and a DSP campaign without DCM data
+    """
+    rnd = np.random.RandomState(seed)
+    dates = pd.date_range("2018-01-01", periods=days)
+    con.execute("""CREATE TABLE brands (id INTEGER, brand VARCHAR(25),
+                   sub_brand VARCHAR(25), dsp VARCHAR(25))""")
+    con.execute("""CREATE TABLE campaigns (id INTEGER, campaign_id INTEGER,
+                   campaign VARCHAR(75))""")
+    con.execute("""CREATE TABLE report ({}, row_key BLOB)""".format(
+        ", ".join(REPORT_COLUMNS)))
+    con.execute("""CREATE TABLE dirty_dates (date DATETIME,
+                   marked_at DATETIME)""")
+    for i, brand in enumerate(["acme", "acme", "zeta", "omega"]):
+        con.execute("INSERT INTO brands VALUES (?,?,?,?)",
+                    (i + 1, brand, "sub{}".format(i), "dbm"))
+    for i in range(8):
+        con.execute("INSERT INTO campaigns VALUES (?,?,?)",
+                    (i + 1, 100 + i, "campaign_{}".format(i)))
+    dcm = pd.DataFrame({
+        "date": dates[rnd.randint(0, days, rows)],
+        "brand_key": rnd.randint(1, 4, rows),
+        "campaign_key": rnd.randint(1, 4, rows),
+        "placement_key": rnd.randint(1, 50, rows),
+        "impressions": rnd.randint(0, 10000, rows).astype(float),
+        "clicks": rnd.randint(0, 100, rows),
+        "reach": rnd.randint(0, 100, rows).astype(float),
+    })
+    dsp = pd.DataFrame({
+        "date": dates[rnd.randint(0, days, rows // 2)],
+        "brand_key": rnd.choice([1, 2, 4], rows // 2),
+        "campaign_key": rnd.randint(4, 9, rows // 2),
+        "impressions": rnd.randint(0, 10000, rows // 2).astype(float),
+        "clicks": rnd.randint(0, 100, rows // 2),
+        "cost": rnd.randint(0, 1000, rows // 2).astype(float),
+        "source": "dbm",
+    })
+    dcm.to_sql("dcm_classified", con, index=False)
+    dsp.to_sql("dsp_classified", con, index=False)
+
+
+class TestReportEngines(unittest.TestCase):
+    def setUp(self):
+        self.con = create_engine("sqlite://").connect()
+        mysql_functions(self.con)
+        synthetic_report_data(self.con)
+
+    def tearDown(self):
+        self.con.close()
+
+    def report(self):
+        df = pd.read_sql("SELECT * FROM report", self.con,
+                         parse_dates=["date"])
+        return df.sort_values(REPORT_COLUMNS[:4]).reset_index(drop=True)
+
+    @patch('workers.worker.REPORT_INSERT',
+           REPORT_INSERT.split("ON DUPLICATE KEY")[0])
+    def test_same_rows_as_sql(self):
+        # sqlite has no ON DUPLICATE KEY, the report is empty anyway
+        generate_report_sql(self.con, datetime.now(), full=True)
+        expected = self.report()
+        self.con.execute("DELETE FROM report")
+        rows = generate_report_pandas(self.con, datetime.now(), full=True)
+        result = self.report()
+        self.assertEqual(rows, len(result))
+        self.assertGreater(len(expected), 0)
+        self.assertTrue((expected.dsp_campaign_key == 0).any(),
+                        "Some brands should not have DSP data")
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    def test_dirty_dates(self):
+        generate_report_pandas(self.con, datetime.now(), full=True)
+        before = self.report()
+        self.con.execute("""UPDATE dcm_classified SET clicks = 0
+                            WHERE date(date) = '2018-01-02'""")
+        self.con.execute("""INSERT INTO dirty_dates
+                            SELECT DISTINCT date, '2018-01-01'
+                            FROM dcm_classified
+                            WHERE date(date) = '2018-01-02'""")
+        generate_report_pandas(self.con, datetime.now())
+        after = self.report()
+        changed = after.date == datetime(2018, 1, 2)
+        self.assertTrue((after[changed].ad_clicks == 0).all(),
+                        "The dirty date should be generated again")
+        pd.testing.assert_frame_equal(after[~changed], before[~changed],
+                                      check_dtype=False)
+        count = self.con.execute("SELECT COUNT(*) FROM dirty_dates").scalar()
+        self.assertEqual(count, 0, "The dirty dates should be cleaned")
+
+    def test_no_fan_out(self):
+        generate_report_pandas(self.con, datetime.now(), full=True)
+        report = self.report()
+        dcm = pd.read_sql("SELECT * FROM dcm_classified", self.con)
+        ad = report.groupby(REPORT_COLUMNS[:3]).ad_clicks.unique()
+        self.assertTrue((ad.str.len() == 1).all(),
+                        "Each DCM campaign should have a single value")
+        self.assertEqual(ad.str[0].sum(), dcm.clicks.sum(),
+                         "DCM metrics should not be inflated by the join")
+
+
+@patch('workers.worker.REPORT_INSERT',
+       REPORT_INSERT.split("ON DUPLICATE KEY")[0])
+class TestShardedReport(unittest.TestCase):
+    def setUp(self):
+        # the shards need their own connections to the same database
+        self.folder = tempfile.TemporaryDirectory()
+        engine = create_engine("sqlite:///{}/report.db".format(
+            self.folder.name), connect_args={"timeout": 30})
+        event.listen(engine, "connect",
+                     lambda dbapi, record: mysql_functions(dbapi))
+        self.con = engine.connect()
+        synthetic_report_data(self.con, days=20)
+
+    def tearDown(self):
+        self.con.close()
+        self.con.engine.dispose()
+        self.folder.cleanup()
+
+    def report(self):
+        df = pd.read_sql("SELECT * FROM report", self.con,
+                         parse_dates=["date"])
+        return df.sort_values(REPORT_COLUMNS[:4]).reset_index(drop=True)
+
+    def test_report_shards(self):
+        shards = report_shards("2018-01-01 00:00:00", datetime(2018, 1, 10),
+                               4)
+        self.assertEqual(shards, [
+            (datetime(2018, 1, 1), datetime(2018, 1, 5)),
+            (datetime(2018, 1, 5), datetime(2018, 1, 9)),
+            (datetime(2018, 1, 9), datetime(2018, 1, 11)),
+        ])
+
+    def test_same_rows_as_single(self):
+        generate_report_sql(self.con, datetime.now(), full=True)
+        expected = self.report()
+        self.con.execute("""INSERT INTO report (date, row_key)
+                            VALUES ('2017-06-01', x'00')""")
+        rows = generate_report_sharded(self.con, datetime.now(), full=True,
+                                       shard_days=3, parallelism=3)
+        pd.testing.assert_frame_equal(self.report(), expected,
+                                      check_dtype=False)
+        self.assertEqual(rows, len(expected))
+
+    @patch("workers.worker.generate_report_sharded")
+    @patch("workers.worker.get_connection")
+    def test_connection_disposed(self, mock_connection, mock_sharded):
+        mock_sharded.side_effect = Exception("shard failed")
+        with self.assertRaises(Exception):
+            generate_report(full=True, engine="sql", parallelism=20)
+        mock_connection.assert_called_once_with(pool_size=21)
+        con = mock_connection.return_value
+        con.close.assert_called_once_with()
+        con.engine.dispose.assert_called_once_with()